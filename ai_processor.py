@@ -1,10 +1,54 @@
 import os
+import re
 import json
-from openai import OpenAI
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from openai import OpenAI, AsyncOpenAI, APIStatusError, APIConnectionError, APITimeoutError
+from result_cache import ResultCache
+
+# Responses are shared by every AIProcessor in the process, so the OCR
+# pipeline, the classifier and the chatbot all hit the same cache
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_shared_cache():
+    """
+    Get the process-wide AI response cache, creating it on first use
+    
+    Returns:
+        ResultCache: Cache in data/ai_cache.db, bounded by AI_CACHE_MAX_MB (64 MB)
+            with entries expiring after AI_CACHE_TTL seconds (7 days), or None if
+            the AI_CACHE environment variable is set to 0
+    """
+    global _shared_cache
+    if os.environ.get("AI_CACHE", "1") == "0":
+        return None
+    
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            max_mb = int(os.environ.get("AI_CACHE_MAX_MB", 64))
+            ttl = float(os.environ.get("AI_CACHE_TTL", 7 * 24 * 3600))
+            _shared_cache = ResultCache(
+                os.path.join("data", "ai_cache.db"), max_bytes=max_mb * 1024 * 1024, ttl=ttl
+            )
+        return _shared_cache
 
 class AIProcessor:
-    def __init__(self):
-        """Initialize the AI Processor with OpenAI client."""
+    def __init__(self, cache=None, bypass_cache=None):
+        """
+        Initialize the AI Processor with OpenAI client.
+        
+        Args:
+            cache (ResultCache, optional): Cache for model responses, keyed on model,
+                method and normalised prompt. Defaults to the shared cache from
+                get_shared_cache().
+            bypass_cache (bool, optional): Always call the model, but still store the
+                fresh responses. Defaults to the AI_CACHE_BYPASS environment
+                variable (disabled unless set to 1).
+        """
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OpenAI API key is required")
@@ -13,6 +57,64 @@ class AIProcessor:
         # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
         # do not change this unless explicitly requested by the user
         self.model = "gpt-4o"
+        
+        self.cache = cache if cache is not None else get_shared_cache()
+        if bypass_cache is None:
+            bypass_cache = os.environ.get("AI_CACHE_BYPASS", "0") == "1"
+        self.bypass_cache = bypass_cache
+    
+    def _chat(self, method, messages, **options):
+        """
+        Send a chat completion request, answering repeated prompts from the cache
+        
+        Args:
+            method (str): Name of the calling method; part of the cache key and the
+                namespace its hit rate is reported under
+            messages (list): Chat messages
+            **options: Extra arguments for chat.completions.create
+        
+        Returns:
+            str: Content of the model's reply
+        """
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(method, messages, options)
+            if not self.bypass_cache:
+                cached = self.cache.get(key, namespace=method)
+                if cached is not None:
+                    return cached
+        
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            **options
+        )
+        content = response.choices[0].message.content
+        
+        if key is not None and content:
+            self.cache.set(key, content)
+        return content
+    
+    def _cache_key(self, method, messages, options):
+        """
+        Build the cache key for a request
+        
+        Args:
+            method (str): Name of the calling method
+            messages (list): Chat messages
+            options (dict): Extra arguments for chat.completions.create
+        
+        Returns:
+            str: SHA-256 hex digest of the model, method, normalised prompt and options
+        """
+        # Prompts are indented f-strings; whitespace differences should not
+        # defeat the cache
+        normalised = [
+            {"role": message["role"], "content": re.sub(r'\s+', ' ', message["content"]).strip()}
+            for message in messages
+        ]
+        payload = json.dumps([self.model, method, normalised, options], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
     
     def enhance_ocr_text(self, raw_text):
         """
@@ -32,12 +134,7 @@ class AIProcessor:
             {raw_text}
             """
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            enhanced_text = response.choices[0].message.content
+            enhanced_text = self._chat("enhance_ocr_text", [{"role": "user", "content": prompt}])
             return enhanced_text
         except Exception as e:
             print(f"Error enhancing OCR text: {e}")
@@ -69,25 +166,15 @@ class AIProcessor:
             {raw_text}
             """
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+            content = self._chat(
+                "extract_structured_data",
+                [{"role": "user", "content": prompt}],
                 response_format={"type": "json_object"}
             )
             
             try:
-                result = json.loads(response.choices[0].message.content)
-                # Handle case where the AI might wrap the items in a parent object
-                if "items" in result:
-                    return result["items"]
-                elif isinstance(result, list):
-                    return result
-                else:
-                    # Try to find any array in the response
-                    for key, value in result.items():
-                        if isinstance(value, list) and len(value) > 0:
-                            return value
-                    return []
+                result = json.loads(content)
+                return self._find_items(result)
             except json.JSONDecodeError:
                 # If not valid JSON, try to extract via regex as fallback
                 print("AI response was not valid JSON")
@@ -97,6 +184,99 @@ class AIProcessor:
             print(f"Error extracting structured data: {e}")
             return []
     
+    def extract_invoice(self, raw_text, include_metadata=False):
+        """
+        Extract line items, and optionally invoice metadata, from raw OCR text
+        in a single request. The model corrects OCR errors while reading
+        instead of returning a rewritten copy of the text, so this replaces
+        the enhance_ocr_text + extract_structured_data round trips.
+        
+        Args:
+            raw_text (str): Raw OCR text
+            include_metadata (bool, optional): Also extract the fields returned by
+                analyze_invoice_metadata
+        
+        Returns:
+            dict: "items" (list of item dictionaries) and "metadata" (dict, empty
+                unless include_metadata is set)
+        """
+        try:
+            content = self._chat(
+                "extract_invoice",
+                self._extract_invoice_messages(raw_text, include_metadata),
+                response_format={"type": "json_object"}
+            )
+            return self._parse_invoice(content, include_metadata)
+        
+        except Exception as e:
+            print(f"Error extracting invoice data: {e}")
+            return {"items": [], "metadata": {}}
+    
+    def _extract_invoice_messages(self, raw_text, include_metadata):
+        """Build the extract_invoice request, shared with AsyncAIProcessor"""
+        metadata_prompt = ""
+        if include_metadata:
+            metadata_prompt = """
+        Also return a "metadata" object with:
+        - invoice_number: The invoice number/ID
+        - invoice_date: The date of the invoice
+        - vendor_name: The name of the vendor/supplier
+        - total_amount: The total invoice amount
+        - tax_amount: The total tax amount
+        - currency: The currency used
+        If you can't find a particular metadata field, set its value to null.
+        """
+        
+        prompt = f"""
+        The following text was extracted using OCR from an invoice and may contain OCR errors
+        (for example O read as 0, l read as 1, or broken line breaks). Correct them while reading,
+        but do not return the corrected text.
+        
+        Return a JSON object with an "items" list. For each line item, provide:
+        - item: The name/description of the item
+        - qty: The quantity purchased
+        - unit_price: The price per unit
+        - total: The total price for this item (qty * unit_price)
+        Do not include subtotal, tax or grand total lines as items. If you can't extract all
+        fields for an item, make reasonable estimates based on the available information.
+        {metadata_prompt}
+        Invoice text:
+        {raw_text}
+        """
+        
+        return [{"role": "user", "content": prompt}]
+    
+    def _parse_invoice(self, content, include_metadata):
+        """Parse an extract_invoice response into items and metadata"""
+        result = json.loads(content)
+        metadata = result.get("metadata") if isinstance(result, dict) else None
+        return {
+            "items": self._find_items(result),
+            "metadata": metadata if include_metadata and isinstance(metadata, dict) else {}
+        }
+    
+    def _find_items(self, result):
+        """
+        Find the list of items in a JSON-mode response
+        
+        Args:
+            result: Decoded JSON response
+        
+        Returns:
+            list: List of dictionaries containing item details
+        """
+        # Handle case where the AI might wrap the items in a parent object
+        if isinstance(result, list):
+            return result
+        elif "items" in result:
+            return result["items"]
+        else:
+            # Try to find any array in the response
+            for key, value in result.items():
+                if isinstance(value, list) and len(value) > 0:
+                    return value
+            return []
+    
     def analyze_invoice_metadata(self, raw_text):
         """
         Extract invoice metadata like invoice number, date, vendor, etc.
@@ -108,34 +288,37 @@ class AIProcessor:
             dict: Dictionary with extracted metadata
         """
         try:
-            prompt = f"""
-            Extract the following metadata from this invoice text:
-            - invoice_number: The invoice number/ID
-            - invoice_date: The date of the invoice
-            - vendor_name: The name of the vendor/supplier
-            - total_amount: The total invoice amount
-            - tax_amount: The total tax amount
-            - currency: The currency used
-            
-            Return the data as a JSON object. If you can't find a particular field, set its value to null.
-            
-            Invoice text:
-            {raw_text}
-            """
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+            content = self._chat(
+                "analyze_invoice_metadata",
+                self._invoice_metadata_messages(raw_text),
                 response_format={"type": "json_object"}
             )
             
-            metadata = json.loads(response.choices[0].message.content)
+            metadata = json.loads(content)
             return metadata
             
         except Exception as e:
             print(f"Error extracting invoice metadata: {e}")
             return {}
     
+    def _invoice_metadata_messages(self, raw_text):
+        """Build the analyze_invoice_metadata request, shared with AsyncAIProcessor"""
+        prompt = f"""
+        Extract the following metadata from this invoice text:
+        - invoice_number: The invoice number/ID
+        - invoice_date: The date of the invoice
+        - vendor_name: The name of the vendor/supplier
+        - total_amount: The total invoice amount
+        - tax_amount: The total tax amount
+        - currency: The currency used
+        
+        Return the data as a JSON object. If you can't find a particular field, set its value to null.
+        
+        Invoice text:
+        {raw_text}
+        """
+        return [{"role": "user", "content": prompt}]
+    
     def suggest_hsn_codes(self, item_descriptions):
         """
         Suggest appropriate HSN codes for item descriptions
@@ -147,42 +330,45 @@ class AIProcessor:
             dict: Dictionary mapping item descriptions to HSN codes and GST rates
         """
         try:
-            prompt = f"""
-            For each of the following product descriptions, suggest the most appropriate HSN code and GST rate.
-            Return the results as a JSON object where the keys are the item descriptions and the values are 
-            objects containing the hsn_code and gst_rate.
-            
-            Item descriptions:
-            {json.dumps(item_descriptions)}
-            
-            Consider common HSN codes used in India:
-            - 1905: Bread, pastry, cakes, biscuits (18%)
-            - 2106: Food preparations (18%)
-            - 3004: Medicaments (12%)
-            - 3304: Beauty or make-up preparations (28%)
-            - 3401: Soap, organic surface-active products (18%)
-            - 3402: Washing and cleaning preparations (18%)
-            - 3923: Plastic articles for packaging (18%)
-            - 4819: Cartons, boxes, cases, bags of paper (18%)
-            - 8415: Air conditioning machines (28%)
-            - 8508: Vacuum cleaners (28%)
-            - 8516: Electric heating equipment (28%)
-            - 8517: Telephones, smartphones (18%)
-            - 8528: Monitors and projectors, TV receivers (28%)
-            """
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+            content = self._chat(
+                "suggest_hsn_codes",
+                self._suggest_hsn_codes_messages(item_descriptions),
                 response_format={"type": "json_object"}
             )
             
-            hsn_suggestions = json.loads(response.choices[0].message.content)
+            hsn_suggestions = json.loads(content)
             return hsn_suggestions
             
         except Exception as e:
             print(f"Error suggesting HSN codes: {e}")
             return {}
+    
+    def _suggest_hsn_codes_messages(self, item_descriptions):
+        """Build the suggest_hsn_codes request, shared with AsyncAIProcessor"""
+        prompt = f"""
+        For each of the following product descriptions, suggest the most appropriate HSN code and GST rate.
+        Return the results as a JSON object where the keys are the item descriptions and the values are 
+        objects containing the hsn_code and gst_rate.
+        
+        Item descriptions:
+        {json.dumps(item_descriptions)}
+        
+        Consider common HSN codes used in India:
+        - 1905: Bread, pastry, cakes, biscuits (18%)
+        - 2106: Food preparations (18%)
+        - 3004: Medicaments (12%)
+        - 3304: Beauty or make-up preparations (28%)
+        - 3401: Soap, organic surface-active products (18%)
+        - 3402: Washing and cleaning preparations (18%)
+        - 3923: Plastic articles for packaging (18%)
+        - 4819: Cartons, boxes, cases, bags of paper (18%)
+        - 8415: Air conditioning machines (28%)
+        - 8508: Vacuum cleaners (28%)
+        - 8516: Electric heating equipment (28%)
+        - 8517: Telephones, smartphones (18%)
+        - 8528: Monitors and projectors, TV receivers (28%)
+        """
+        return [{"role": "user", "content": prompt}]
 
     def get_chatbot_response(self, user_message, chat_history=None):
         """
@@ -219,14 +405,245 @@ class AIProcessor:
             messages.append({"role": "user", "content": user_message})
             
             # Get response from AI model
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
+            return self._chat(
+                "get_chatbot_response",
+                messages,
                 max_tokens=300  # Limit token length for cost efficiency
             )
-            
-            return response.choices[0].message.content
         
         except Exception as e:
             print(f"Error getting chatbot response: {e}")
-            return "I'm having trouble connecting to my knowledge base right now. Please try again later."
\ No newline at end of file
+            return "I'm having trouble connecting to my knowledge base right now. Please try again later."
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """
+        Initialize a token bucket rate limiter for use within one event loop
+        
+        Args:
+            rate (float): Tokens added per second
+            capacity (float, optional): Maximum burst size. Defaults to one second's worth of tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AsyncAIProcessor(AIProcessor):
+    def __init__(self, cache=None, bypass_cache=None, max_concurrency=None, requests_per_minute=None,
+                 max_retries=None):
+        """
+        Initialize an asyncio variant of the AI Processor for batch jobs. Requests
+        run on a private event loop in a background thread, so synchronous code
+        can submit() work and carry on (e.g. with OCR) while it is in flight.
+        
+        Args:
+            cache (ResultCache, optional): Response cache, as for AIProcessor
+            bypass_cache (bool, optional): Skip cache lookups, as for AIProcessor
+            max_concurrency (int, optional): Maximum requests in flight. Defaults to
+                the AI_MAX_CONCURRENCY environment variable, or 8.
+            requests_per_minute (float, optional): Rate limit enforced with a token
+                bucket. Defaults to the AI_REQUESTS_PER_MINUTE environment variable,
+                or 300.
+            max_retries (int, optional): Retries on rate limit (429), server (5xx) and
+                connection errors, with jittered exponential backoff. Defaults to
+                the AI_MAX_RETRIES environment variable, or 5.
+        """
+        super().__init__(cache=cache, bypass_cache=bypass_cache)
+        
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("AI_MAX_CONCURRENCY", 8))
+        if requests_per_minute is None:
+            requests_per_minute = float(os.environ.get("AI_REQUESTS_PER_MINUTE", 300))
+        if max_retries is None:
+            max_retries = int(os.environ.get("AI_MAX_RETRIES", 5))
+        self.max_concurrency = max(1, max_concurrency)
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = 1.0
+        self.backoff_max = 30.0
+        
+        # Retries are handled here, with jitter, instead of by the SDK
+        self.async_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+        
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._semaphore = None
+        self._bucket = None
+        self.retries = 0
+    
+    def submit(self, coroutine):
+        """
+        Schedule a coroutine on the processor's event loop
+        
+        Args:
+            coroutine: Coroutine to run, typically a call to one of the async methods
+        
+        Returns:
+            concurrent.futures.Future: Future holding the coroutine's result
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="ai-event-loop", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+    
+    def close(self):
+        """Stop the background event loop, if one was started."""
+        with self._loop_lock:
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self.async_client.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+                self._semaphore = None
+                self._bucket = None
+    
+    async def _achat(self, method, messages, **options):
+        """
+        Send a chat completion request with bounded concurrency, rate limiting
+        and retries, answering repeated prompts from the cache
+        
+        Args:
+            method (str): Name of the calling method
+            messages (list): Chat messages
+            **options: Extra arguments for chat.completions.create
+        
+        Returns:
+            str: Content of the model's reply
+        """
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(method, messages, options)
+            if not self.bypass_cache:
+                cached = self.cache.get(key, namespace=method)
+                if cached is not None:
+                    return cached
+        
+        # Created lazily so they belong to the loop the requests run on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._bucket = TokenBucket(self.requests_per_minute / 60)
+        
+        async with self._semaphore:
+            attempt = 0
+            while True:
+                await self._bucket.acquire()
+                try:
+                    response = await self.async_client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        **options
+                    )
+                    break
+                except (APIStatusError, APIConnectionError, APITimeoutError) as e:
+                    status = getattr(e, "status_code", None)
+                    retryable = status is None or status == 429 or status >= 500
+                    if not retryable or attempt >= self.max_retries:
+                        raise
+                    
+                    await asyncio.sleep(self._backoff(attempt, e))
+                    attempt += 1
+                    self.retries += 1
+        
+        content = response.choices[0].message.content
+        if key is not None and content:
+            self.cache.set(key, content)
+        return content
+    
+    def _backoff(self, attempt, error):
+        """
+        Compute the delay before a retry: the server's Retry-After if it sent
+        one, otherwise exponential backoff with full jitter
+        
+        Args:
+            attempt (int): Number of retries already made
+            error (Exception): Error that triggered the retry
+        
+        Returns:
+            float: Seconds to wait
+        """
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    async def extract_invoice_async(self, raw_text, include_metadata=False):
+        """
+        Async version of AIProcessor.extract_invoice
+        
+        Args:
+            raw_text (str): Raw OCR text
+            include_metadata (bool, optional): Also extract invoice metadata
+        
+        Returns:
+            dict: "items" (list of item dictionaries) and "metadata" (dict)
+        """
+        try:
+            content = await self._achat(
+                "extract_invoice",
+                self._extract_invoice_messages(raw_text, include_metadata),
+                response_format={"type": "json_object"}
+            )
+            return self._parse_invoice(content, include_metadata)
+        except Exception as e:
+            print(f"Error extracting invoice data: {e}")
+            return {"items": [], "metadata": {}}
+    
+    async def analyze_invoice_metadata_async(self, raw_text):
+        """
+        Async version of AIProcessor.analyze_invoice_metadata
+        
+        Args:
+            raw_text (str): OCR text from invoice
+        
+        Returns:
+            dict: Dictionary with extracted metadata
+        """
+        try:
+            content = await self._achat(
+                "analyze_invoice_metadata",
+                self._invoice_metadata_messages(raw_text),
+                response_format={"type": "json_object"}
+            )
+            return json.loads(content)
+        except Exception as e:
+            print(f"Error extracting invoice metadata: {e}")
+            return {}
+    
+    async def suggest_hsn_codes_async(self, item_descriptions):
+        """
+        Async version of AIProcessor.suggest_hsn_codes
+        
+        Args:
+            item_descriptions (list): List of item descriptions
+        
+        Returns:
+            dict: Dictionary mapping item descriptions to HSN codes and GST rates
+        """
+        try:
+            content = await self._achat(
+                "suggest_hsn_codes",
+                self._suggest_hsn_codes_messages(item_descriptions),
+                response_format={"type": "json_object"}
+            )
+            return json.loads(content)
+        except Exception as e:
+            print(f"Error suggesting HSN codes: {e}")
+            return {}
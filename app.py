@@ -1,6 +1,8 @@
 import os
+import shutil
 import tempfile
 import threading
+import time
 import datetime
 from flask import Flask, request, jsonify, send_file, render_template
 from flask_cors import CORS
@@ -14,11 +16,17 @@ from ocr_processor import OCRProcessor
 from gst_classifier import GSTClassifier
 from report_generator import ReportGenerator
 from trend_analyzer import TrendAnalyzer
-from ai_processor import AIProcessor
+from ai_processor import AIProcessor, AsyncAIProcessor
 
 # For batch processing
 batch_jobs = {}
 
+# Copies of uploads whose OCR stopped early, kept until their skipped pages are
+# read, for at most INVOICE_SOURCE_TTL seconds and INVOICE_SOURCE_MAX_MB in total
+SOURCE_DIR = os.path.join("data", "sources")
+SOURCE_TTL = float(os.environ.get("INVOICE_SOURCE_TTL", 7 * 24 * 3600))
+SOURCE_MAX_BYTES = int(os.environ.get("INVOICE_SOURCE_MAX_MB", 512)) * 1024 * 1024
+
 # Create Flask app
 app = Flask(__name__, 
             static_url_path='', 
@@ -29,11 +37,18 @@ CORS(app)
 # Global instances
 db = DatabaseClient()
 ocr_processor = OCRProcessor()
-gst_classifier = GSTClassifier()
+gst_classifier = GSTClassifier(memory=db)
 report_generator = ReportGenerator()
 trend_analyzer = TrendAnalyzer(db)
 ai_processor = AIProcessor()
 
+# Async AI client for batch jobs; batches fall back to synchronous calls without it
+try:
+    async_ai_processor = AsyncAIProcessor()
+except Exception as e:
+    print(f"Async AI processing not available: {e}")
+    async_ai_processor = None
+
 # Routes
 @app.route('/')
 def index():
@@ -55,6 +70,9 @@ def get_invoice(invoice_id):
         
         if not invoice:
             return jsonify({"error": "Invoice not found"}), 404
+        
+        if invoice.get("skipped_pages"):
+            _complete_invoice_text(invoice)
             
         return jsonify({
             "invoice": invoice,
@@ -63,6 +81,87 @@ def get_invoice(invoice_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _keep_source_file(file_path, ocr_result):
+    """
+    Copy an upload whose OCR stopped early, so that its skipped pages can be
+    read once the full raw text is asked for
+    
+    Returns:
+        str: Path of the copy, or None if every page was read
+    """
+    if not ocr_result["skipped_pages"]:
+        return None
+    
+    _prune_source_files(incoming=os.path.getsize(file_path))
+    
+    os.makedirs(SOURCE_DIR, exist_ok=True)
+    source_path = os.path.join(SOURCE_DIR, uuid.uuid4().hex + os.path.splitext(file_path)[1])
+    shutil.copyfile(file_path, source_path)
+    return source_path
+
+def _prune_source_files(incoming=0):
+    """
+    Delete kept copies older than SOURCE_TTL, then the oldest others until
+    incoming more bytes fit under SOURCE_MAX_BYTES. The invoices of deleted
+    copies keep the text of the pages that were read.
+    """
+    try:
+        entries = list(os.scandir(SOURCE_DIR))
+    except FileNotFoundError:
+        return
+    
+    now = time.time()
+    kept = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if now - stat.st_mtime > SOURCE_TTL:
+            _discard_source_file(entry.path)
+        else:
+            kept.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = incoming + sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if total <= SOURCE_MAX_BYTES:
+            break
+        _discard_source_file(path)
+        total -= size
+
+def _discard_source_file(source_path):
+    """Delete a copy made by _keep_source_file, if there is one"""
+    if source_path:
+        try:
+            os.unlink(source_path)
+        except OSError:
+            pass
+
+def _complete_invoice_text(invoice):
+    """OCR the pages an invoice skipped and store its full raw text, updating invoice in place"""
+    if not invoice["source_path"] or not os.path.exists(invoice["source_path"]):
+        # Pruned by _prune_source_files; only the text read at upload remains
+        return
+    
+    try:
+        # The early-stopped result is normally still cached for the kept copy;
+        # completing that result also updates the cache for re-uploads
+        result = ocr_processor.process_document(invoice["source_path"])
+        ocr_processor.complete_document(invoice["source_path"], result)
+    except Exception as e:
+        # Serve the partial text rather than failing the request
+        print(f"Error completing invoice text: {e}")
+        return
+    
+    # process_document reports an unreadable file as empty text rather than raising
+    if not result["text"] or result["skipped_pages"]:
+        print(f"Could not complete the text of invoice {invoice['id']} from {invoice['source_path']}")
+        return
+    
+    if db.complete_invoice_text(invoice["id"], result["text"]):
+        _discard_source_file(invoice["source_path"])
+        invoice.update(raw_text=result["text"], source_path=None, skipped_pages=None)
+
 @app.route('/api/gst-slabs', methods=['GET'])
 def get_gst_slabs():
     try:
@@ -71,6 +170,41 @@ def get_gst_slabs():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/hsn/version', methods=['GET'])
+def get_hsn_version():
+    registry = gst_classifier.hsn_registry
+    return jsonify({
+        "version": registry.version,
+        "codes": len(registry.catalogue),
+        "loaded_at": registry.loaded_at
+    })
+
+@app.route('/api/hsn/rates', methods=['POST'])
+def update_hsn_rates():
+    try:
+        data = request.json
+        
+        if not data or not isinstance(data.get("rates"), dict):
+            return jsonify({"error": "No rates provided"}), 400
+        
+        # Swaps in the new catalogue for the classifier and the database at once
+        version = gst_classifier.hsn_registry.update_rates(data["rates"])
+        return jsonify({"success": True, "version": version})
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/hsn/reload', methods=['POST'])
+def reload_hsn():
+    try:
+        registry = gst_classifier.hsn_registry
+        reloaded = registry.reload()
+        return jsonify({"reloaded": reloaded, "version": registry.version})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/process-invoice', methods=['POST'])
 def process_invoice():
     if 'file' not in request.files:
@@ -88,13 +222,14 @@ def process_invoice():
             temp_file_path = tmp.name
         
         # Extract text using OCR
-        extracted_text = ocr_processor.process_file(temp_file_path)
+        ocr_result = ocr_processor.process_document(temp_file_path)
+        extracted_text = ocr_result["text"]
         
         if not extracted_text:
             return jsonify({"error": "No text could be extracted from the invoice"}), 400
         
         # Extract structured data
-        items_data = ocr_processor.extract_items(extracted_text)
+        items_data = ocr_processor.extract_items(extracted_text, words=ocr_result["words"])
         
         if not items_data:
             return jsonify({"error": "Could not identify item details in the invoice"}), 400
@@ -102,18 +237,20 @@ def process_invoice():
         # Classify items into GST slabs
         classified_items = gst_classifier.classify_items(items_data)
         
-        # Save to database
-        invoice_id = db.insert_invoice(
+        # Save the invoice and its classified items to the database together
+        source_path = _keep_source_file(temp_file_path, ocr_result)
+        invoice_id, _ = db.save_invoice_with_items(
             file_name=file.filename,
             file_type=file.content_type,
-            raw_text=extracted_text
+            raw_text=extracted_text,
+            items=classified_items,
+            source_path=source_path,
+            skipped_pages=ocr_result["skipped_pages"]
         )
         
         if not invoice_id:
+            _discard_source_file(source_path)
             return jsonify({"error": "Failed to save invoice to database"}), 500
-            
-        # Save classified items
-        db.insert_items(invoice_id, classified_items)
         
         # Calculate GST breakdown
         gst_breakdown = {}
@@ -138,7 +275,12 @@ def process_invoice():
             "success": True,
             "invoice_id": invoice_id,
             "items": classified_items,
-            "gst_breakdown": gst_breakdown
+            "gst_breakdown": gst_breakdown,
+            "ocr": {
+                "pages": ocr_result["pages"],
+                "seconds": ocr_result["seconds"],
+                "skipped_pages": ocr_result["skipped_pages"]
+            }
         })
         
     except Exception as e:
@@ -156,10 +298,19 @@ def update_item():
         if not item_data or "id" not in item_data:
             return jsonify({"error": "Invalid item data"}), 400
             
+        item_id = item_data["id"]
+        corrected = "hsn_code" in item_data or "gst_rate" in item_data
+        
         success = db.update_item(item_data)
         
         if not success:
             return jsonify({"error": "Failed to update item"}), 500
+        
+        # Remember the correction so the item is classified this way from now on
+        if corrected:
+            item = db.get_item(item_id)
+            if item:
+                gst_classifier.learn_correction(item["item"], item["hsn_code"], item["gst_rate"])
             
         return jsonify({"success": True})
         
@@ -325,6 +476,7 @@ def batch_process_invoices():
         'id': batch_id,
         'status': 'processing',
         'total_files': len(files),
+        'ocr_done': 0,
         'processed_files': 0,
         'successful_files': 0,
         'failed_files': 0,
@@ -354,97 +506,107 @@ def _process_batch(batch_id, temp_files):
     batch_info = batch_jobs[batch_id]
     
     try:
+        # Files are OCR'd here one after another. Their item extraction requests
+        # run on the async processor's event loop, up to its concurrency limit,
+        # while the next files are OCR'd.
+        extractions = []
         for file_info in temp_files:
             try:
                 # Extract text using OCR
-                extracted_text = ocr_processor.process_file(file_info['path'])
+                ocr_result = ocr_processor.process_document(file_info['path'])
+                file_info['skipped_pages'] = ocr_result["skipped_pages"]
+                file_info['source_path'] = _keep_source_file(file_info['path'], ocr_result)
                 
+                future = None
+                if async_ai_processor is not None and ocr_result["text"]:
+                    future = async_ai_processor.submit(ocr_processor.extract_invoice_async(
+                        ocr_result["text"], async_ai_processor, words=ocr_result["words"]
+                    ))
+                extractions.append((file_info, ocr_result, future))
+            except Exception as e:
+                extractions.append((file_info, e, None))
+            finally:
+                # Cleanup temp file
+                try:
+                    os.unlink(file_info['path'])
+                except:
+                    pass
+                
+                # Files only count as processed once saved, so report OCR progress separately
+                batch_info['ocr_done'] += 1
+                
+        # Collect the extracted items; files that failed are recorded straight away
+        extracted = []
+        for file_info, ocr_result, future in extractions:
+            try:
+                if isinstance(ocr_result, Exception):
+                    raise ocr_result
+                
+                extracted_text = ocr_result["text"]
                 if not extracted_text:
-                    batch_info['failed_files'] += 1
-                    batch_info['results'].append({
-                        'file_name': file_info['name'],
-                        'success': False,
-                        'error': "No text could be extracted from the invoice"
-                    })
+                    _record_batch_result(batch_info, file_info, error="No text could be extracted from the invoice")
                     continue
                 
                 # Extract structured data
-                items_data = ocr_processor.extract_items(extracted_text)
+                if future is not None:
+                    items_data = future.result()["items"]
+                else:
+                    items_data = ocr_processor.extract_items(extracted_text, words=ocr_result["words"])
+                
+                # Items from the AI are not validated; one without a description
+                # would make classification fail for the whole batch
+                items_data = [item for item in items_data or [] if isinstance(item, dict) and item.get("item")]
                 
                 if not items_data:
-                    batch_info['failed_files'] += 1
-                    batch_info['results'].append({
-                        'file_name': file_info['name'],
-                        'success': False,
-                        'error': "Could not identify item details in the invoice"
-                    })
+                    _record_batch_result(batch_info, file_info, error="Could not identify item details in the invoice")
                     continue
                 
-                # Classify items into GST slabs
-                classified_items = gst_classifier.classify_items(items_data)
+                extracted.append((file_info, extracted_text, items_data))
+            except Exception as e:
+                _record_batch_result(batch_info, file_info, error=str(e))
+        
+        # Classify the items of all invoices together, so that each distinct
+        # description is classified only once
+        try:
+            classified_invoices, classification_stats = gst_classifier.classify_batch(
+                [items_data for _, _, items_data in extracted],
+                async_ai_processor=async_ai_processor
+            )
+            batch_info['classification'] = classification_stats
+        except Exception as e:
+            # Fall back to classifying each invoice on its own, so that one bad
+            # invoice only fails its own file
+            print(f"Batch classification failed, classifying per invoice: {e}")
+            classified_invoices = []
+            for _, _, items_data in extracted:
+                try:
+                    classified_invoices.append(gst_classifier.classify_items(items_data))
+                except Exception as invoice_error:
+                    classified_invoices.append(invoice_error)
+        
+        for (file_info, extracted_text, _), classified_items in zip(extracted, classified_invoices):
+            try:
+                if isinstance(classified_items, Exception):
+                    raise classified_items
                 
-                # Save to database
-                invoice_id = db.insert_invoice(
+                # Save the invoice and its classified items to the database together
+                invoice_id, _ = db.save_invoice_with_items(
                     file_name=file_info['name'],
                     file_type=file_info['content_type'],
-                    raw_text=extracted_text
+                    raw_text=extracted_text,
+                    items=classified_items,
+                    source_path=file_info.get('source_path'),
+                    skipped_pages=file_info.get('skipped_pages')
                 )
                 
                 if not invoice_id:
-                    batch_info['failed_files'] += 1
-                    batch_info['results'].append({
-                        'file_name': file_info['name'],
-                        'success': False,
-                        'error': "Failed to save invoice to database"
-                    })
+                    _record_batch_result(batch_info, file_info, error="Failed to save invoice to database")
                     continue
                 
-                # Save classified items
-                db.insert_items(invoice_id, classified_items)
-                
-                # Calculate GST breakdown
-                gst_breakdown = {}
-                for item in classified_items:
-                    gst_rate = item.get("gst_rate", 0)
-                    if gst_rate not in gst_breakdown:
-                        gst_breakdown[gst_rate] = {
-                            "taxable_amount": 0,
-                            "tax_amount": 0
-                        }
-                    
-                    taxable_amount = item.get("total", 0)
-                    tax_amount = taxable_amount * (gst_rate / 100)
-                    
-                    gst_breakdown[gst_rate]["taxable_amount"] += taxable_amount
-                    gst_breakdown[gst_rate]["tax_amount"] += tax_amount
-                
                 # Record success
-                batch_info['successful_files'] += 1
-                batch_info['results'].append({
-                    'file_name': file_info['name'],
-                    'success': True,
-                    'invoice_id': invoice_id,
-                    'items_count': len(classified_items)
-                })
-                
+                _record_batch_result(batch_info, file_info, invoice_id=invoice_id, items_count=len(classified_items))
             except Exception as e:
-                # Record failure
-                batch_info['failed_files'] += 1
-                batch_info['results'].append({
-                    'file_name': file_info['name'],
-                    'success': False,
-                    'error': str(e)
-                })
-            
-            finally:
-                # Cleanup temp file
-                try:
-                    os.unlink(file_info['path'])
-                except:
-                    pass
-                
-                # Update progress
-                batch_info['processed_files'] += 1
+                _record_batch_result(batch_info, file_info, error=str(e))
         
         # Mark batch as completed
         batch_info['status'] = 'completed'
@@ -456,14 +618,41 @@ def _process_batch(batch_id, temp_files):
         batch_info['error'] = str(e)
         batch_info['completed_at'] = str(datetime.datetime.now())
         
-        # Clean up any remaining temp files
+        # Clean up any remaining temp files and copies of unsaved files
         for file_info in temp_files:
+            _discard_source_file(file_info.get('source_path'))
             try:
                 if os.path.exists(file_info['path']):
                     os.unlink(file_info['path'])
             except:
                 pass
 
+def _record_batch_result(batch_info, file_info, error=None, invoice_id=None, items_count=0):
+    """Record the outcome of one batch file and update the progress counters"""
+    if error is None:
+        batch_info['successful_files'] += 1
+        batch_info['results'].append({
+            'file_name': file_info['name'],
+            'success': True,
+            'invoice_id': invoice_id,
+            'items_count': items_count
+        })
+        # The database now refers to the kept copy, if any
+        file_info['source_path'] = None
+    else:
+        # A failed file is never saved, so its kept copy is not needed
+        _discard_source_file(file_info.get('source_path'))
+        file_info['source_path'] = None
+        batch_info['failed_files'] += 1
+        batch_info['results'].append({
+            'file_name': file_info['name'],
+            'success': False,
+            'error': error
+        })
+    
+    # Update progress
+    batch_info['processed_files'] += 1
+
 @app.route('/api/batch/status/<batch_id>', methods=['GET'])
 def get_batch_status(batch_id):
     if batch_id not in batch_jobs:
@@ -480,6 +669,7 @@ def list_batch_jobs():
             'id': job_id,
             'status': job_info['status'],
             'total_files': job_info['total_files'],
+            'ocr_done': job_info['ocr_done'],
             'processed_files': job_info['processed_files'],
             'successful_files': job_info['successful_files'],
             'failed_files': job_info['failed_files'],
@@ -632,6 +822,29 @@ def get_top_hsn_codes():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ocr/cache-stats', methods=['GET'])
+def get_ocr_cache_stats():
+    if ocr_processor.cache is None:
+        return jsonify({"enabled": False})
+    
+    stats = ocr_processor.cache.stats()
+    stats["enabled"] = True
+    return jsonify(stats)
+
+@app.route('/api/ai/cache-stats', methods=['GET'])
+def get_ai_cache_stats():
+    if ai_processor.cache is None:
+        return jsonify({"enabled": False})
+    
+    stats = ai_processor.cache.stats()
+    stats["enabled"] = True
+    stats["bypass"] = ai_processor.bypass_cache
+    return jsonify(stats)
+
+@app.route('/api/gst/classification-stats', methods=['GET'])
+def get_classification_stats():
+    return jsonify(gst_classifier.classification_stats())
+
 # Chatbot endpoint
 @app.route('/api/chatbot', methods=['POST'])
 def chatbot():
@@ -0,0 +1,677 @@
+"""
+Benchmarks for the invoice processing pipeline.
+
+Run with:
+    python benchmarks.py <benchmark> [options]
+
+Use python benchmarks.py --help to list the available benchmarks.
+"""
+import argparse
+import random
+import re
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+def _time_call(func, *args, repeat=3, **kwargs):
+    """
+    Time a function call, keeping the best of several runs
+    
+    Args:
+        func (callable): Function to time
+        repeat (int, optional): Number of runs
+    
+    Returns:
+        tuple: (best time in seconds, result of the last call)
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def _synthetic_invoice_image(width=4000, height=5600, skew=2.0, seed=0):
+    """
+    Render a noisy, skewed invoice-like page similar to a phone photo
+    
+    Args:
+        width (int, optional): Image width in pixels
+        height (int, optional): Image height in pixels
+        skew (float, optional): Rotation in degrees
+        seed (int, optional): Random seed for the noise
+    
+    Returns:
+        PIL.Image: Grayscale test image
+    """
+    image = Image.new("L", (width, height), 235)
+    draw = ImageDraw.Draw(image)
+    font_size = width // 70
+    
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        font = None
+    
+    draw.text((width // 12, height // 20), "TAX INVOICE  No. INV-2024-0042", fill=20, font=font)
+    for row in range(40):
+        y = height // 8 + row * int(font_size * 1.8)
+        draw.text(
+            (width // 12, y),
+            f"Item {row + 1:02d} Assorted goods pack   {row % 5 + 1}   {120 + row * 7}.00   {(row % 5 + 1) * (120 + row * 7)}.00",
+            fill=20,
+            font=font
+        )
+    
+    image = image.rotate(skew, expand=True, fillcolor=60, resample=Image.BICUBIC)
+    rng = np.random.default_rng(seed)
+    pixels = np.asarray(image).astype(np.int16) + rng.normal(0, 18, (image.height, image.width)).astype(np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def benchmark_preprocessing(paths, repeat):
+    """Compare Tesseract time on raw images against preprocessed ones."""
+    import pytesseract
+    from image_preprocessor import ImagePreprocessor
+    
+    images = [(path, Image.open(path)) for path in paths] or [("synthetic", _synthetic_invoice_image())]
+    preprocessor = ImagePreprocessor()
+    
+    for name, image in images:
+        image = image.convert("L")
+        prep_time, processed = _time_call(preprocessor.process, image, repeat=repeat)
+        raw_time, _ = _time_call(pytesseract.image_to_string, image, repeat=repeat)
+        ocr_time, _ = _time_call(pytesseract.image_to_string, processed, repeat=repeat)
+        
+        print(f"{name}: {image.size[0]}x{image.size[1]} -> {processed.size[0]}x{processed.size[1]}")
+        print(f"  tesseract on raw image:          {raw_time:8.3f}s")
+        print(f"  preprocessing:                   {prep_time:8.3f}s")
+        print(f"  tesseract on preprocessed image: {ocr_time:8.3f}s")
+        print(f"  speedup (including preprocessing): {raw_time / (prep_time + ocr_time):.2f}x")
+
+def benchmark_deskew(paths, repeat, angles=(-4.0, -2.0, 0.0, 2.0, 3.0)):
+    """Check that known rotations of the synthetic page, dark surround included, are recovered."""
+    from image_preprocessor import ImagePreprocessor
+    
+    preprocessor = ImagePreprocessor()
+    failures = []
+    for skew in angles:
+        pixels = np.asarray(_synthetic_invoice_image(skew=skew))
+        elapsed, angle = _time_call(preprocessor._estimate_skew, pixels, repeat=repeat)
+        # The correction rotates the page back, so it has the opposite sign
+        ok = abs(angle + skew) <= preprocessor.skew_step
+        if not ok:
+            failures.append(skew)
+        print(f"  skew {skew:5.1f}: estimated correction {angle:5.2f}  {'ok' if ok else 'WRONG'}  ({elapsed * 1000:.0f} ms)")
+    
+    if failures:
+        raise SystemExit(f"Skew not recovered for: {', '.join(map(str, failures))}")
+
+def benchmark_ocr_engines(paths, repeat, pages=20):
+    """Compare per-page overhead of the available OCR engines on small receipts."""
+    from ocr_engine import ENGINES, create_engine
+    
+    if paths:
+        images = [Image.open(path).convert("L") for path in paths]
+    else:
+        # Small receipt-sized pages, where fixed per-call cost dominates
+        images = [_synthetic_invoice_image(width=600, height=840, skew=0, seed=seed) for seed in range(pages)]
+    
+    for name in ENGINES:
+        engine = create_engine(name)
+        if engine.name != name:
+            print(f"{name}: not available")
+            continue
+        
+        engine.image_to_string(images[0])  # Warm up (model load for persistent engines)
+        elapsed, _ = _time_call(lambda: [engine.image_to_string(image) for image in images], repeat=repeat)
+        print(f"{name}: {elapsed / len(images) * 1000:8.1f} ms/page over {len(images)} pages")
+
+def benchmark_roi(paths, repeat):
+    """Compare full-page OCR with region-of-interest OCR of the line-item table."""
+    from image_preprocessor import ImagePreprocessor
+    from ocr_engine import create_engine
+    from ocr_processor import _ocr_regions
+    
+    images = [(path, Image.open(path)) for path in paths] or [("synthetic", _synthetic_invoice_image())]
+    preprocessor = ImagePreprocessor()
+    engine = create_engine()
+    
+    for name, image in images:
+        image = preprocessor.process(image.convert("L"))
+        full_time, _ = _time_call(engine.image_to_string, image, repeat=repeat)
+        print(f"{name}: {image.size[0]}x{image.size[1]}")
+        print(f"  full page:                {full_time:8.3f}s")
+        
+        for regions in ("cheap", "skip"):
+            roi_time, result = _time_call(_ocr_regions, image, engine, False, regions, repeat=repeat)
+            if result is None:
+                print("  no table region detected")
+                break
+            print(f"  table {result['regions']['table']}, header/footer {regions}: "
+                  f"{roi_time:8.3f}s  (saved {full_time - roi_time:.3f}s measured, "
+                  f"{result['regions']['seconds_saved']:.3f}s estimated)")
+
+def _legacy_extract_items(text):
+    """
+    Reference copy of the regex-cascade item parser that the single-pass
+    parser in OCRProcessor replaced, kept for comparison. Whitespace is
+    collapsed per line so both parsers see the same lines.
+    """
+    text = text.replace('|', '1').replace('l', '1').replace('O', '0').replace('o', '0')
+    text = '\n'.join(re.sub(r'\s+', ' ', line) for line in text.split('\n'))
+    text = text.replace('₹', '').replace('$', '').replace('€', '')
+    text = re.sub(r'[^\w\s\.\-\,]', '', text)
+    
+    patterns = [
+        r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)\s+(?:x\s+)?(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)',
+        r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)\s+(?:pcs|units|nos)?\s+(\d+(?:\.\d+)?)',
+        r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)'
+    ]
+    
+    def parse_line(line):
+        for pattern in patterns:
+            match = re.search(pattern, line)
+            if match:
+                groups = match.groups()
+                if len(groups) == 4:
+                    qty, unit_price, total = float(groups[1]), float(groups[2]), float(groups[3])
+                    if abs(qty * unit_price - total) > 1:
+                        continue
+                    return {"item": groups[0].strip(), "qty": qty, "unit_price": unit_price, "total": total}
+                if len(groups) == 3:
+                    qty, total = float(groups[1]), float(groups[2])
+                    return {"item": groups[0].strip(), "qty": qty, "unit_price": total / qty if qty else 0, "total": total}
+                total = float(groups[1])
+                return {"item": groups[0].strip(), "qty": 1, "unit_price": total, "total": total}
+        return None
+    
+    items = []
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        if len(line.strip()) < 5:
+            continue
+        item = parse_line(line)
+        if item:
+            items.append(item)
+            continue
+        if i < len(lines) - 1:
+            item = parse_line(line + " " + lines[i + 1])
+            if item:
+                items.append(item)
+    return items
+
+def _synthetic_ocr_text(lines=10000, seed=0):
+    """
+    Generate invoice-like OCR text mixing item lines, wrapped descriptions and noise
+    
+    Args:
+        lines (int, optional): Number of lines
+        seed (int, optional): Random seed
+        
+    Returns:
+        str: Synthetic OCR text
+    """
+    rng = random.Random(seed)
+    products = ["Parle-G Biscuits", "Surf Excel 1kg", "Colgate Paste", "Samsung Charger",
+                "Notebook A4 ruled", "Basmati Rice 5kg", "Dettol Soap", "LED Bulb 9W"]
+    out = []
+    for i in range(lines):
+        kind = rng.random()
+        qty = rng.randint(1, 20)
+        price = rng.randint(5, 2000) + rng.choice([0, 0.5, 0.25])
+        if kind < 0.6:
+            out.append(f"{i + 1}  {rng.choice(products)}   {qty}   {price:.2f}   {qty * price:,.2f}")
+        elif kind < 0.75:
+            out.append(f"{rng.choice(products)} assorted pack of {rng.randint(2, 12)}")
+            out.append(f"{qty} {price:.2f} {qty * price:.2f}")
+        elif kind < 0.85:
+            out.append(f"{rng.choice(products)} {qty} pcs {qty * price:.2f}")
+        else:
+            out.append(rng.choice(["Terms & Conditions apply", "Thank you for your business!",
+                                   "GSTIN: 27ABCDE1234F1Z5", "| ---- | ---- |"]))
+    return "\n".join(out)
+
+def benchmark_item_parser(paths, repeat, lines=10000):
+    """Compare the single-pass item line parser with the legacy regex cascade."""
+    from ocr_processor import OCRProcessor
+    
+    if paths:
+        texts = [open(path, encoding="utf-8").read() for path in paths]
+    else:
+        texts = [_synthetic_ocr_text(lines)]
+    
+    # Only the parsing methods are exercised, so skip engine/AI/cache set-up
+    processor = OCRProcessor.__new__(OCRProcessor)
+    
+    def parse(text):
+        return processor._parse_item_lines(processor._clean_text(text).split("\n"))
+    
+    for text in texts:
+        line_count = text.count("\n") + 1
+        legacy_time, legacy_items = _time_call(_legacy_extract_items, text, repeat=repeat)
+        new_time, new_items = _time_call(parse, text, repeat=repeat)
+        
+        print(f"{line_count} lines")
+        print(f"  legacy regex cascade: {legacy_time * 1000:8.1f} ms  ({len(legacy_items)} items)")
+        print(f"  single-pass parser:   {new_time * 1000:8.1f} ms  ({len(new_items)} items)")
+        print(f"  speedup: {legacy_time / new_time:.2f}x")
+
+def _legacy_match_with_hsn(hsn_data, item_name):
+    """
+    Reference copy of the row-by-row HSN matcher that the inverted index in
+    GSTClassifier replaced, kept for comparison.
+    """
+    from fuzzywuzzy import fuzz
+    
+    best_match = None
+    best_score = 0
+    for _, row in hsn_data.iterrows():
+        description = row["description"].lower()
+        for word in description.split():
+            if word in item_name and len(word) > 3:
+                score = fuzz.token_sort_ratio(description, item_name)
+                if score > best_score:
+                    best_score = score
+                    best_match = row
+    
+    if best_score > 60:
+        return best_match["hsn_code"], best_match["gst_rate"], best_score
+    return None, None, 0
+
+def _synthetic_hsn_master(rows=12000, seed=0):
+    """
+    Generate an HSN master table shaped like the full tariff schedule
+    
+    Args:
+        rows (int, optional): Number of HSN rows
+        seed (int, optional): Random seed
+        
+    Returns:
+        pandas.DataFrame: hsn_code, description and gst_rate columns
+    """
+    import pandas as pd
+    
+    rng = random.Random(seed)
+    vocabulary = ["bread", "pastry", "cakes", "biscuits", "food", "preparations", "medicaments", "beauty",
+                  "make-up", "soap", "organic", "surface-active", "products", "washing", "cleaning", "plastic",
+                  "articles", "packaging", "cartons", "boxes", "cases", "bags", "paper", "machines", "vacuum",
+                  "cleaners", "electric", "heating", "equipment", "telephones", "monitors", "projectors",
+                  "receivers", "cotton", "yarn", "woven", "fabrics", "knitted", "apparel", "footwear", "parts",
+                  "accessories", "steel", "iron", "copper", "aluminium", "tools", "instruments", "furniture",
+                  "lamps", "toys", "games", "sports", "fresh", "frozen", "dried", "fruits", "vegetables", "meat",
+                  "fish", "dairy", "cereals", "flour", "sugar", "cocoa", "beverages", "spirits", "tobacco"]
+    vocabulary += [f"{word}{suffix}" for word in vocabulary for suffix in ("ed", "ing", "ware")]
+    
+    # Sorted by code, like the published schedule
+    return pd.DataFrame({
+        "hsn_code": sorted(f"{rng.randint(100000, 999999)}" for _ in range(rows)),
+        "description": [", ".join(rng.sample(vocabulary, rng.randint(2, 6))).capitalize() for _ in range(rows)],
+        "gst_rate": [rng.choice([0, 5, 12, 18, 28]) for _ in range(rows)]
+    })
+
+def _catalogue_from_frame(hsn_data):
+    """Build an HSNCatalogue from an HSN master DataFrame."""
+    from hsn_catalogue import HSNCatalogue
+    
+    return HSNCatalogue.from_records(hsn_data["hsn_code"], hsn_data["description"], hsn_data["gst_rate"])
+
+def benchmark_hsn_match(paths, repeat, items=200):
+    """Compare the inverted-index HSN matcher with the row-by-row scan."""
+    import pandas as pd
+    from gst_classifier import GSTClassifier
+    from hsn_catalogue import HSNRegistry
+    
+    hsn_data = pd.read_csv(paths[0], dtype={"hsn_code": str}) if paths else _synthetic_hsn_master()
+    
+    # Only the HSN matcher is exercised, so skip AI set-up
+    classifier = GSTClassifier.__new__(GSTClassifier)
+    classifier.hsn_registry = HSNRegistry(catalogue=_catalogue_from_frame(hsn_data))
+    classifier._hsn_state = None
+    build_time, _ = _time_call(classifier.hsn_catalogue._build_word_index, repeat=1)
+    
+    rng = random.Random(1)
+    descriptions = hsn_data["description"].str.lower().tolist()
+    names = [" ".join(rng.choice(descriptions).replace(",", "").split()[:3]) + f" {rng.randint(1, 500)}g"
+             for _ in range(items)]
+    
+    legacy_time, legacy = _time_call(lambda: [_legacy_match_with_hsn(hsn_data, name) for name in names], repeat=repeat)
+    index_time, indexed = _time_call(lambda: [classifier._match_with_hsn(name) for name in names], repeat=repeat)
+    mismatches = sum(
+        (str(a[0]), a[1], a[2]) != (str(b[0]), b[1], b[2]) for a, b in zip(legacy, indexed)
+    )
+    
+    print(f"{len(hsn_data)} HSN rows, {len(classifier.hsn_catalogue._word_index)} indexed words, {len(names)} items")
+    print(f"  index build:     {build_time * 1000:8.1f} ms")
+    print(f"  row-by-row scan: {legacy_time / len(names) * 1000:8.2f} ms/item")
+    print(f"  inverted index:  {index_time / len(names) * 1000:8.2f} ms/item")
+    print(f"  speedup: {legacy_time / index_time:.2f}x  ({mismatches} results differ)")
+
+def benchmark_hsn_batch(paths, repeat, items=2000):
+    """Compare items/second of the TF-IDF batch matcher with the per-item HSN matcher."""
+    import pandas as pd
+    import hsn_matcher
+    from gst_classifier import GSTClassifier
+    from hsn_catalogue import HSNRegistry
+    
+    hsn_data = pd.read_csv(paths[0], dtype={"hsn_code": str}) if paths else _synthetic_hsn_master()
+    
+    # Only the HSN matchers are exercised, so skip AI set-up
+    classifier = GSTClassifier.__new__(GSTClassifier)
+    classifier.hsn_registry = HSNRegistry(catalogue=_catalogue_from_frame(hsn_data))
+    classifier._hsn_state = None
+    
+    rng = random.Random(1)
+    descriptions = hsn_data["description"].str.lower().tolist()
+    names = [" ".join(rng.choice(descriptions).replace(",", "").split()[:3]) + f" {rng.randint(1, 500)}g"
+             for _ in range(items)]
+    
+    build_time, _ = _time_call(classifier.match_hsn_batch, names[:1], repeat=1)
+    
+    # The per-item matcher is slow enough that a sample is extrapolated
+    sample = names[:max(1, items // 10)]
+    fuzzy_time, _ = _time_call(lambda: [classifier._match_with_hsn(name) for name in sample], repeat=repeat)
+    batch_time, _ = _time_call(classifier.match_hsn_batch, names, repeat=repeat)
+    
+    print(f"{len(hsn_data)} HSN rows, {len(names)} items "
+          f"({'SciPy sparse' if hsn_matcher.scipy_available else 'NumPy posting lists'})")
+    print(f"  TF-IDF matrix build:      {build_time * 1000:8.1f} ms")
+    print(f"  _match_with_hsn:          {len(sample) / fuzzy_time:10.0f} items/s")
+    print(f"  match_hsn_batch (top 5):  {len(names) / batch_time:10.0f} items/s")
+    print(f"  speedup: {(len(names) / batch_time) / (len(sample) / fuzzy_time):.1f}x")
+
+def benchmark_hsn_catalogue(paths, repeat, lookups=100000):
+    """Compare loading the HSN master from CSV with pandas against the catalogue snapshot."""
+    import os
+    import tempfile
+    import pandas as pd
+    from hsn_catalogue import HSNCatalogue
+    
+    with tempfile.TemporaryDirectory() as directory:
+        if paths:
+            csv_path = paths[0]
+        else:
+            csv_path = os.path.join(directory, "hsn_codes.csv")
+            _synthetic_hsn_master().to_csv(csv_path, index=False)
+        snapshot_path = os.path.join(directory, "hsn_catalogue.npz")
+        
+        pandas_time, hsn_data = _time_call(pd.read_csv, csv_path, dtype={"hsn_code": str}, repeat=repeat)
+        csv_time, catalogue = _time_call(HSNCatalogue.from_csv, csv_path, repeat=repeat)
+        catalogue.save(snapshot_path)
+        snapshot_time, catalogue = _time_call(HSNCatalogue.load, snapshot_path, repeat=repeat)
+        snapshot_size = os.path.getsize(snapshot_path)
+    
+    rng = random.Random(2)
+    codes = [code + "".join(rng.choice("0123456789") for _ in range(8 - len(code)))
+             for code in rng.choices(hsn_data["hsn_code"].tolist(), k=lookups)]
+    lookup_time, _ = _time_call(lambda: [catalogue.rate(code) for code in codes], repeat=repeat)
+    frame_time, _ = _time_call(
+        lambda: [hsn_data.loc[hsn_data["hsn_code"] == code[:6], "gst_rate"] for code in codes[:lookups // 100]],
+        repeat=repeat
+    )
+    
+    print(f"{len(catalogue)} HSN codes, {len(catalogue.descriptions)} distinct descriptions, "
+          f"snapshot {snapshot_size / 1024:.0f} KiB")
+    print(f"  pandas read_csv:          {pandas_time * 1000:8.1f} ms")
+    print(f"  catalogue from CSV:       {csv_time * 1000:8.1f} ms")
+    print(f"  catalogue from snapshot:  {snapshot_time * 1000:8.1f} ms")
+    print(f"  prefix rate lookup:       {lookup_time / lookups * 1e6:8.2f} us/code")
+    print(f"  DataFrame filter lookup:  {frame_time / (lookups // 100) * 1e6:8.2f} us/code")
+
+def benchmark_keyword_match(paths, repeat, skus=30000, items=2000):
+    """Compare the keyword automaton with linear substring scans of a large SKU dictionary."""
+    import string
+    from keyword_matcher import KeywordAutomaton
+    
+    rng = random.Random(0)
+    if paths:
+        names = [line.strip().lower() for line in open(paths[0], encoding="utf-8") if line.strip()]
+    else:
+        names = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12))) for _ in range(skus)]
+    dictionary = dict.fromkeys(names)
+    item_names = [" ".join(rng.choice(names + ["pack", "assorted", "500g"]) for _ in range(4)) for _ in range(items)]
+    
+    build_time, automaton = _time_call(lambda: KeywordAutomaton((name, name) for name in dictionary), repeat=1)
+    automaton.build()
+    
+    # The linear scan is slow enough that a sample is extrapolated
+    sample = item_names[:max(1, items // 20)]
+    linear_time, _ = _time_call(lambda: [[name for name in dictionary if name in item] for item in sample], repeat=repeat)
+    automaton_time, _ = _time_call(lambda: [automaton.find(item) for item in item_names], repeat=repeat)
+    
+    linear_per_item = linear_time / len(sample)
+    automaton_per_item = automaton_time / len(item_names)
+    print(f"{len(dictionary)} keywords, {len(item_names)} item names")
+    print(f"  automaton build: {build_time * 1000:8.1f} ms")
+    print(f"  linear scan:     {linear_per_item * 1000:8.3f} ms/item")
+    print(f"  automaton:       {automaton_per_item * 1000:8.3f} ms/item")
+    print(f"  speedup: {linear_per_item / automaton_per_item:.1f}x")
+
+def _benchmark_database(directory):
+    """
+    Create a DatabaseClient on a fresh database file, with the default HSN
+    codes and without touching data/
+    """
+    import os
+    from database import DatabaseClient
+    from hsn_catalogue import DEFAULT_HSN_CODES, HSNCatalogue, HSNRegistry
+    
+    catalogue = HSNCatalogue.from_records(*zip(*DEFAULT_HSN_CODES))
+    return DatabaseClient(hsn_registry=HSNRegistry(catalogue=catalogue),
+                          db_path=os.path.join(directory, "taxlyzer.db"))
+
+def _synthetic_items(count, seed=0):
+    """Generate classified invoice items."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        qty = rng.randint(1, 20)
+        price = rng.randint(5, 2000)
+        items.append({"item": f"Item {i} assorted goods", "qty": qty, "unit_price": price,
+                      "total": qty * price, "hsn_code": rng.choice(["1905", "3401", "8517"]),
+                      "gst_rate": rng.choice([5, 12, 18, 28])})
+    return items
+
+def benchmark_persistence(paths, repeat, invoices=20, items=500):
+    """Compare saving invoices with per-row inserts against one executemany transaction."""
+    import tempfile
+    
+    invoice_items = _synthetic_items(items)
+    rows = invoices * (items + 1)
+    
+    def per_row(db):
+        for n in range(invoices):
+            invoice_id = db.insert_invoice(f"invoice-{n}.pdf", "application/pdf", "text")
+            db.insert_items(invoice_id, invoice_items)
+    
+    def single_transaction(db):
+        for n in range(invoices):
+            db.save_invoice_with_items(f"invoice-{n}.pdf", "application/pdf", "text", invoice_items)
+    
+    # Commit cost depends on the file system, so the databases can be put on
+    # the same disk as data/ by passing a directory
+    print(f"{invoices} invoices x {items} items")
+    for name, save in (("insert_invoice + insert_items", per_row),
+                       ("save_invoice_with_items", single_transaction)):
+        with tempfile.TemporaryDirectory(dir=paths[0] if paths else None) as directory:
+            db = _benchmark_database(directory)
+            elapsed, _ = _time_call(save, db, repeat=repeat)
+            db.close()
+        print(f"  {name:30s} {rows / elapsed:10.0f} rows/s  ({elapsed * 1000:.1f} ms)")
+
+def benchmark_query_plans(paths, repeat, invoices=200, items=100):
+    """Check that the hot queries use their indexes and time item lookups with and without them."""
+    import tempfile
+    
+    invoice_items = _synthetic_items(items)
+    with tempfile.TemporaryDirectory(dir=paths[0] if paths else None) as directory:
+        db = _benchmark_database(directory)
+        invoice_ids = [
+            db.save_invoice_with_items(f"invoice-{n}.pdf", "application/pdf", "text", invoice_items)[0]
+            for n in range(invoices)
+        ]
+        
+        plans = db.explain_query_plans()
+        for name, result in plans.items():
+            status = "ok" if result["uses_index"] else "MISSING"
+            print(f"  {name:20s} {status:8s} {'; '.join(result['plan'])}")
+        
+        def lookup_items():
+            for invoice_id in invoice_ids:
+                db.get_items_by_invoice(invoice_id)
+        
+        indexed, _ = _time_call(lookup_items, repeat=repeat)
+        db.conn.execute("DROP INDEX idx_items_invoice_id")
+        full_scan, _ = _time_call(lookup_items, repeat=repeat)
+        db.close()
+    
+    print(f"get_items_by_invoice x {invoices} over {invoices * items} items")
+    print(f"  {'indexed':30s} {indexed * 1000:10.1f} ms")
+    print(f"  {'full scan':30s} {full_scan * 1000:10.1f} ms")
+    
+    missing = [name for name, result in plans.items() if not result["uses_index"]]
+    if missing:
+        raise SystemExit(f"Queries not using their index: {', '.join(missing)}")
+
+def benchmark_concurrency(paths, repeat, readers=8, writes=200, items=50):
+    """
+    Stress one database with parallel readers alongside a writer, checking that
+    no call fails and that readers never see an invoice without all its items
+    """
+    import tempfile
+    import threading
+    
+    invoice_items = _synthetic_items(items)
+    with tempfile.TemporaryDirectory(dir=paths[0] if paths else None) as directory:
+        db = _benchmark_database(directory)
+        db.save_invoice_with_items("seed.pdf", "application/pdf", "text", invoice_items)
+        
+        done = threading.Event()
+        failures = []
+        reads = [0] * readers
+        
+        def write():
+            try:
+                for n in range(writes):
+                    invoice_id, _ = db.save_invoice_with_items(f"invoice-{n}.pdf", "application/pdf", "text", invoice_items)
+                    if invoice_id is None:
+                        failures.append(f"write {n} failed")
+            finally:
+                done.set()
+        
+        def read(reader):
+            while not done.is_set():
+                invoices = db.get_invoices()
+                if not invoices:
+                    failures.append(f"reader {reader} saw no invoices")
+                    continue
+                # The newest invoice may have just been committed
+                found = len(db.get_items_by_invoice(invoices[0]["id"]))
+                if found != items:
+                    failures.append(f"reader {reader} saw {found} of {items} items")
+                reads[reader] += 1
+        
+        threads = [threading.Thread(target=read, args=(n,)) for n in range(readers)]
+        threads.append(threading.Thread(target=write))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        db.close()
+    
+    print(f"{readers} readers + 1 writer, {writes} invoices x {items} items")
+    print(f"  {'writes':30s} {writes / elapsed:10.0f} invoices/s")
+    print(f"  {'reads':30s} {sum(reads) / elapsed:10.0f} reads/s")
+    print(f"  {'failures':30s} {len(failures):10d}")
+    if failures:
+        raise SystemExit("\n".join(failures[:10]))
+
+def benchmark_ocr_completion(paths, repeat, pages=4, read=2):
+    """
+    Check that completing an early-stopped document leaves a cache entry with
+    the pages and words of every page, so that re-uploading it is complete too.
+    Page OCR is simulated, so this runs without Tesseract.
+    """
+    import os
+    import tempfile
+    from ocr_processor import OCRProcessor
+    from result_cache import ResultCache
+    
+    def process_pdf(pdf_path, regions=None, early_stop=False, page_numbers=None):
+        page_numbers = page_numbers or list(range(1, pages + 1))
+        done = page_numbers[:read] if early_stop else page_numbers
+        return [
+            {"page": n, "text": f"Page {n}", "seconds": 0.0, "source": "ocr", "words": [{"text": f"Page{n}", "page": n}]}
+            for n in done
+        ] + [
+            {"page": n, "text": "", "seconds": 0.0, "source": "skipped"}
+            for n in page_numbers[len(done):]
+        ]
+    
+    def covers_every_page(result):
+        return (not result["skipped_pages"]
+                and sorted(page["page"] for page in result["pages"]) == list(range(1, pages + 1))
+                and {word["page"] for word in result["words"]} == set(range(1, pages + 1)))
+    
+    failures = []
+    with tempfile.TemporaryDirectory(dir=paths[0] if paths else None) as directory:
+        pdf_path = os.path.join(directory, "invoice.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(b"%PDF-1.4 synthetic")
+        
+        cache = ResultCache(os.path.join(directory, "ocr_cache.db"))
+        processor = OCRProcessor(workers=1, cache=cache, layout=True, roi=False, early_stop=True)
+        processor._process_pdf = process_pdf
+        
+        upload = processor.process_document(pdf_path)
+        if upload["skipped_pages"] != list(range(read + 1, pages + 1)):
+            failures.append(f"upload skipped {upload['skipped_pages']}")
+        
+        # A result rebuilt from stored text alone must not replace the cache entry
+        processor.complete_document(pdf_path, {"text": upload["text"], "pages": [], "words": [],
+                                               "seconds": 0, "skipped_pages": upload["skipped_pages"]})
+        if processor.process_document(pdf_path)["skipped_pages"] != upload["skipped_pages"]:
+            failures.append("partial completion overwrote the cached result")
+        
+        # Completing the cached result, as the invoice route does
+        elapsed, _ = _time_call(
+            lambda: processor.complete_document(pdf_path, processor.process_document(pdf_path)), repeat=1
+        )
+        reupload = processor.process_document(pdf_path)
+        if not reupload["cached"] or not covers_every_page(reupload):
+            failures.append("re-upload after completion does not cover every page")
+        
+        cache.conn.close()
+    
+    print(f"{pages} pages, {read} read before early stop; completion took {elapsed * 1000:.1f} ms")
+    print(f"  {'failures':30s} {len(failures):10d}")
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+BENCHMARKS = {
+    "preprocessing": benchmark_preprocessing,
+    "deskew": benchmark_deskew,
+    "ocr-engines": benchmark_ocr_engines,
+    "roi": benchmark_roi,
+    "item-parser": benchmark_item_parser,
+    "hsn-match": benchmark_hsn_match,
+    "hsn-batch": benchmark_hsn_batch,
+    "hsn-catalogue": benchmark_hsn_catalogue,
+    "keyword-match": benchmark_keyword_match,
+    "persistence": benchmark_persistence,
+    "query-plans": benchmark_query_plans,
+    "concurrency": benchmark_concurrency,
+    "ocr-completion": benchmark_ocr_completion,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the invoice processing pipeline")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("paths", nargs="*", help="Input files; synthetic data is used when omitted")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is kept)")
+    args = parser.parse_args()
+    
+    BENCHMARKS[args.benchmark](args.paths, args.repeat)
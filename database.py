@@ -1,29 +1,139 @@
 import os
 import json
 import sqlite3
+import threading
 import uuid
 from datetime import datetime
 
+from hsn_catalogue import get_shared_registry
+
+# Connection settings. WAL lets readers run alongside a writer, and writers
+# wait up to the busy timeout for each other instead of failing with
+# "database is locked".
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 10))
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", 16 * 1024))
+SQLITE_MMAP_BYTES = int(os.environ.get("SQLITE_MMAP_BYTES", 128 * 1024 * 1024))
+
+# Schema migrations, applied in order by _apply_migrations. PRAGMA user_version
+# records how many have run on a database; add new ones at the end only.
+MIGRATIONS = [
+    (
+        "Add secondary indexes for item lookups and analytics",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_items_invoice_id ON items (invoice_id)",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_created_at ON invoices (created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_items_hsn_code ON items (hsn_code)",
+            "CREATE INDEX IF NOT EXISTS idx_items_gst_rate ON items (gst_rate)",
+        ]
+    ),
+    (
+        "Keep the source file and skipped pages of invoices whose OCR stopped early",
+        [
+            "ALTER TABLE invoices ADD COLUMN source_path TEXT",
+            "ALTER TABLE invoices ADD COLUMN skipped_pages TEXT",
+        ]
+    ),
+]
+
+# Frequently run queries, with sample parameters and the index each should use
+HOT_QUERIES = {
+    "items_by_invoice": ("SELECT * FROM items WHERE invoice_id = ?", ("invoice",), "idx_items_invoice_id"),
+    "invoices_by_date": ("SELECT * FROM invoices ORDER BY created_at DESC", (), "idx_invoices_created_at"),
+    "items_by_hsn_code": ("SELECT * FROM items WHERE hsn_code = ?", ("1905",), "idx_items_hsn_code"),
+    "items_by_gst_rate": ("SELECT * FROM items WHERE gst_rate = ?", (18,), "idx_items_gst_rate"),
+}
+
+def _uuid4_batch(count):
+    """
+    Generate random (version 4) UUID strings in bulk, from one read of the
+    OS random source instead of one uuid.uuid4() object per ID
+    
+    Args:
+        count (int): Number of IDs
+        
+    Returns:
+        list: UUID strings in the same format as str(uuid.uuid4())
+    """
+    raw = bytearray(os.urandom(16 * count))
+    raw[6::16] = bytes(byte & 0x0F | 0x40 for byte in raw[6::16])  # Version 4
+    raw[8::16] = bytes(byte & 0x3F | 0x80 for byte in raw[8::16])  # RFC 4122 variant
+    digits = raw.hex()
+    return [
+        f"{digits[i:i + 8]}-{digits[i + 8:i + 12]}-{digits[i + 12:i + 16]}-{digits[i + 16:i + 20]}-{digits[i + 20:i + 32]}"
+        for i in range(0, 32 * count, 32)
+    ]
+
 class DatabaseClient:
-    def __init__(self):
-        """Initialize the SQLite database client and create necessary tables."""
+    def __init__(self, hsn_registry=None, db_path="data/taxlyzer.db"):
+        """
+        Initialize the SQLite database client and create necessary tables
+        
+        Args:
+            hsn_registry (HSNRegistry, optional): Source of the HSN catalogue; defaults
+                to the process-wide registry shared with GSTClassifier
+            db_path (str, optional): Path to the SQLite database file
+        """
         # Create data directory if it doesn't exist
-        os.makedirs("data", exist_ok=True)
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
         
-        # Connect to SQLite database with thread safety
-        self.db_path = "data/taxlyzer.db"
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row  # This enables dictionary-like access to rows
+        # Each thread gets its own connection (see conn), so Flask request
+        # threads and batch threads never share a cursor or a transaction
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
         
-        # Ensure tables exist
+        # Ensure tables exist and the schema is up to date
         self._create_tables_if_not_exist()
+        self._apply_migrations()
         
-        # Populate GST slabs table if empty
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM gst_slabs")
-        count = cursor.fetchone()[0]
-        if count == 0:
-            self._populate_gst_slabs()
+        # Keep the gst_slabs table in step with the HSN catalogue
+        self.hsn_registry = hsn_registry or get_shared_registry()
+        self._sync_gst_slabs(self.hsn_registry.catalogue)
+        self.hsn_registry.subscribe(self._sync_gst_slabs)
+    
+    @property
+    def conn(self):
+        """This thread's connection to the database, opened on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            
+            # Close the connections of threads that have finished
+            current = threading.current_thread()
+            with self._connections_lock:
+                for thread, stale in self._connections:
+                    if not thread.is_alive():
+                        stale.close()
+                self._connections = [
+                    (thread, other) for thread, other in self._connections if thread.is_alive()
+                ] + [(current, conn)]
+        return conn
+    
+    def _connect(self):
+        """Open a connection with the WAL, cache and busy timeout settings."""
+        # check_same_thread is off only so that close() can close every thread's connection
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # This enables dictionary-like access to rows
+        
+        conn.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL only syncs at checkpoints; a power cut can lose the
+        # last commits but never corrupts the database
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_BYTES}")
+        return conn
+    
+    def close(self):
+        """Close the connections of all threads."""
+        with self._connections_lock:
+            for _, conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
     
     def _create_tables_if_not_exist(self):
         """
@@ -31,6 +141,8 @@ class DatabaseClient:
         - invoices: Store invoice metadata
         - items: Store extracted items
         - gst_slabs: Store HSN codes and GST rates
+        - hsn_snapshot: Version of the HSN catalogue gst_slabs was copied from
+        - classification_memory: Store learned item classifications
         """
         cursor = self.conn.cursor()
         
@@ -75,37 +187,102 @@ class DatabaseClient:
         ''')
         print("GST slabs table is ready.")
         
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hsn_snapshot (
+                version INTEGER NOT NULL
+            )
+        ''')
+        
+        # Create classification_memory table; revision increases with every change
+        # so readers can tell when to reload it
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classification_memory (
+                item_key TEXT PRIMARY KEY,
+                item TEXT NOT NULL,
+                hsn_code TEXT,
+                gst_rate NUMERIC NOT NULL,
+                source TEXT NOT NULL,
+                revision INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_classification_memory_revision ON classification_memory (revision)"
+        )
+        print("Classification memory table is ready.")
+        
         # Commit changes
         self.conn.commit()
     
-    def _populate_gst_slabs(self):
-        """Populate the gst_slabs table with common HSN codes."""
-        common_hsn_codes = [
-            {"hsn_code": "1905", "description": "Bread, pastry, cakes, biscuits", "gst_rate": 18},
-            {"hsn_code": "2106", "description": "Food preparations", "gst_rate": 18},
-            {"hsn_code": "3004", "description": "Medicaments", "gst_rate": 12},
-            {"hsn_code": "3304", "description": "Beauty or make-up preparations", "gst_rate": 28},
-            {"hsn_code": "3401", "description": "Soap, organic surface-active products", "gst_rate": 18},
-            {"hsn_code": "3402", "description": "Washing and cleaning preparations", "gst_rate": 18},
-            {"hsn_code": "3923", "description": "Plastic articles for packaging", "gst_rate": 18},
-            {"hsn_code": "4819", "description": "Cartons, boxes, cases, bags of paper", "gst_rate": 18},
-            {"hsn_code": "8415", "description": "Air conditioning machines", "gst_rate": 28},
-            {"hsn_code": "8508", "description": "Vacuum cleaners", "gst_rate": 28},
-            {"hsn_code": "8516", "description": "Electric heating equipment", "gst_rate": 28},
-            {"hsn_code": "8517", "description": "Telephones, smartphones", "gst_rate": 18},
-            {"hsn_code": "8528", "description": "Monitors and projectors, TV receivers", "gst_rate": 28},
-            # Add more common HSN codes as needed
-        ]
+    def _apply_migrations(self):
+        """Run the MIGRATIONS this database has not had yet, each in its own transaction."""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
         
-        cursor = self.conn.cursor()
-        for hsn_data in common_hsn_codes:
-            cursor.execute(
+        for number, (description, statements) in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                self.conn.execute("BEGIN")
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            
+            print(f"Applied database migration {number}: {description}")
+    
+    def explain_query_plans(self):
+        """
+        Check which indexes the HOT_QUERIES use
+        
+        Returns:
+            dict: Query name -> dict with the "plan" (EXPLAIN QUERY PLAN details),
+                the expected "index" and whether the plan "uses_index"
+        """
+        plans = {}
+        for name, (query, parameters, index) in HOT_QUERIES.items():
+            cursor = self.conn.cursor()
+            cursor.execute(f"EXPLAIN QUERY PLAN {query}", parameters)
+            plan = [row["detail"] for row in cursor.fetchall()]
+            plans[name] = {
+                "plan": plan,
+                "index": index,
+                "uses_index": any(f"INDEX {index}" in detail for detail in plan)
+            }
+        return plans
+    
+    def _sync_gst_slabs(self, catalogue):
+        """
+        Copy the HSN catalogue into the gst_slabs table, unless it already holds
+        this version
+        
+        Args:
+            catalogue (HSNCatalogue): Current HSN catalogue
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT version FROM hsn_snapshot")
+            row = cursor.fetchone()
+            if row is not None and row[0] == catalogue.version:
+                return
+            
+            cursor.execute("DELETE FROM gst_slabs")
+            cursor.executemany(
                 "INSERT INTO gst_slabs (id, hsn_code, description, gst_rate) VALUES (?, ?, ?, ?)",
-                (str(uuid.uuid4()), hsn_data["hsn_code"], hsn_data["description"], hsn_data["gst_rate"])
+                [
+                    (str(uuid.uuid4()), entry["hsn_code"], entry["description"], entry["gst_rate"])
+                    for entry in map(catalogue.entry, range(len(catalogue)))
+                    if entry["gst_rate"] is not None
+                ]
             )
-        
-        self.conn.commit()
-        print("Populated GST slabs table with common HSN codes.")
+            cursor.execute("DELETE FROM hsn_snapshot")
+            cursor.execute("INSERT INTO hsn_snapshot (version) VALUES (?)", (catalogue.version,))
+            
+            self.conn.commit()
+            print(f"Copied HSN catalogue version {catalogue.version} to the GST slabs table.")
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error syncing GST slabs: {e}")
     
     def insert_invoice(self, file_name, file_type, raw_text):
         """
@@ -134,6 +311,58 @@ class DatabaseClient:
             print(f"Error inserting invoice: {e}")
             return None
     
+    def save_invoice_with_items(self, file_name, file_type, raw_text, items,
+                                source_path=None, skipped_pages=None):
+        """
+        Insert an invoice and its items atomically: either both are saved or,
+        on any error, neither is
+        
+        Args:
+            file_name (str): Name of the uploaded file
+            file_type (str): MIME type of the file
+            raw_text (str): Extracted raw text from OCR
+            items (list): List of dictionaries containing item details
+            source_path (str, optional): Kept copy of the file, when OCR stopped early
+            skipped_pages (list, optional): Page numbers left out of raw_text
+            
+        Returns:
+            tuple: (invoice ID, list of item IDs in the order of items), or
+                (None, []) if failed
+        """
+        try:
+            invoice_id, *item_ids = _uuid4_batch(len(items) + 1)
+            
+            # The connection context manager commits once at the end, or rolls
+            # everything back if a statement fails
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.execute(
+                    "INSERT INTO invoices (id, file_name, file_type, raw_text, source_path, skipped_pages) VALUES (?, ?, ?, ?, ?, ?)",
+                    (invoice_id, file_name, file_type, raw_text, source_path,
+                     json.dumps(skipped_pages) if skipped_pages else None)
+                )
+                cursor.executemany(
+                    "INSERT INTO items (id, invoice_id, item, qty, unit_price, total, hsn_code, gst_rate) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            item_id,
+                            invoice_id,
+                            item["item"],
+                            item["qty"],
+                            item["unit_price"],
+                            item["total"],
+                            item.get("hsn_code", ""),
+                            item.get("gst_rate", 0)
+                        )
+                        for item_id, item in zip(item_ids, items)
+                    ]
+                )
+            
+            return invoice_id, item_ids
+        except Exception as e:
+            print(f"Error saving invoice with items: {e}")
+            return None, []
+    
     def insert_items(self, invoice_id, items):
         """
         Insert extracted items for an invoice
@@ -203,6 +432,99 @@ class DatabaseClient:
             print(f"Error updating item: {e}")
             return False
     
+    def get_item(self, item_id):
+        """
+        Get a specific item by ID
+        
+        Args:
+            item_id (str): ID of the item
+        
+        Returns:
+            dict: Item details
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT * FROM items WHERE id = ?", (item_id,))
+            
+            row = cursor.fetchone()
+            if row:
+                return dict(row)
+            return None
+        except Exception as e:
+            print(f"Error getting item: {e}")
+            return None
+    
+    def remember_classifications(self, entries):
+        """
+        Insert or update learned item classifications. Corrections made by
+        users are only ever replaced by newer corrections.
+        
+        Args:
+            entries (list): Dictionaries with item_key (normalised item name), item,
+                hsn_code, gst_rate and source ("correction" or "classification")
+        
+        Returns:
+            int: New version of the classification memory, or None on failure
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO classification_memory (item_key, item, hsn_code, gst_rate, source, revision)
+                VALUES (:item_key, :item, :hsn_code, :gst_rate, :source,
+                        (SELECT COALESCE(MAX(revision), 0) + 1 FROM classification_memory))
+                ON CONFLICT (item_key) DO UPDATE SET
+                    item = excluded.item,
+                    hsn_code = excluded.hsn_code,
+                    gst_rate = excluded.gst_rate,
+                    source = excluded.source,
+                    revision = excluded.revision,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE classification_memory.source != 'correction' OR excluded.source = 'correction'
+                """,
+                entries
+            )
+            
+            self.conn.commit()
+            return self.get_classification_memory_version()
+        except Exception as e:
+            print(f"Error saving classification memory: {e}")
+            return None
+    
+    def get_classification_memory(self):
+        """
+        Get all learned item classifications
+        
+        Returns:
+            dict: Normalised item name -> dict with hsn_code, gst_rate and source
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT item_key, hsn_code, gst_rate, source FROM classification_memory")
+            
+            return {
+                row["item_key"]: {"hsn_code": row["hsn_code"], "gst_rate": row["gst_rate"], "source": row["source"]}
+                for row in cursor.fetchall()
+            }
+        except Exception as e:
+            print(f"Error getting classification memory: {e}")
+            return {}
+    
+    def get_classification_memory_version(self):
+        """
+        Get the version of the classification memory, which changes whenever it does
+        
+        Returns:
+            int: Latest revision, or None on failure
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(revision), 0) FROM classification_memory")
+            return cursor.fetchone()[0]
+        except Exception as e:
+            print(f"Error getting classification memory version: {e}")
+            return None
+    
     def get_invoices(self):
         """
         Get all invoices from the database
@@ -215,7 +537,7 @@ class DatabaseClient:
             cursor.execute("SELECT * FROM invoices ORDER BY created_at DESC")
             
             # Convert rows to dictionaries
-            invoices = [dict(row) for row in cursor.fetchall()]
+            invoices = [self._invoice_from_row(row) for row in cursor.fetchall()]
             return invoices
         except Exception as e:
             print(f"Error getting invoices: {e}")
@@ -237,12 +559,44 @@ class DatabaseClient:
             
             row = cursor.fetchone()
             if row:
-                return dict(row)
+                return self._invoice_from_row(row)
             return None
         except Exception as e:
             print(f"Error getting invoice: {e}")
             return None
     
+    def _invoice_from_row(self, row):
+        """Convert an invoices row to a dictionary, decoding its skipped pages."""
+        invoice = dict(row)
+        if invoice.get("skipped_pages"):
+            invoice["skipped_pages"] = json.loads(invoice["skipped_pages"])
+        return invoice
+    
+    def complete_invoice_text(self, invoice_id, raw_text):
+        """
+        Replace the raw text of an invoice whose OCR stopped early with the
+        text of all its pages
+        
+        Args:
+            invoice_id (str): ID of the invoice
+            raw_text (str): Raw text of every page
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE invoices SET raw_text = ?, source_path = NULL, skipped_pages = NULL WHERE id = ?",
+                (raw_text, invoice_id)
+            )
+            
+            self.conn.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error completing invoice text: {e}")
+            return False
+    
     def get_items_by_invoice(self, invoice_id):
         """
         Get all items for a specific invoice
@@ -294,17 +648,15 @@ class DatabaseClient:
         """
         try:
             # This is a simplified approach; in a real system, use more sophisticated matching
-            gst_slabs = self.get_gst_slabs()
+            self.hsn_registry.maybe_reload()
+            catalogue = self.hsn_registry.catalogue
             
-            # Convert item name to lowercase for case-insensitive matching
-            item_name_lower = item_name.lower()
-            
-            for slab in gst_slabs:
-                description = slab.get("description", "").lower()
-                
-                # Check if any word in the description is in the item name
-                if any(word in item_name_lower for word in description.split()):
-                    return slab["hsn_code"], slab["gst_rate"]
+            # Rows with a description word in the item name (case-insensitive); the
+            # lowest code wins
+            candidates = catalogue.word_candidates(item_name.lower())
+            if candidates:
+                entry = catalogue.entry(min(candidates))
+                return entry["hsn_code"], entry["gst_rate"]
             
             # Default return
             return None, 0
@@ -313,6 +665,6 @@ class DatabaseClient:
             return None, 0
             
     def __del__(self):
-        """Close the database connection when the object is destroyed."""
-        if hasattr(self, 'conn'):
-            self.conn.close()
+        """Close the database connections when the object is destroyed."""
+        if hasattr(self, '_connections'):
+            self.close()
@@ -2,9 +2,12 @@ import re
 import os
 import csv
 import json
-import pandas as pd
 from fuzzywuzzy import fuzz
 
+from hsn_catalogue import get_shared_registry
+from hsn_matcher import HSNVectorMatcher
+from keyword_matcher import KeywordAutomaton
+
 # Check if AI processor is available
 try:
     from ai_processor import AIProcessor
@@ -12,10 +15,84 @@ try:
 except ImportError:
     ai_available = False
 
+# Upper bound on the item descriptions sent in one suggest_hsn_codes request,
+# keeping the prompt and the JSON reply well inside the model's limits
+MAX_DESCRIPTIONS_PER_REQUEST = 80
+MAX_DESCRIPTION_CHARS_PER_REQUEST = 6000
+
+# Confidence of each local classification tier. HSN description matches are
+# scored by their fuzzy match ratio; items below the classifier's confidence
+# threshold are escalated to the AI.
+MEMORY_CONFIDENCE = 1.0
+SPECIFIC_ITEM_CONFIDENCE = 0.95
+AI_CONFIDENCE = 0.9
+CATEGORY_CONFIDENCE = 0.5
+DEFAULT_CONFIDENCE = 0.0
+# Cosine similarity an HSN description needs to match an item when the
+# "tfidf" HSN matcher is used
+VECTOR_MATCH_THRESHOLD = 0.35
+TIERS = ("memory", "specific", "hsn", "category", "default", "ai")
+
+def normalize_item_name(name):
+    """
+    Normalise an item description so that spelling variants of the same SKU
+    (case, spacing, punctuation) compare equal
+    
+    Args:
+        name (str): Item description
+    
+    Returns:
+        str: Normalised description
+    """
+    return " ".join(re.sub(r'[^\w\s\-/.%]', ' ', str(name).lower()).split())
+
 class GSTClassifier:
-    def __init__(self):
+    def __init__(self, confidence_threshold=None, memory=None, memory_confidence=None, hsn_matcher=None,
+                 hsn_registry=None):
+        """
+        Initialize the GST classifier
+        
+        Args:
+            confidence_threshold (float, optional): Items classified locally with a
+                lower confidence (0-1) are sent to the AI. Defaults to the
+                GST_AI_CONFIDENCE_THRESHOLD environment variable, or 0.75.
+            memory (DatabaseClient, optional): Store of learned classifications, keyed
+                by normalised item name, consulted before any other tier
+            memory_confidence (float, optional): Classifications at least this confident
+                are added to the memory. Defaults to the GST_MEMORY_CONFIDENCE
+                environment variable, or 0.9.
+            hsn_matcher (str, optional): How items are matched against HSN descriptions:
+                "fuzzy" (per item fuzzy ratio) or "tfidf" (whole invoices or batches at
+                once by character n-gram TF-IDF similarity). Defaults to the
+                GST_HSN_MATCHER environment variable, or "fuzzy".
+            hsn_registry (HSNRegistry, optional): Source of the HSN catalogue; defaults
+                to the process-wide registry shared with DatabaseClient
+        """
+        if confidence_threshold is None:
+            confidence_threshold = float(os.environ.get("GST_AI_CONFIDENCE_THRESHOLD", 0.75))
+        self.confidence_threshold = confidence_threshold
+        
+        if memory_confidence is None:
+            memory_confidence = float(os.environ.get("GST_MEMORY_CONFIDENCE", 0.9))
+        self.memory = memory
+        self.memory_confidence = memory_confidence
+        
+        if hsn_matcher is None:
+            hsn_matcher = os.environ.get("GST_HSN_MATCHER", "fuzzy")
+        self.hsn_matcher = hsn_matcher
+        
+        # In-memory copy of the learned classifications and the table version it reflects
+        self._memory_map = {}
+        self._memory_version = None
+        self._refresh_memory()
+        
+        # Items resolved by each tier, and AI requests made, since start-up
+        self.tier_stats = dict.fromkeys(TIERS, 0)
+        self.tier_stats["ai_requests"] = 0
+        
         # Load HSN codes and GST rates
-        self.hsn_data = self._load_hsn_data()
+        self.hsn_registry = hsn_registry or get_shared_registry()
+        self._hsn_state = None
         
         # Initialize AI processor if available
         if ai_available:
@@ -68,124 +145,315 @@ class GSTClassifier:
             "parle-g": {"gst_rate": 18, "hsn_code": "1905"},
             "britannia": {"gst_rate": 18, "hsn_code": "1905"}
         }
+        
+        self._build_keyword_automata()
     
-    def _load_hsn_data(self):
+    def classify_items(self, items, hsn_suggestions=None):
         """
-        Load HSN code data from CSV
+        Classify items into GST slabs. Every item is classified locally first;
+        only items whose local confidence is below confidence_threshold are
+        sent to the AI, together in a single request.
         
+        Args:
+            items (list): List of dictionaries containing item details
+            hsn_suggestions (dict, optional): HSN suggestions already fetched for these
+                items (e.g. by AsyncAIProcessor.suggest_hsn_codes_async); the AI is
+                only called when they are not given
+            
         Returns:
-            pandas.DataFrame: DataFrame containing HSN codes and GST rates
-        """
-        # Try to load from data directory first
-        data_file = os.path.join("data", "hsn_codes.csv")
-        
-        if os.path.exists(data_file):
-            return pd.read_csv(data_file)
-        
-        # If file doesn't exist, create a basic dataset
-        data = {
-            "hsn_code": [
-                "1905", "2106", "3004", "3304", "3401", "3402", "3923", 
-                "4819", "8415", "8508", "8516", "8517", "8528"
-            ],
-            "description": [
-                "Bread, pastry, cakes, biscuits", "Food preparations", "Medicaments",
-                "Beauty or make-up preparations", "Soap, organic surface-active products",
-                "Washing and cleaning preparations", "Plastic articles for packaging",
-                "Cartons, boxes, cases, bags of paper", "Air conditioning machines",
-                "Vacuum cleaners", "Electric heating equipment", "Telephones, smartphones",
-                "Monitors and projectors, TV receivers"
-            ],
-            "gst_rate": [
-                18, 18, 12, 28, 18, 18, 18, 18, 28, 28, 28, 18, 28
-            ]
-        }
+            list: List of dictionaries with GST details added
+        """
+        self._refresh_memory()
+        
+        low_confidence = []
+        learned = []
+        hsn_matches = self._vector_hsn_matches([item["item"] for item in items])
+        for item, hsn_match in zip(items, hsn_matches):
+            result = self._traditional_classify_item(item, hsn_match)
+            if result["confidence"] < self.confidence_threshold:
+                low_confidence.append((item, result))
+            else:
+                self.tier_stats[result["tier"]] += 1
+                learned.append((item, result))
+        
+        # If AI is available, use it for the items the local tiers are unsure of
+        if low_confidence and (hsn_suggestions is not None or (hasattr(self, 'use_ai') and self.use_ai)):
+            try:
+                if hsn_suggestions is None:
+                    # Extract item descriptions for AI classification
+                    item_descriptions = list(dict.fromkeys(item["item"] for item, _ in low_confidence))
+                    
+                    # Get AI suggestions for HSN codes and GST rates
+                    hsn_suggestions = self.ai_processor.suggest_hsn_codes(item_descriptions)
+                    self.tier_stats["ai_requests"] += 1
+            except Exception as e:
+                print(f"AI-based classification failed: {e}")
+                # Keep the traditional classification
         
-        df = pd.DataFrame(data)
+        ai_classified = 0
+        for item, result in low_confidence:
+            suggestion = (hsn_suggestions or {}).get(item["item"])
+            if isinstance(suggestion, dict):
+                # Apply AI suggestion
+                item["hsn_code"] = suggestion.get("hsn_code", "")
+                item["gst_rate"] = suggestion.get("gst_rate", 18)
+                result = {"tier": "ai", "confidence": AI_CONFIDENCE}
+                learned.append((item, result))
+                ai_classified += 1
+            self.tier_stats[result["tier"]] += 1
         
-        # Create data directory if it doesn't exist
-        os.makedirs("data", exist_ok=True)
+        if ai_classified:
+            print(f"AI successfully classified {ai_classified} of {len(items)} items")
         
-        # Save to CSV for future use
-        df.to_csv(data_file, index=False)
+        self._remember(learned)
         
-        return df
+        return items
     
-    def classify_items(self, items):
+    def classify_batch(self, invoices, async_ai_processor=None):
         """
-        Classify items into GST slabs
+        Classify the items of many invoices at once. Descriptions are normalised
+        and deduplicated across the batch and only the unique ones are
+        classified: locally first, then those below confidence_threshold with
+        the AI, in as few requests as the prompt limits allow. The results are
+        fanned back out to every invoice.
         
         Args:
-            items (list): List of dictionaries containing item details
-            
+            invoices (list): One list of item dictionaries per invoice
+            async_ai_processor (AsyncAIProcessor, optional): When given, the AI
+                requests for the chunks are sent concurrently through it
+        
         Returns:
-            list: List of dictionaries with GST details added
+            tuple: (list of classified item lists in invoice order, stats dict with
+                "invoices", "total_descriptions", "unique_descriptions", "ai_requests"
+                and the unique descriptions resolved by each tier in "tiers")
         """
-        # If AI is available, try to use it for classification
-        if hasattr(self, 'use_ai') and self.use_ai:
+        self._refresh_memory()
+        
+        # First spelling seen of each normalised description
+        unique = {}
+        total = 0
+        for items in invoices:
+            for item in items:
+                total += 1
+                unique.setdefault(normalize_item_name(item["item"]), item["item"])
+        
+        # Classify each unique description locally once; only the ones the local
+        # tiers are unsure of are sent to the AI
+        classifications = {}
+        escalate = []
+        hsn_matches = self._vector_hsn_matches(list(unique.values()))
+        for (name, description), hsn_match in zip(unique.items(), hsn_matches):
+            classified = {"item": description}
+            result = self._traditional_classify_item(classified, hsn_match)
+            classifications[name] = (classified, result)
+            if result["confidence"] < self.confidence_threshold:
+                escalate.append(description)
+        
+        suggestions = {}
+        chunks = []
+        if self.use_ai and escalate:
+            chunks = self._chunk_descriptions(escalate)
             try:
-                # Extract item descriptions for AI classification
-                item_descriptions = [item["item"] for item in items]
-                
-                # Get AI suggestions for HSN codes and GST rates
-                hsn_suggestions = self.ai_processor.suggest_hsn_codes(item_descriptions)
-                
-                if hsn_suggestions:
-                    # Apply AI suggestions
-                    classified_items = []
-                    for item in items:
-                        item_name = item["item"]
-                        if item_name in hsn_suggestions:
-                            suggestion = hsn_suggestions[item_name]
-                            item["hsn_code"] = suggestion.get("hsn_code", "")
-                            item["gst_rate"] = suggestion.get("gst_rate", 18)
-                        else:
-                            # Fall back to traditional classification if item not found
-                            self._traditional_classify_item(item)
-                        
-                        classified_items.append(item)
-                    
-                    print(f"AI successfully classified {len(classified_items)} items")
-                    return classified_items
+                if async_ai_processor is not None:
+                    futures = [
+                        async_ai_processor.submit(async_ai_processor.suggest_hsn_codes_async(chunk))
+                        for chunk in chunks
+                    ]
+                    responses = [future.result() for future in futures]
+                else:
+                    responses = [self.ai_processor.suggest_hsn_codes(chunk) for chunk in chunks]
                 
+                for response in responses:
+                    for description, suggestion in (response or {}).items():
+                        if isinstance(suggestion, dict):
+                            suggestions[normalize_item_name(description)] = suggestion
             except Exception as e:
-                print(f"AI-based classification failed: {e}")
-                # Fall back to traditional classification
+                print(f"AI-based batch classification failed: {e}")
+        
+        tiers = dict.fromkeys(TIERS, 0)
+        for name, (classified, result) in classifications.items():
+            # Only descriptions below the threshold were sent to the AI
+            if name in suggestions and result["confidence"] < self.confidence_threshold:
+                classified["hsn_code"] = suggestions[name].get("hsn_code", "")
+                classified["gst_rate"] = suggestions[name].get("gst_rate", 18)
+                result = {"tier": "ai", "confidence": AI_CONFIDENCE}
+                classifications[name] = (classified, result)
+            tiers[result["tier"]] += 1
+            self.tier_stats[result["tier"]] += 1
+        self.tier_stats["ai_requests"] += len(chunks)
+        
+        self._remember(classifications.values())
+        
+        # Copy each description's classification to every item that has it
+        classified_invoices = []
+        for items in invoices:
+            for item in items:
+                classified = classifications[normalize_item_name(item["item"])][0]
+                item.update({key: classified[key] for key in ("hsn_code", "gst_rate") if key in classified})
+            classified_invoices.append(items)
+        
+        stats = {
+            "invoices": len(invoices),
+            "total_descriptions": total,
+            "unique_descriptions": len(unique),
+            "ai_requests": len(chunks),
+            "tiers": tiers
+        }
+        print(f"Batch classification: {len(unique)} unique of {total} item descriptions, "
+              f"{len(chunks)} AI requests")
+        return classified_invoices, stats
+    
+    def learn_correction(self, item_name, hsn_code, gst_rate):
+        """
+        Remember a user's correction of an item's classification; it takes
+        precedence over every other tier the next time the item is seen
+        
+        Args:
+            item_name (str): Name of the item
+            hsn_code (str): Corrected HSN code
+            gst_rate (float): Corrected GST rate
+        """
+        self._remember([({"item": item_name, "hsn_code": hsn_code, "gst_rate": gst_rate},
+                         {"tier": "correction", "confidence": MEMORY_CONFIDENCE})], source="correction")
+    
+    def _refresh_memory(self):
+        """Reload the learned classifications if the memory table has changed."""
+        if self.memory is None:
+            return
+        
+        version = self.memory.get_classification_memory_version()
+        if version is not None and version != self._memory_version:
+            self._memory_map = self.memory.get_classification_memory()
+            self._memory_version = version
+    
+    def _remember(self, classified, source="classification"):
+        """
+        Add confident classifications to the memory
+        
+        Args:
+            classified (iterable): (item, result) pairs, where result has the "tier"
+                and "confidence" of the item's classification
+            source (str, optional): "classification", or "correction" for user edits,
+                which automatic classifications never overwrite
+        """
+        if self.memory is None:
+            return
         
-        # Traditional classification approach
-        classified_items = []
-        for item in items:
-            self._traditional_classify_item(item)
-            classified_items.append(item)
+        entries = {}
+        for item, result in classified:
+            if result["tier"] == "memory" or result["confidence"] < self.memory_confidence:
+                continue
+            if not item.get("hsn_code") and source != "correction":
+                continue
             
-        return classified_items
+            key = normalize_item_name(item["item"])
+            known = self._memory_map.get(key)
+            if known is not None and (known["source"] == "correction" and source != "correction"
+                                      or (known["hsn_code"], known["gst_rate"]) == (item["hsn_code"], item["gst_rate"])):
+                continue
+            
+            entries[key] = {"item_key": key, "item": item["item"], "hsn_code": str(item.get("hsn_code") or ""),
+                            "gst_rate": item["gst_rate"], "source": source}
+        
+        if not entries:
+            return
+        
+        version = self.memory.remember_classifications(list(entries.values()))
+        if version is not None:
+            for key, entry in entries.items():
+                self._memory_map[key] = {name: entry[name] for name in ("hsn_code", "gst_rate", "source")}
+            self._memory_version = version
+    
+    def classification_stats(self):
+        """
+        Get the number of items each classification tier has resolved
+        
+        Returns:
+            dict: Items per tier, AI requests made and the share of items sent to the AI
+        """
+        stats = dict(self.tier_stats)
+        classified = sum(stats[tier] for tier in TIERS)
+        stats["ai_share"] = stats["ai"] / classified if classified else 0
+        stats["confidence_threshold"] = self.confidence_threshold
+        stats["memory_entries"] = len(self._memory_map)
+        return stats
+    
+    def _chunk_descriptions(self, descriptions):
+        """
+        Split item descriptions into chunks that fit in one suggest_hsn_codes request
+        
+        Args:
+            descriptions (list): Item descriptions
+        
+        Returns:
+            list: Lists of descriptions
+        """
+        chunks = []
+        chunk_chars = 0
+        for description in descriptions:
+            if (not chunks or len(chunks[-1]) >= MAX_DESCRIPTIONS_PER_REQUEST
+                    or chunk_chars + len(description) > MAX_DESCRIPTION_CHARS_PER_REQUEST):
+                chunks.append([])
+                chunk_chars = 0
+            chunks[-1].append(description)
+            chunk_chars += len(description)
+        return chunks
+    
+    def _traditional_classify_item(self, item, hsn_match=None):
+        """
+        Helper method for traditional classification logic
+        
+        Args:
+            item (dict): Item to classify; "gst_rate" and, when known, "hsn_code" are set on it
+            hsn_match (tuple, optional): HSN match already found for the item by
+                _vector_hsn_matches; _match_with_hsn is used when not given
+            
+        Returns:
+            dict: "tier" that classified the item ("memory", "specific", "hsn", "category"
+                or "default") and the "confidence" of the classification (0-1)
+        """
+        # Items seen before, as corrected by a user or confidently classified
+        learned = self._memory_map.get(normalize_item_name(item["item"]))
+        if learned is not None:
+            item["hsn_code"] = learned["hsn_code"]
+            item["gst_rate"] = learned["gst_rate"]
+            if learned["source"] != "correction" and learned["hsn_code"]:
+                # Follow rate changes in the HSN catalogue for learned codes
+                rate = self.hsn_catalogue.rate(learned["hsn_code"])
+                if rate is not None:
+                    item["gst_rate"] = rate
+            return {"tier": "memory", "confidence": MEMORY_CONFIDENCE}
         
-    def _traditional_classify_item(self, item):
-        """Helper method for traditional classification logic"""
         item_name = item["item"].lower()
         
-        # Check if item is in specific items list
-        for specific_item, details in self.specific_items.items():
-            if specific_item in item_name:
-                item["gst_rate"] = details["gst_rate"]
-                item["hsn_code"] = details["hsn_code"]
-                return
+        # Check if item is in specific items list; the first listed item wins
+        matches = self._specific_automaton.find(item_name)
+        if matches:
+            details = min(matches, key=lambda match: match[2])[3]
+            item["gst_rate"] = details["gst_rate"]
+            item["hsn_code"] = details["hsn_code"]
+            return {"tier": "specific", "confidence": SPECIFIC_ITEM_CONFIDENCE}
                 
         # If not found in specific items, try to match with HSN data
-        hsn_code, gst_rate = self._match_with_hsn(item_name)
+        if hsn_match is None:
+            hsn_match = self._match_with_hsn(item_name)
+        hsn_code, gst_rate, score = hsn_match
         
         if hsn_code:
             item["hsn_code"] = hsn_code
             item["gst_rate"] = gst_rate
-        else:
-            # If not found in HSN data, use category-based classification
-            category = self._identify_category(item_name)
-            
-            if category:
-                item["gst_rate"] = self.category_to_gst.get(category, 18)  # Default to 18% if category not found
-            else:
-                # Default GST rate if nothing matches
-                item["gst_rate"] = 18
+            return {"tier": "hsn", "confidence": score / 100}
+        
+        # If not found in HSN data, use category-based classification
+        category = self._identify_category(item_name)
+        
+        if category:
+            item["gst_rate"] = self.category_to_gst.get(category, 18)  # Default to 18% if category not found
+            return {"tier": "category", "confidence": CATEGORY_CONFIDENCE}
+        
+        # Default GST rate if nothing matches
+        item["gst_rate"] = 18
+        return {"tier": "default", "confidence": DEFAULT_CONFIDENCE}
     
     def _match_with_hsn(self, item_name):
         """
@@ -195,28 +463,117 @@ class GSTClassifier:
             item_name (str): Name of the item
             
         Returns:
-            tuple: (hsn_code, gst_rate) or (None, None) if not found
+            tuple: (hsn_code, gst_rate, score) with the fuzzy match score (0-100), or
+                (None, None, 0) if not found
         """
+        catalogue, descriptions, _ = self._hsn()
         best_match = None
         best_score = 0
         
-        for _, row in self.hsn_data.iterrows():
-            description = row["description"].lower()
+        # Only rows with a description word contained in the item name are scored,
+        # in code order so ties resolve to the first row. Rows without a GST
+        # rate, even an inherited one, cannot classify anything.
+        for row in sorted(catalogue.word_candidates(item_name)):
+            if not catalogue.has_rate(row):
+                continue
+            score = fuzz.token_sort_ratio(descriptions[row], item_name)
             
-            # Check if any word in the description is in the item name
-            for word in description.split():
-                if word in item_name and len(word) > 3:  # Only consider words longer than 3 characters
-                    score = fuzz.token_sort_ratio(description, item_name)
-                    
-                    if score > best_score:
-                        best_score = score
-                        best_match = row
+            if score > best_score:
+                best_score = score
+                best_match = row
         
         # Only consider a match if the score is above a threshold
         if best_score > 60:
-            return best_match["hsn_code"], best_match["gst_rate"]
+            entry = catalogue.entry(best_match)
+            return entry["hsn_code"], entry["gst_rate"], best_score
         
-        return None, None
+        return None, None, 0
+    
+    def match_hsn_batch(self, item_names, top_k=5):
+        """
+        Score many item names against every HSN description at once
+        
+        Args:
+            item_names (list): Item names
+            top_k (int, optional): Candidates returned per item
+            
+        Returns:
+            list: One list per item of candidate dicts with hsn_code, gst_rate,
+                description and cosine similarity "score" (0-1), best first
+        """
+        catalogue, descriptions, matchers = self._hsn()
+        if "tfidf" not in matchers:
+            matchers["tfidf"] = HSNVectorMatcher(descriptions)
+        
+        return [
+            [dict(catalogue.entry(row), score=score) for row, score in candidates]
+            for candidates in matchers["tfidf"].match(item_names, top_k=top_k)
+        ]
+    
+    def _vector_hsn_matches(self, item_names):
+        """
+        Find the HSN match of each item with the "tfidf" matcher, in one pass
+        
+        Args:
+            item_names (list): Item names
+            
+        Returns:
+            list: (hsn_code, gst_rate, score) per item in the form _match_with_hsn
+                returns, or None for every item when the "fuzzy" matcher is used
+        """
+        if self.hsn_matcher != "tfidf":
+            return [None] * len(item_names)
+        
+        matches = []
+        for candidates in self.match_hsn_batch(item_names, top_k=5):
+            # The best candidate that has a GST rate
+            best = next((candidate for candidate in candidates if candidate["gst_rate"] is not None), None)
+            if best is not None and best["score"] >= VECTOR_MATCH_THRESHOLD:
+                matches.append((best["hsn_code"], best["gst_rate"], best["score"] * 100))
+            else:
+                matches.append((None, None, 0))
+        return matches
+    
+    @property
+    def hsn_catalogue(self):
+        """Current HSN catalogue."""
+        return self._hsn()[0]
+    
+    def _hsn(self):
+        """
+        Get the current HSN catalogue with the lowercased description of every
+        row, prepared once per catalogue version. Descriptions shared by several
+        codes are lowercased once.
+        
+        Returns:
+            tuple: (HSNCatalogue, list of row descriptions, dict of matchers built
+                for this version on first use)
+        """
+        self.hsn_registry.maybe_reload()
+        catalogue = self.hsn_registry.catalogue
+        
+        # Replaced as a whole, so concurrent callers never mix two versions
+        state = self._hsn_state
+        if state is None or state[0] is not catalogue:
+            lowered = [description.lower() for description in catalogue.descriptions]
+            state = (catalogue, [lowered[index] for index in catalogue.description_ids.tolist()], {})
+            self._hsn_state = state
+        return state
+    
+    def _build_keyword_automata(self):
+        """
+        Compile the category keywords and specific item names into automata
+        that find every whole-word match in one pass over an item name. Call
+        again after changing category_keywords or specific_items.
+        """
+        self._category_automaton = KeywordAutomaton(
+            (keyword.lower(), (category, keyword))
+            for category, keywords in self.category_keywords.items()
+            for keyword in keywords
+        )
+        self._specific_automaton = KeywordAutomaton(
+            (name.lower(), details) for name, details in self.specific_items.items()
+        )
     
     def _identify_category(self, item_name):
         """
@@ -231,12 +588,13 @@ class GSTClassifier:
         best_category = None
         best_match_count = 0
         
-        for category, keywords in self.category_keywords.items():
-            match_count = 0
-            
-            for keyword in keywords:
-                if keyword in item_name:
-                    match_count += 1
+        # Distinct keywords of each category found in the item name
+        matched = {}
+        for _, _, _, (category, keyword) in self._category_automaton.find(item_name):
+            matched.setdefault(category, set()).add(keyword)
+        
+        for category in self.category_keywords:
+            match_count = len(matched.get(category, ()))
             
             if match_count > best_match_count:
                 best_match_count = match_count
@@ -0,0 +1,622 @@
+import os
+import csv
+import sys
+import math
+import time
+import threading
+import numpy as np
+
+HSN_CSV = os.path.join("data", "hsn_codes.csv")
+HSN_SNAPSHOT = os.path.join("data", "hsn_catalogue.npz")
+
+# Longest HSN/SAC code (8-digit tariff item)
+MAX_CODE_LENGTH = 8
+
+# Separates the descriptions in the snapshot's UTF-8 text blob
+DESCRIPTION_SEPARATOR = "\x00"
+
+# Written to HSN_CSV when no HSN master is present
+DEFAULT_HSN_CODES = [
+    ("1905", "Bread, pastry, cakes, biscuits", 18),
+    ("2106", "Food preparations", 18),
+    ("3004", "Medicaments", 12),
+    ("3304", "Beauty or make-up preparations", 28),
+    ("3401", "Soap, organic surface-active products", 18),
+    ("3402", "Washing and cleaning preparations", 18),
+    ("3923", "Plastic articles for packaging", 18),
+    ("4819", "Cartons, boxes, cases, bags of paper", 18),
+    ("8415", "Air conditioning machines", 28),
+    ("8508", "Vacuum cleaners", 28),
+    ("8516", "Electric heating equipment", 28),
+    ("8517", "Telephones, smartphones", 18),
+    ("8528", "Monitors and projectors, TV receivers", 28),
+]
+
+class HSNCatalogue:
+    def __init__(self, codes, rates, description_ids, descriptions, effective_rates=None, version=0):
+        """
+        Initialize a compact HSN code table. Use from_records, from_csv or
+        load rather than calling this directly.
+        
+        Args:
+            codes (numpy.ndarray): HSN codes, sorted
+            rates (numpy.ndarray): GST rate of each code, NaN where the code has no
+                rate of its own and inherits its parent's
+            description_ids (numpy.ndarray): Index into descriptions for each code
+            descriptions (list): Distinct descriptions
+            effective_rates (numpy.ndarray, optional): Rates with inheritance already
+                resolved, as stored in snapshots; computed when not given
+            version (int, optional): Version of the HSN data, increased whenever it changes
+        """
+        self.version = version
+        self.codes = codes
+        self.rates = rates
+        self.description_ids = description_ids
+        self.descriptions = [sys.intern(str(description)) for description in descriptions]
+        
+        # The prefix trie is built here when rates need resolving, otherwise on
+        # the first code lookup, so loading a snapshot does no per-code work
+        self._trie = None
+        self.effective_rates = effective_rates
+        if effective_rates is None:
+            self._build_trie()
+        
+        # Word index used by word_candidates, built on first use
+        self._word_index = None
+        self._max_word = 0
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    @classmethod
+    def from_records(cls, codes, descriptions, rates, version=0):
+        """
+        Build a catalogue from parallel sequences in any order
+        
+        Args:
+            codes (iterable): HSN codes (2, 4, 6 or 8 digits)
+            descriptions (iterable): Description of each code
+            rates (iterable): GST rate of each code; None or NaN to inherit the
+                rate of the chapter/heading the code belongs to
+            version (int, optional): Version of the HSN data
+        
+        Returns:
+            HSNCatalogue: The catalogue
+        """
+        codes = np.array([str(code).strip() for code in codes], dtype=f"U{MAX_CODE_LENGTH}")
+        rates = np.array([np.nan if rate is None or rate == "" else float(rate) for rate in rates], dtype=np.float32)
+        
+        # Intern the descriptions: each distinct text is stored once
+        distinct = {}
+        description_ids = np.array(
+            [distinct.setdefault(str(description), len(distinct)) for description in descriptions], dtype=np.int32
+        )
+        
+        order = np.argsort(codes, kind="stable")
+        return cls(codes[order], rates[order], description_ids[order], list(distinct), version=version)
+    
+    @classmethod
+    def from_csv(cls, csv_path, version=0):
+        """
+        Build a catalogue from an HSN master CSV with hsn_code, description and
+        gst_rate columns
+        
+        Args:
+            csv_path (str): Path to the CSV file
+            version (int, optional): Version of the HSN data
+        
+        Returns:
+            HSNCatalogue: The catalogue
+        """
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        
+        return cls.from_records(
+            [row["hsn_code"] for row in rows],
+            [row["description"] for row in rows],
+            [row["gst_rate"] for row in rows],
+            version=version
+        )
+    
+    @classmethod
+    def load(cls, snapshot_path):
+        """
+        Load a catalogue from a binary snapshot written by save
+        
+        Args:
+            snapshot_path (str): Path to the .npz snapshot
+        
+        Returns:
+            HSNCatalogue: The catalogue
+        """
+        with np.load(snapshot_path, allow_pickle=False) as snapshot:
+            descriptions = snapshot["descriptions"].tobytes().decode("utf-8").split(DESCRIPTION_SEPARATOR)
+            return cls(
+                snapshot["codes"], snapshot["rates"], snapshot["description_ids"], descriptions,
+                effective_rates=snapshot["effective_rates"], version=int(snapshot["version"])
+            )
+    
+    def save(self, snapshot_path):
+        """
+        Write the catalogue to a binary snapshot that load reads back in milliseconds
+        
+        Args:
+            snapshot_path (str): Path to the .npz snapshot
+        """
+        directory = os.path.dirname(snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        # Write to a temporary file first so readers never see a partial snapshot
+        temp_path = f"{snapshot_path}.tmp.npz"
+        np.savez(
+            temp_path,
+            version=np.array(self.version),
+            codes=self.codes,
+            rates=self.rates,
+            effective_rates=self.effective_rates,
+            description_ids=self.description_ids,
+            # One UTF-8 blob rather than a fixed-width string array padded to the
+            # longest description
+            descriptions=np.frombuffer(
+                DESCRIPTION_SEPARATOR.join(
+                    description.replace(DESCRIPTION_SEPARATOR, " ") for description in self.descriptions
+                ).encode("utf-8"),
+                dtype=np.uint8
+            )
+        )
+        os.replace(temp_path, snapshot_path)
+    
+    def to_csv(self, csv_path):
+        """
+        Write the catalogue as an HSN master CSV that from_csv reads back
+        
+        Args:
+            csv_path (str): Path to the CSV file
+        """
+        temp_path = f"{csv_path}.tmp"
+        with open(temp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["hsn_code", "description", "gst_rate"])
+            for code, rate, description_id in zip(self.codes.tolist(), self.rates.tolist(),
+                                                  self.description_ids.tolist()):
+                if math.isnan(rate):
+                    rate = ""
+                elif rate.is_integer():
+                    rate = int(rate)
+                writer.writerow([code, self.descriptions[description_id], rate])
+        os.replace(temp_path, csv_path)
+    
+    def with_rates(self, rates):
+        """
+        Make a new version of the catalogue with some GST rates changed; the
+        catalogue itself is never modified
+        
+        Args:
+            rates (dict): HSN code -> new GST rate, or None to inherit the rate of
+                the code's heading or chapter
+        
+        Returns:
+            HSNCatalogue: The updated catalogue, one version later
+        
+        Raises:
+            ValueError: If a code is unknown, a rate is not a non-negative number,
+                or a code would be left without any rate to inherit
+        """
+        unknown = [code for code in rates if self.get(code) is None]
+        if unknown:
+            raise ValueError(f"Unknown HSN codes: {', '.join(map(str, unknown))}")
+        
+        new_rates = self.rates.copy()
+        for code, rate in rates.items():
+            if rate is not None:
+                rate = _parse_rate(code, rate)
+            
+            # Every row of a code listed twice gets the new rate
+            code = str(code).strip()
+            start = np.searchsorted(self.codes, code, side="left")
+            end = np.searchsorted(self.codes, code, side="right")
+            new_rates[start:end] = np.nan if rate is None else rate
+        
+        catalogue = HSNCatalogue(self.codes, new_rates, self.description_ids, self.descriptions,
+                                 version=self.version + 1)
+        
+        # Removing a rate must not leave the code, or codes that inherited the
+        # rate from it, with nothing to inherit
+        unrated = np.isnan(catalogue.effective_rates) & ~np.isnan(self.effective_rates)
+        unrated_codes = set(catalogue.codes[unrated].tolist())
+        unrated_codes.update(
+            str(code).strip() for code, rate in rates.items()
+            if rate is None and catalogue.get(code)["gst_rate"] is None
+        )
+        if unrated_codes:
+            raise ValueError(f"No GST rate to inherit for HSN codes: {', '.join(sorted(unrated_codes))}")
+        
+        return catalogue
+    
+    def entry(self, row):
+        """
+        Get a catalogue row as a dictionary
+        
+        Args:
+            row (int): Row position
+        
+        Returns:
+            dict: hsn_code, description and gst_rate (inherited when the code has none)
+        """
+        return {
+            "hsn_code": str(self.codes[row]),
+            "description": self.descriptions[self.description_ids[row]],
+            "gst_rate": self._rate(row)
+        }
+    
+    def get(self, code):
+        """
+        Look up an exact HSN code
+        
+        Args:
+            code (str): HSN code
+        
+        Returns:
+            dict: Catalogue entry, or None if the code is not listed
+        """
+        node = self._walk(str(code).strip())
+        if node is None or None not in node:
+            return None
+        return self.entry(node[None])
+    
+    def lookup(self, code):
+        """
+        Find the most specific listed code that the given code falls under, e.g.
+        the heading 1905 for the tariff item 19053100 if only the heading is listed
+        
+        Args:
+            code (str): HSN code
+        
+        Returns:
+            dict: Catalogue entry of the longest listed prefix, or None if not even
+                the chapter is listed
+        """
+        row = self._longest_prefix(str(code).strip())
+        return None if row is None else self.entry(row)
+    
+    def rate(self, code):
+        """
+        Get the GST rate of an HSN code, inherited from its heading or chapter
+        when the code itself is not listed or has no rate
+        
+        Args:
+            code (str): HSN code
+        
+        Returns:
+            float: GST rate, or None if unknown
+        """
+        row = self._longest_prefix(str(code).strip())
+        return None if row is None else self._rate(row)
+    
+    def has_rate(self, row):
+        """Check whether a row has a GST rate, its own or an inherited one."""
+        return not np.isnan(self.effective_rates[row])
+    
+    def under(self, prefix):
+        """
+        List every code under a chapter, heading or sub-heading
+        
+        Args:
+            prefix (str): Code prefix
+        
+        Returns:
+            list: Catalogue entries in code order
+        """
+        prefix = str(prefix).strip()
+        start = np.searchsorted(self.codes, prefix, side="left")
+        end = np.searchsorted(self.codes, prefix + "\uffff", side="left")
+        return [self.entry(row) for row in range(start, end)]
+    
+    def description(self, row):
+        """Get the description of a catalogue row."""
+        return self.descriptions[self.description_ids[row]]
+    
+    def word_candidates(self, text, min_length=4):
+        """
+        Find the rows with a description word (of at least min_length characters)
+        that appears anywhere in the text
+        
+        Args:
+            text (str): Lowercased text, e.g. an item name
+            min_length (int, optional): Shortest description word considered; the
+                index holds words of 4 or more characters
+        
+        Returns:
+            set: Row positions
+        """
+        if self._word_index is None:
+            self._build_word_index()
+        
+        # Description words match anywhere in the text, not just whole words,
+        # so look up every substring that is long enough to be an indexed word
+        min_length = max(min_length, 4)
+        candidates = set()
+        for start in range(len(text) - min_length + 1):
+            for end in range(start + min_length, min(start + self._max_word, len(text)) + 1):
+                rows = self._word_index.get(text[start:end])
+                if rows:
+                    candidates |= rows
+        
+        return candidates
+    
+    def _rate(self, row):
+        """Effective GST rate of a row."""
+        rate = float(self.effective_rates[row])
+        if np.isnan(rate):
+            return None
+        return int(rate) if rate.is_integer() else rate
+    
+    def _build_trie(self):
+        """
+        Build a trie over the codes' 2-digit levels (chapter, heading,
+        sub-heading, tariff item) and resolve inherited rates. Codes are sorted,
+        so every chapter and heading is inserted before the codes under it.
+        """
+        trie = {}
+        rates = self.rates.tolist()
+        
+        for row, code in enumerate(self.codes.tolist()):
+            node = trie
+            inherited = math.nan
+            for level in _levels(code):
+                if None in node and not math.isnan(rates[node[None]]):
+                    inherited = rates[node[None]]
+                node = node.setdefault(level, {})
+            
+            # The first row wins if a code is listed twice
+            node.setdefault(None, row)
+            if math.isnan(rates[row]):
+                rates[row] = inherited
+        
+        if self.effective_rates is None:
+            self.effective_rates = np.array(rates, dtype=np.float32)
+        self._trie = trie
+    
+    def _build_word_index(self):
+        """Index the rows by the lowercased words of their descriptions."""
+        index = {}
+        lowered = [description.lower().split() for description in self.descriptions]
+        for row, description_id in enumerate(self.description_ids.tolist()):
+            for word in lowered[description_id]:
+                if len(word) > 3:
+                    index.setdefault(word, set()).add(row)
+        
+        self._max_word = max(map(len, index), default=0)
+        self._word_index = index
+    
+    def _walk(self, code):
+        """Follow a code through the trie; returns its node or None."""
+        if self._trie is None:
+            self._build_trie()
+        
+        node = self._trie
+        for level in _levels(code):
+            node = node.get(level)
+            if node is None:
+                return None
+        return node
+    
+    def _longest_prefix(self, code):
+        """Row of the longest listed prefix of a code, or None."""
+        if self._trie is None:
+            self._build_trie()
+        
+        node = self._trie
+        row = None
+        for level in _levels(code):
+            node = node.get(level)
+            if node is None:
+                break
+            row = node.get(None, row)
+        return row
+
+def _parse_rate(code, rate):
+    """Check a GST rate given for an HSN code and return it as a float."""
+    try:
+        if isinstance(rate, bool):
+            raise TypeError
+        value = float(rate)
+    except (TypeError, ValueError):
+        raise ValueError(f"GST rate for HSN code {code} is not a number: {rate!r}")
+    
+    if not math.isfinite(value) or value < 0:
+        raise ValueError(f"GST rate for HSN code {code} must be a non-negative number: {rate!r}")
+    return value
+
+def _levels(code):
+    """Split a code into its 2-digit levels, e.g. "190531" -> ["19", "05", "31"]."""
+    return [code[start:start + 2] for start in range(0, len(code), 2)]
+
+def load_catalogue(csv_path=HSN_CSV, snapshot_path=HSN_SNAPSHOT):
+    """
+    Load the HSN catalogue from its binary snapshot, rebuilding the snapshot
+    from the CSV master, one version later, when the CSV is newer
+    
+    Args:
+        csv_path (str, optional): HSN master CSV; the default codes are written
+            there if it does not exist
+        snapshot_path (str, optional): Binary snapshot path
+    
+    Returns:
+        HSNCatalogue: The catalogue
+    """
+    if not os.path.exists(csv_path):
+        directory = os.path.dirname(csv_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["hsn_code", "description", "gst_rate"])
+            writer.writerows(DEFAULT_HSN_CODES)
+    
+    previous_version = 0
+    if os.path.exists(snapshot_path):
+        try:
+            if os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path):
+                return HSNCatalogue.load(snapshot_path)
+            
+            with np.load(snapshot_path, allow_pickle=False) as snapshot:
+                previous_version = int(snapshot["version"])
+        except Exception as e:
+            print(f"Error loading HSN snapshot, rebuilding it: {e}")
+    
+    # The CSV has changed since the snapshot was written
+    catalogue = HSNCatalogue.from_csv(csv_path, version=previous_version + 1)
+    try:
+        catalogue.save(snapshot_path)
+    except Exception as e:
+        print(f"Error saving HSN snapshot: {e}")
+    return catalogue
+
+class HSNRegistry:
+    def __init__(self, csv_path=HSN_CSV, snapshot_path=HSN_SNAPSHOT, check_interval=None, catalogue=None):
+        """
+        Initialize the holder of the current HSN catalogue. Catalogues are never
+        modified: a change produces a new version that replaces the current one
+        in a single assignment, so a caller that takes registry.catalogue once
+        sees one consistent version throughout.
+        
+        Args:
+            csv_path (str, optional): HSN master CSV
+            snapshot_path (str, optional): Binary snapshot path
+            check_interval (float, optional): Seconds between checks of the CSV and
+                snapshot for changes made by other processes; 0 disables the checks.
+                Defaults to the HSN_RELOAD_INTERVAL environment variable, or 30.
+            catalogue (HSNCatalogue, optional): Serve this catalogue instead of
+                loading the files; updates then stay in memory
+        """
+        if check_interval is None:
+            check_interval = float(os.environ.get("HSN_RELOAD_INTERVAL", 30))
+        
+        self.csv_path = csv_path
+        self.snapshot_path = snapshot_path
+        self.check_interval = check_interval
+        
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._next_check = 0
+        self._file_state = None
+        
+        if catalogue is None:
+            catalogue = load_catalogue(csv_path, snapshot_path)
+            self._file_state = self._stat()
+        self.catalogue = catalogue
+        self.loaded_at = time.time()
+    
+    @property
+    def version(self):
+        """Version of the current catalogue."""
+        return self.catalogue.version
+    
+    def subscribe(self, callback):
+        """
+        Call a function with the new catalogue whenever it is replaced
+        
+        Args:
+            callback (callable): Function taking an HSNCatalogue
+        """
+        self._listeners.append(callback)
+    
+    def maybe_reload(self):
+        """
+        Reload the catalogue if its files have changed. The files are checked at
+        most every check_interval seconds, so this is cheap enough to call
+        before every classification.
+        
+        Returns:
+            bool: True if a new catalogue was swapped in
+        """
+        if self._file_state is None or self.check_interval <= 0:
+            return False
+        
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        
+        if self._stat() == self._file_state:
+            return False
+        return self.reload()
+    
+    def reload(self):
+        """
+        Load the catalogue from its files again, e.g. after the HSN master CSV
+        has been replaced
+        
+        Returns:
+            bool: True if a new version was swapped in
+        """
+        if self._file_state is None:
+            return False
+        
+        with self._lock:
+            catalogue = load_catalogue(self.csv_path, self.snapshot_path)
+            self._file_state = self._stat()
+            if catalogue.version == self.catalogue.version:
+                return False
+            self._swap(catalogue)
+            return True
+    
+    def update_rates(self, rates):
+        """
+        Change GST rates, e.g. after a GST Council notification, and swap in the
+        new catalogue. The CSV and snapshot are rewritten so that other
+        processes pick the change up too.
+        
+        Args:
+            rates (dict): HSN code -> new GST rate (None to inherit)
+        
+        Returns:
+            int: New catalogue version
+        """
+        with self._lock:
+            catalogue = self.catalogue.with_rates(rates)
+            if self._file_state is not None:
+                # The snapshot is written last so it is never older than the CSV
+                catalogue.to_csv(self.csv_path)
+                catalogue.save(self.snapshot_path)
+                self._file_state = self._stat()
+            self._swap(catalogue)
+            return catalogue.version
+    
+    def _swap(self, catalogue):
+        """Replace the current catalogue and notify the subscribers."""
+        self.catalogue = catalogue
+        self.loaded_at = time.time()
+        print(f"HSN catalogue version {catalogue.version} loaded ({len(catalogue)} codes)")
+        
+        for callback in self._listeners:
+            try:
+                callback(catalogue)
+            except Exception as e:
+                print(f"Error notifying HSN catalogue subscriber: {e}")
+    
+    def _stat(self):
+        """Modification times of the CSV and snapshot."""
+        return tuple(
+            os.stat(path).st_mtime_ns if os.path.exists(path) else None
+            for path in (self.csv_path, self.snapshot_path)
+        )
+
+# One catalogue per process, shared by the classifier and the database client
+_shared_registry = None
+_shared_registry_lock = threading.Lock()
+
+def get_shared_registry():
+    """
+    Get the process-wide HSN registry, loading the catalogue on first use
+    
+    Returns:
+        HSNRegistry: Registry over data/hsn_codes.csv and data/hsn_catalogue.npz
+    """
+    global _shared_registry
+    with _shared_registry_lock:
+        if _shared_registry is None:
+            _shared_registry = HSNRegistry()
+        return _shared_registry
@@ -0,0 +1,147 @@
+import re
+import numpy as np
+
+# SciPy is optional; without it the scores are accumulated from posting lists
+try:
+    from scipy import sparse
+    scipy_available = True
+except ImportError:
+    scipy_available = False
+
+class HSNVectorMatcher:
+    def __init__(self, descriptions, ngram_range=(3, 3), chunk_size=256):
+        """
+        Initialize a batch matcher that scores item names against HSN
+        descriptions by cosine similarity of character n-gram TF-IDF vectors
+        
+        Args:
+            descriptions (list): HSN descriptions, in table order
+            ngram_range (tuple, optional): Smallest and largest n-gram length
+            chunk_size (int, optional): Items scored per matrix product, bounding
+                the dense score block to chunk_size x len(descriptions)
+        """
+        self.ngram_range = ngram_range
+        self.chunk_size = chunk_size
+        self.size = len(descriptions)
+        self.vocabulary = {}
+        
+        rows, columns, counts = self._count_ngrams(descriptions, grow=True)
+        
+        # Smoothed inverse document frequency, as in scikit-learn's TfidfVectorizer
+        document_frequency = np.bincount(columns, minlength=len(self.vocabulary))
+        self.idf = (np.log((1 + self.size) / (1 + document_frequency)) + 1).astype(np.float32)
+        
+        weights = self._normalize(rows, counts * self.idf[columns], self.size)
+        
+        if scipy_available:
+            self._matrix = sparse.csr_matrix(
+                (weights, (rows, columns)), shape=(self.size, len(self.vocabulary)), dtype=np.float32
+            )
+        else:
+            # Posting list per n-gram: the description rows containing it and their weights
+            order = np.argsort(columns, kind="stable")
+            bounds = np.searchsorted(columns[order], np.arange(len(self.vocabulary) + 1))
+            self._postings = [
+                (rows[order[start:end]], weights[order[start:end]])
+                for start, end in zip(bounds[:-1], bounds[1:])
+            ]
+    
+    def match(self, item_names, top_k=5):
+        """
+        Find the most similar HSN descriptions for many items at once
+        
+        Args:
+            item_names (list): Item names
+            top_k (int, optional): Candidates returned per item
+        
+        Returns:
+            list: One list per item of (description row, score) tuples, best first,
+                with scores between 0 and 1; rows with no shared n-gram are left out
+        """
+        top_k = min(top_k, self.size)
+        results = []
+        for start in range(0, len(item_names), self.chunk_size):
+            scores = self._scores(item_names[start:start + self.chunk_size])
+            if top_k == 0:
+                results.extend([] for _ in range(len(scores)))
+                continue
+            
+            best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            
+            for rows, row_scores in zip(best.tolist(), best_scores.tolist()):
+                results.append([(row, score) for row, score in zip(rows, row_scores) if score > 0])
+        
+        return results
+    
+    def _scores(self, item_names):
+        """Cosine similarity of each item name with every description, as a dense block."""
+        rows, columns, counts = self._count_ngrams(item_names, grow=False)
+        weights = self._normalize(rows, counts * self.idf[columns], len(item_names))
+        
+        if scipy_available:
+            # A sparse-by-dense product writes the scores straight into a dense
+            # block, which is much faster than a sparse-by-sparse product whose
+            # result is nearly dense anyway
+            query = np.zeros((len(self.vocabulary), len(item_names)), dtype=np.float32)
+            query[columns, rows] = weights
+            return np.ascontiguousarray((self._matrix @ query).T)
+        
+        # Gather the postings of every (item, n-gram) pair and sum them per
+        # (item, description) cell in one bincount
+        postings = [self._postings[column] for column in columns.tolist()]
+        lengths = np.array([len(description_rows) for description_rows, _ in postings], dtype=np.int64)
+        if not lengths.sum():
+            return np.zeros((len(item_names), self.size), dtype=np.float32)
+        
+        cells = np.repeat(rows * self.size, lengths) + np.concatenate([description_rows for description_rows, _ in postings])
+        values = np.repeat(weights, lengths) * np.concatenate([description_weights for _, description_weights in postings])
+        scores = np.bincount(cells, weights=values, minlength=len(item_names) * self.size)
+        return scores.reshape(len(item_names), self.size).astype(np.float32)
+    
+    def _count_ngrams(self, texts, grow):
+        """
+        Count the character n-grams of each text
+        
+        Args:
+            texts (list): Texts to vectorise
+            grow (bool): Add unseen n-grams to the vocabulary instead of dropping them
+        
+        Returns:
+            tuple: (text rows, vocabulary columns, counts) as NumPy arrays
+        """
+        rows, columns, counts = [], [], []
+        smallest, largest = self.ngram_range
+        
+        for row, text in enumerate(texts):
+            text_counts = {}
+            # N-grams are taken within words padded with spaces, so word starts and
+            # ends count but n-grams never span two words
+            for word in re.findall(r'\w+', str(text).lower()):
+                padded = f" {word} "
+                for n in range(smallest, largest + 1):
+                    for start in range(len(padded) - n + 1):
+                        ngram = padded[start:start + n]
+                        column = self.vocabulary.get(ngram)
+                        if column is None:
+                            if not grow:
+                                continue
+                            column = self.vocabulary[ngram] = len(self.vocabulary)
+                        text_counts[column] = text_counts.get(column, 0) + 1
+            
+            rows.extend([row] * len(text_counts))
+            columns.extend(text_counts)
+            counts.extend(text_counts.values())
+        
+        return (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64),
+                np.array(counts, dtype=np.float32))
+    
+    @staticmethod
+    def _normalize(rows, weights, size):
+        """Scale each row's weights to unit length."""
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=size))
+        norms[norms == 0] = 1
+        return (weights / norms[rows]).astype(np.float32)
@@ -0,0 +1,125 @@
+from collections import deque
+
+# Suffixes a keyword may carry and still count as a whole-word match, so that
+# "biscuit" matches "biscuits" but "ac" does not match "packet"
+PLURAL_SUFFIXES = ("s", "es")
+
+class KeywordAutomaton:
+    def __init__(self, keywords=None):
+        """
+        Initialize an Aho-Corasick automaton that finds every occurrence of a
+        set of keywords in one pass over the text
+        
+        Args:
+            keywords (iterable, optional): (keyword, value) pairs to add
+        """
+        # Trie transitions, failure links and the keyword ids ending at each state
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._keywords = []
+        self._built = False
+        
+        for keyword, value in keywords or ():
+            self.add(keyword, value)
+    
+    def __len__(self):
+        return len(self._keywords)
+    
+    def add(self, keyword, value):
+        """
+        Add a keyword to the automaton
+        
+        Args:
+            keyword (str): Keyword to search for (matched case-sensitively)
+            value: Value reported when the keyword is found
+        """
+        if not keyword:
+            return
+        
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        
+        self._output[state].append(len(self._keywords))
+        self._keywords.append((keyword, value))
+        self._built = False
+    
+    def build(self):
+        """Compute the failure links; called automatically before the first search."""
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                
+                # Keywords that are suffixes of this one end here too
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        
+        self._built = True
+    
+    def find(self, text, whole_words=True):
+        """
+        Find every keyword occurrence in the text
+        
+        Args:
+            text (str): Text to search
+            whole_words (bool, optional): Only report keywords that start and end on
+                a word boundary (a plural suffix is allowed before the end)
+        
+        Returns:
+            list: (start, end, keyword index, value) tuples in order of their end
+                position; the keyword index is the order the keyword was added in
+        """
+        if not self._built:
+            self.build()
+        
+        matches = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            
+            for index in self._output[state]:
+                keyword, value = self._keywords[index]
+                start = position + 1 - len(keyword)
+                end = position + 1
+                if whole_words and not _on_word_boundaries(text, start, end):
+                    continue
+                matches.append((start, end, index, value))
+        
+        return matches
+
+def _on_word_boundaries(text, start, end):
+    """Check that text[start:end] is a whole word, allowing a plural suffix."""
+    if start > 0 and text[start - 1].isalnum():
+        return False
+    
+    if end == len(text) or not text[end].isalnum():
+        return True
+    
+    for suffix in PLURAL_SUFFIXES:
+        if text.startswith(suffix, end):
+            after = end + len(suffix)
+            if after == len(text) or not text[after].isalnum():
+                return True
+    
+    return False
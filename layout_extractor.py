@@ -0,0 +1,355 @@
+import re
+import html
+from statistics import median
+
+# Header labels used to locate the quantity, unit price and total columns
+HEADER_KEYWORDS = {
+    "qty": ["qty", "quantity", "nos", "pcs", "units"],
+    "unit_price": ["rate", "price", "unit price", "mrp", "unit"],
+    "total": ["amount", "total", "value", "amt"],
+    "hsn": ["hsn", "sac", "hsn/sac"],
+    "item": ["item", "description", "particulars", "product", "goods"]
+}
+
+# Rows starting with these words summarise the invoice rather than list an item
+SUMMARY_WORDS = ("total", "subtotal", "sub total", "grand total", "cgst", "sgst", "igst",
+                 "tax", "discount", "round off", "balance", "amount in words")
+
+NUMBER_PATTERN = re.compile(r'^[₹$€]?\(?-?\d[\d,]*(?:\.\d+)?\)?%?$')
+
+def words_to_text(words):
+    """
+    Rebuild plain text from OCR word boxes, one text line per line and a blank
+    line between blocks
+
+    Args:
+        words (list): Word dictionaries in reading order
+
+    Returns:
+        str: Reconstructed text
+    """
+    lines = []
+    current_line = None
+    current_block = None
+
+    for word in words:
+        if word["block"] != current_block and lines:
+            lines.append("")
+        if word["block"] != current_block or word["line"] != current_line:
+            lines.append(word["text"])
+        else:
+            lines[-1] += " " + word["text"]
+        current_block = word["block"]
+        current_line = word["line"]
+
+    return "\n".join(lines)
+
+def parse_bbox_layout(xhtml):
+    """
+    Parse the output of pdftotext -bbox-layout into word dictionaries
+
+    Args:
+        xhtml (str): pdftotext -bbox-layout output
+
+    Returns:
+        list: Word dictionaries with a 1-based "page" number
+    """
+    words = []
+    page = block = line = 0
+    token_pattern = re.compile(
+        r'<(page|block|line)\b[^>]*>|<word xMin="([\d.]+)" yMin="([\d.]+)" xMax="([\d.]+)" yMax="([\d.]+)">(.*?)</word>'
+    )
+
+    for match in token_pattern.finditer(xhtml):
+        tag = match.group(1)
+        if tag == "page":
+            page += 1
+        elif tag == "block":
+            block += 1
+        elif tag == "line":
+            line += 1
+        else:
+            x_min, y_min, x_max, y_max = (float(match.group(i)) for i in range(2, 6))
+            words.append({
+                "page": page,
+                "text": html.unescape(match.group(6)),
+                "left": x_min,
+                "top": y_min,
+                "width": x_max - x_min,
+                "height": y_max - y_min,
+                "conf": 100.0,
+                "block": block,
+                "line": line
+            })
+
+    return words
+
+def _parse_number(text):
+    """
+    Parse a numeric table cell such as "1,250.00" or "₹45"
+
+    Args:
+        text (str): Cell text
+
+    Returns:
+        float: Parsed value, or None if the cell is not numeric
+    """
+    text = text.strip()
+    if not NUMBER_PATTERN.match(text):
+        return None
+    try:
+        return float(re.sub(r'[^\d.\-]', '', text))
+    except ValueError:
+        return None
+
+class LayoutExtractor:
+    def __init__(self, min_confidence=30, row_tolerance=0.6, cell_gap=1.2):
+        """
+        Initialize the layout-aware line item extractor
+
+        Args:
+            min_confidence (float, optional): Words recognised with lower confidence are ignored
+            row_tolerance (float, optional): Maximum vertical distance between word
+                centres on the same row, relative to the median word height
+            cell_gap (float, optional): Horizontal gap, relative to the median word
+                height, above which neighbouring words belong to different cells
+        """
+        self.min_confidence = min_confidence
+        self.row_tolerance = row_tolerance
+        self.cell_gap = cell_gap
+
+    def extract_items(self, words):
+        """
+        Extract line items by rebuilding the invoice table from word positions
+
+        Args:
+            words (list): Word dictionaries with "page", "text", "left", "top",
+                "width", "height" and "conf"
+
+        Returns:
+            list: List of dictionaries containing item details
+        """
+        items = []
+        pages = {}
+        for word in words:
+            if word["text"].strip() and float(word.get("conf", 100)) >= self.min_confidence:
+                pages.setdefault(word.get("page", 1), []).append(word)
+
+        for page_number in sorted(pages):
+            items.extend(self._extract_page_items(pages[page_number]))
+
+        return items
+
+    def _extract_page_items(self, words):
+        """
+        Extract line items from the words of a single page
+
+        Args:
+            words (list): Word dictionaries on one page
+
+        Returns:
+            list: List of dictionaries containing item details
+        """
+        word_height = median(word["height"] for word in words) or 1
+        rows = [self._split_cells(row, word_height) for row in self._group_rows(words, word_height)]
+
+        columns = None
+        items = []
+        for cells in rows:
+            header = self._match_header(cells)
+            if header:
+                columns = header
+                continue
+
+            row_text = " ".join(cell["text"] for cell in cells).lower()
+            if row_text.startswith(SUMMARY_WORDS):
+                # Summary rows end the table that the current header described
+                columns = None
+                continue
+
+            item = self._row_to_item(cells, columns)
+            if item:
+                items.append(item)
+
+        return items
+
+    def _group_rows(self, words, word_height):
+        """
+        Group words into table rows by vertical position
+
+        Args:
+            words (list): Word dictionaries on one page
+            word_height (float): Median word height on the page
+
+        Returns:
+            list: Rows, top to bottom, each a list of words sorted left to right
+        """
+        rows = []
+        for word in sorted(words, key=lambda w: w["top"] + w["height"] / 2):
+            centre = word["top"] + word["height"] / 2
+            if rows and abs(centre - rows[-1]["centre"]) <= self.row_tolerance * word_height:
+                row = rows[-1]
+                row["words"].append(word)
+                row["centre"] += (centre - row["centre"]) / len(row["words"])
+            else:
+                rows.append({"centre": centre, "words": [word]})
+
+        return [sorted(row["words"], key=lambda w: w["left"]) for row in rows]
+
+    def _split_cells(self, row, word_height):
+        """
+        Merge the words of a row into cells separated by wide horizontal gaps
+
+        Args:
+            row (list): Words sorted left to right
+            word_height (float): Median word height on the page
+
+        Returns:
+            list: Cell dictionaries with "text", "left" and "right"
+        """
+        cells = []
+        for word in row:
+            right = word["left"] + word["width"]
+            if cells and word["left"] - cells[-1]["right"] <= self.cell_gap * word_height:
+                cells[-1]["text"] += " " + word["text"]
+                cells[-1]["right"] = right
+            else:
+                cells.append({"text": word["text"], "left": word["left"], "right": right})
+        return cells
+
+    def _match_header(self, cells):
+        """
+        Recognise a table header row and record where each column sits
+
+        Args:
+            cells (list): Cells of one row
+
+        Returns:
+            dict: Column name to (left, right) extent, or None if the row is not a header
+        """
+        columns = {}
+        for cell in cells:
+            label = cell["text"].lower().strip(" .:")
+            for column, keywords in HEADER_KEYWORDS.items():
+                if column not in columns and any(label == k or label.startswith(k + " ") for k in keywords):
+                    columns[column] = (cell["left"], cell["right"])
+                    break
+
+        if "total" in columns and ("qty" in columns or "unit_price" in columns):
+            return columns
+        return None
+
+    def _row_to_item(self, cells, columns):
+        """
+        Map the cells of a row to item, qty, unit_price and total
+
+        Args:
+            cells (list): Cells of one row
+            columns (dict): Column extents from the table header, or None
+
+        Returns:
+            dict: Item details, or None if the row is not a line item
+        """
+        numbers = []
+        name_parts = []
+        for cell in cells:
+            if cell["text"].endswith("%"):
+                # Tax rate columns are not part of the item amounts
+                continue
+            value = _parse_number(cell["text"])
+            if value is None:
+                if not numbers:
+                    name_parts.append(cell["text"])
+                continue
+            if not name_parts:
+                # Leading serial number column
+                continue
+            if columns and self._nearest_column(cell, columns) == "hsn":
+                continue
+            if not columns and not numbers and re.fullmatch(r'\d{4}(?:\d{2}){0,2}', cell["text"]):
+                # An unlabelled 4/6/8-digit code right after the description is an HSN code
+                continue
+            numbers.append((cell, value))
+
+        item_name = " ".join(name_parts).strip()
+        if len(item_name) < 2 or not numbers:
+            return None
+
+        qty = unit_price = total = None
+        if columns:
+            for cell, value in numbers:
+                column = self._nearest_column(cell, columns)
+                if column == "total":
+                    total = value
+                elif column == "unit_price":
+                    unit_price = value
+                elif column == "qty":
+                    qty = value
+
+        if total is None:
+            # No usable header: the last number is the amount, and the quantity and
+            # rate are the pair of earlier numbers whose product matches it
+            total = numbers[-1][1]
+            values = [value for _, value in numbers[:-1]]
+            for i in range(len(values)):
+                for j in range(i + 1, len(values)):
+                    if abs(values[i] * values[j] - total) <= max(1, total * 0.01):
+                        qty, unit_price = values[i], values[j]
+                        break
+                if qty is not None:
+                    break
+
+            if qty is None and not columns:
+                # Without a header, "label ... number" lines such as phone numbers,
+                # dates and GSTINs look just like items; only a qty x rate = amount
+                # row is trusted
+                return None
+
+        if total is None or total <= 0:
+            return None
+
+        if qty is None and unit_price is None:
+            qty, unit_price = 1, total
+        elif qty is None:
+            qty = round(total / unit_price, 3) if unit_price else 1
+        elif unit_price is None:
+            unit_price = total / qty if qty else total
+
+        return {
+            "item": item_name,
+            "qty": qty,
+            "unit_price": unit_price,
+            "total": total
+        }
+
+    def _nearest_column(self, cell, columns):
+        """
+        Find the header column a numeric cell sits under
+
+        Args:
+            cell (dict): Table cell
+            columns (dict): Column extents from the table header
+
+        Returns:
+            str: Column name, or None if the cell is not under any amount column
+        """
+        centre = (cell["left"] + cell["right"]) / 2
+        best_column = None
+        best_distance = None
+
+        for column in ("qty", "unit_price", "total", "hsn"):
+            extent = columns.get(column)
+            if extent is None:
+                continue
+
+            # Numbers are usually right-aligned under their header, so allow some slack
+            slack = max(extent[1] - extent[0], cell["right"] - cell["left"])
+            if cell["left"] > extent[1] + slack or cell["right"] < extent[0] - slack:
+                continue
+
+            distance = abs(centre - (extent[0] + extent[1]) / 2)
+            if best_distance is None or distance < best_distance:
+                best_column = column
+                best_distance = distance
+
+        return best_column
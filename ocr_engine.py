@@ -0,0 +1,285 @@
+import os
+import threading
+import importlib.util
+import pytesseract
+
+# tesserocr binds libtesseract directly, so a loaded model can be reused
+# across pages. It is optional; pytesseract is used when it is missing.
+# It is only imported when a TesserocrEngine is created: its OpenMP runtime
+# reads OMP_THREAD_LIMIT once, when loaded, so the limit has to be set first.
+tesserocr_available = importlib.util.find_spec("tesserocr") is not None
+tesserocr = None
+
+def _import_tesserocr():
+    """Import tesserocr on first use."""
+    global tesserocr
+    if tesserocr is None:
+        import tesserocr as module
+        tesserocr = module
+    return tesserocr
+
+class PytesseractEngine:
+    name = "pytesseract"
+    
+    def __init__(self, lang='eng'):
+        """
+        Initialize an OCR engine that runs the tesseract CLI once per page
+        through pytesseract
+        
+        Args:
+            lang (str, optional): Tesseract language code
+        """
+        self.lang = lang
+    
+    def version(self):
+        """
+        Get the engine version, used to key cached OCR results
+        
+        Returns:
+            str: Engine name and Tesseract version
+        """
+        return f"{self.name}-{pytesseract.get_tesseract_version()}"
+    
+    def image_to_string(self, image, psm=None):
+        """
+        Recognise the text in an image
+        
+        Args:
+            image (PIL.Image): Image to OCR
+            psm (int, optional): Tesseract page segmentation mode; Tesseract's default if None
+        
+        Returns:
+            str: Extracted text
+        """
+        return pytesseract.image_to_string(image, lang=self.lang, config=self._config(psm))
+    
+    def image_to_data(self, image, psm=None):
+        """
+        Recognise the words in an image along with their bounding boxes
+        
+        Args:
+            image (PIL.Image): Image to OCR
+            psm (int, optional): Tesseract page segmentation mode; Tesseract's default if None
+        
+        Returns:
+            list: Word dictionaries with "text", "left", "top", "width", "height",
+                "conf", "block" and "line", in reading order
+        """
+        data = pytesseract.image_to_data(
+            image, lang=self.lang, config=self._config(psm), output_type=pytesseract.Output.DICT
+        )
+        
+        words = []
+        line_numbers = {}
+        for i, text in enumerate(data["text"]):
+            if data["level"][i] != 5 or not text.strip():
+                continue
+            
+            # Tesseract numbers lines within paragraphs within blocks; flatten to a page-wide line number
+            line_key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            line_numbers.setdefault(line_key, len(line_numbers) + 1)
+            
+            words.append({
+                "text": text,
+                "left": data["left"][i],
+                "top": data["top"][i],
+                "width": data["width"][i],
+                "height": data["height"][i],
+                "conf": float(data["conf"][i]),
+                "block": data["block_num"][i],
+                "line": line_numbers[line_key]
+            })
+        
+        return words
+    
+    def _config(self, psm):
+        """Build the tesseract command line options for a page segmentation mode"""
+        return f"--psm {psm}" if psm is not None else ""
+
+class TesserocrEngine:
+    name = "tesserocr"
+    
+    def __init__(self, lang='eng'):
+        """
+        Initialize an OCR engine that keeps a libtesseract instance, and its
+        language model, loaded for the lifetime of the process
+        
+        Args:
+            lang (str, optional): Tesseract language code
+        """
+        if not tesserocr_available:
+            raise ImportError("tesserocr is not installed")
+        _import_tesserocr()
+        
+        self.lang = lang
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+        # A Tesseract API instance holds per-image state, so calls from
+        # different threads must not interleave
+        self._lock = threading.Lock()
+    
+    def version(self):
+        """
+        Get the engine version, used to key cached OCR results
+        
+        Returns:
+            str: Engine name and Tesseract version
+        """
+        return f"{self.name}-{tesserocr.tesseract_version().split()[1]}"
+    
+    def image_to_string(self, image, psm=None):
+        """
+        Recognise the text in an image
+        
+        Args:
+            image (PIL.Image): Image to OCR
+            psm (int, optional): Tesseract page segmentation mode; Tesseract's default if None
+        
+        Returns:
+            str: Extracted text
+        """
+        with self._lock:
+            self.api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+            self.api.SetImage(image)
+            return self.api.GetUTF8Text()
+    
+    def image_to_data(self, image, psm=None):
+        """
+        Recognise the words in an image along with their bounding boxes
+        
+        Args:
+            image (PIL.Image): Image to OCR
+            psm (int, optional): Tesseract page segmentation mode; Tesseract's default if None
+        
+        Returns:
+            list: Word dictionaries with "text", "left", "top", "width", "height",
+                "conf", "block" and "line", in reading order
+        """
+        level = tesserocr.RIL.WORD
+        words = []
+        block = line = 0
+        
+        with self._lock:
+            self.api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+            self.api.SetImage(image)
+            self.api.Recognize()
+            
+            for word in tesserocr.iterate_level(self.api.GetIterator(), level):
+                if word.IsAtBeginningOf(tesserocr.RIL.BLOCK):
+                    block += 1
+                if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                    line += 1
+                
+                text = word.GetUTF8Text(level)
+                if not text or not text.strip():
+                    continue
+                
+                left, top, right, bottom = word.BoundingBox(level)
+                words.append({
+                    "text": text,
+                    "left": left,
+                    "top": top,
+                    "width": right - left,
+                    "height": bottom - top,
+                    "conf": word.Confidence(level),
+                    "block": block,
+                    "line": line
+                })
+        
+        return words
+
+ENGINES = {
+    PytesseractEngine.name: PytesseractEngine,
+    TesserocrEngine.name: TesserocrEngine,
+}
+
+# OCR engines are selected with the OCR_ENGINE environment variable:
+#   tesserocr    Keeps libtesseract and its language model loaded for the life
+#                of the process. Needs the optional "ocr" extra
+#                (pip install ".[ocr]").
+#   pytesseract  Runs the tesseract CLI, starting a new process for every page.
+# When OCR_ENGINE is not set, tesserocr is used if it is installed.
+PYTESSERACT_NOTE = "pytesseract starts a tesseract process per page; install the 'ocr' extra for tesserocr"
+
+def default_engine_name():
+    """
+    Get the engine used when none is requested
+    
+    Returns:
+        str: OCR_ENGINE if set, otherwise "tesserocr" when installed, else "pytesseract"
+    """
+    default = TesserocrEngine.name if tesserocr_available else PytesseractEngine.name
+    return os.environ.get("OCR_ENGINE") or default
+
+def create_engine(name=None, lang='eng'):
+    """
+    Create an OCR engine, falling back to pytesseract if the requested engine
+    cannot be loaded
+    
+    Args:
+        name (str, optional): Engine name. Defaults to default_engine_name().
+        lang (str, optional): Tesseract language code
+    
+    Returns:
+        An engine with version(), image_to_string(image, psm) and image_to_data(image, psm) methods
+    """
+    name = name or default_engine_name()
+    
+    if name not in ENGINES:
+        print(f"Unknown OCR engine '{name}', using {PytesseractEngine.name} ({PYTESSERACT_NOTE})")
+        name = PytesseractEngine.name
+    elif name == PytesseractEngine.name and not tesserocr_available:
+        print(f"tesserocr is not installed, using {PytesseractEngine.name} ({PYTESSERACT_NOTE})")
+    
+    try:
+        return ENGINES[name](lang=lang)
+    except Exception as e:
+        print(f"OCR engine '{name}' not available, using {PytesseractEngine.name} ({PYTESSERACT_NOTE}): {e}")
+        return PytesseractEngine(lang=lang)
+
+# Engines already loaded in this process, keyed by (name, lang). Worker
+# processes load theirs once at start-up and reuse it for every page they
+# receive.
+_process_engines = {}
+_process_engines_lock = threading.Lock()
+
+def init_worker(name, lang='eng'):
+    """
+    Initializer for OCR worker processes: load the engine once so every page
+    the worker receives reuses the loaded model
+    
+    Args:
+        name (str): Engine name
+        lang (str, optional): Tesseract language code
+    """
+    # Each worker handles one page at a time; let the pool provide the
+    # parallelism instead of Tesseract's own OpenMP threads. OCRProcessor starts
+    # workers from a fork server that never loads an engine, so tesserocr (and
+    # its OpenMP runtime) is first loaded below, after the limit is set; the
+    # tesseract CLI that pytesseract runs inherits it too. Only the workers are
+    # limited, not the process that owns the pool.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    
+    # Drop any engines (and lock state) inherited from the process the worker
+    # was forked from; they are not safe to share
+    global _process_engines, _process_engines_lock
+    _process_engines = {}
+    _process_engines_lock = threading.Lock()
+    
+    get_process_engine(name, lang)
+
+def get_process_engine(name, lang='eng'):
+    """
+    Get this process's long-lived engine, creating it on first use
+    
+    Args:
+        name (str): Engine name
+        lang (str, optional): Tesseract language code
+    
+    Returns:
+        The shared engine instance for this process
+    """
+    key = (name, lang)
+    with _process_engines_lock:
+        if key not in _process_engines:
+            _process_engines[key] = create_engine(name, lang)
+        return _process_engines[key]
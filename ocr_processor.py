@@ -1,19 +1,331 @@
 import os
 import re
-import pytesseract
+import json
+import hashlib
+import multiprocessing
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 import numpy as np
 from ai_processor import AIProcessor
+from result_cache import ResultCache
+from ocr_engine import default_engine_name, get_process_engine, init_worker
+from image_preprocessor import (ImagePreprocessor, TARGET_TEXT_HEIGHT, estimate_text_height, choose_scale,
+                                detect_table_region)
+from layout_extractor import LayoutExtractor, SUMMARY_WORDS, words_to_text, parse_bbox_layout
+
+# Region-of-interest OCR: the line-item table is read at full resolution as
+# a single uniform block of text; the header and footer, which only carry
+# invoice metadata, are read at reduced resolution as sparse text, or skipped.
+BODY_PSM = 6
+CHEAP_PSM = 11
+CHEAP_REGION_SCALE = 0.5
+MIN_REGION_HEIGHT = 20
+
+def _recognize(engine, image, layout, psm=None):
+    """
+    Run the OCR engine over one image
+    
+    Args:
+        engine: OCR engine from ocr_engine
+        image (PIL.Image): Image to OCR
+        layout (bool): Also return word bounding boxes
+        psm (int, optional): Tesseract page segmentation mode
+    
+    Returns:
+        tuple: (text, words); words is None unless layout is set
+    """
+    if layout:
+        # One recognition pass gives both the word boxes and the text
+        words = engine.image_to_data(image, psm=psm)
+        return words_to_text(words), words
+    return engine.image_to_string(image, psm=psm), None
+
+def _ocr_regions(image, engine, layout, regions):
+    """
+    OCR a page as header, table body and footer, each at its own quality
+    
+    Args:
+        image (PIL.Image): Preprocessed grayscale page
+        engine: OCR engine from ocr_engine
+        layout (bool): Also return word bounding boxes
+        regions (str): "cheap" to read the header and footer at reduced
+            resolution, "skip" to read only the table body
+    
+    Returns:
+        dict: "text", "words" (in layout mode) and the "regions" report, or None
+            if no table was found on the page
+    """
+    table = detect_table_region(np.asarray(image))
+    if table is None:
+        return None
+    
+    top, bottom = table
+    width, height = image.size
+    spans = [("header", 0, top), ("body", top, bottom), ("footer", bottom, height)]
+    
+    texts = []
+    words = [] if layout else None
+    report = {"table": [top, bottom]}
+    body_seconds = 0.0
+    other_seconds = 0.0
+    
+    for name, span_top, span_bottom in spans:
+        if span_bottom - span_top < MIN_REGION_HEIGHT:
+            continue
+        if name != "body" and regions == "skip":
+            report[name] = "skipped"
+            continue
+        
+        region_start = time.perf_counter()
+        crop = image.crop((0, span_top, width, span_bottom))
+        scale = 1.0
+        if name == "body":
+            psm = BODY_PSM
+        else:
+            psm = CHEAP_PSM
+            scale = CHEAP_REGION_SCALE
+            crop = crop.resize(
+                (max(1, round(crop.width * scale)), max(1, round(crop.height * scale))),
+                Image.BILINEAR
+            )
+        
+        text, region_words = _recognize(engine, crop, layout, psm=psm)
+        texts.append(text)
+        
+        if layout:
+            # Map word boxes back to page coordinates and keep block and line
+            # numbers unique across regions
+            block_offset = max((word["block"] for word in words), default=0)
+            line_offset = max((word["line"] for word in words), default=0)
+            for word in region_words:
+                for key in ("left", "top", "width", "height"):
+                    word[key] = round(word[key] / scale)
+                word["top"] += span_top
+                word["block"] += block_offset
+                word["line"] += line_offset
+            words.extend(region_words)
+        
+        seconds = time.perf_counter() - region_start
+        if name == "body":
+            body_seconds = seconds
+        else:
+            other_seconds += seconds
+            report[name] = "cheap"
+    
+    # OCR time grows with the area read; estimate what reading the whole page
+    # at body quality would have cost
+    full_page_seconds = body_seconds * height / max(1, bottom - top)
+    report["seconds_saved"] = max(0.0, full_page_seconds - body_seconds - other_seconds)
+    
+    return {"text": "\n".join(text for text in texts if text.strip()), "words": words, "regions": report}
+
+def _ocr_page(page_number, image, engine_name, lang, preprocessor=None, source_dpi=None,
+              resolution_fixed=False, layout=False, regions=None):
+    """
+    OCR a single rasterised page. Runs inside a worker process, so it must stay
+    a module-level function that only takes picklable arguments.
+    
+    Args:
+        page_number (int): 1-based page number
+        image (PIL.Image): Rasterised page
+        engine_name (str): OCR engine to use; loaded once per process
+        lang (str): Tesseract language code
+        preprocessor (ImagePreprocessor, optional): Preprocessing applied before OCR
+        source_dpi (float, optional): Resolution the page was rasterised at
+        resolution_fixed (bool, optional): True if source_dpi was already chosen
+            from the page's text height
+        layout (bool, optional): Also return word bounding boxes
+        regions (str, optional): Region-of-interest mode, "cheap" or "skip" (see
+            _ocr_regions). The whole page is read at full quality if None or if
+            no table is found.
+        
+    Returns:
+        dict: "page", extracted "text", OCR time in "seconds" and, in layout
+            mode, the page's "words". In region-of-interest mode, "regions"
+            reports the table span, how the header and footer were read and the
+            estimated seconds saved.
+    """
+    start = time.perf_counter()
+    
+    # Convert to grayscale
+    if image.mode != 'L':
+        image = image.convert('L')
+    
+    # Apply pre-processing
+    if preprocessor is not None:
+        image = preprocessor.process(image, source_dpi=source_dpi, resolution_fixed=resolution_fixed)
+    
+    engine = get_process_engine(engine_name, lang)
+    result = {"page": page_number}
+    
+    region_result = _ocr_regions(image, engine, layout, regions) if regions else None
+    if region_result is not None:
+        result.update(region_result)
+        if not layout:
+            del result["words"]
+    else:
+        result["text"], words = _recognize(engine, image, layout)
+        if layout:
+            result["words"] = words
+    
+    if layout:
+        for word in result["words"]:
+            word["page"] = page_number
+    
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+# Normalisation applied to OCR text before line item parsing: common OCR
+# confusions are mapped to digits, currency symbols dropped and horizontal
+# whitespace unified, in one str.translate call
+OCR_TRANSLATION = str.maketrans({
+    '|': '1',
+    'l': '1',
+    'O': '0',
+    'o': '0',
+    '₹': None,
+    '$': None,
+    '€': None,
+    '\t': ' ',
+    '\r': ' ',
+    '\f': ' ',
+    '\v': ' '
+})
+
+# Single regex pass for the rest of the clean-up: drop other special
+# characters and squeeze runs of spaces into a two-space column gap. Line
+# breaks are kept so items can be parsed line by line.
+CLEANUP_PATTERN = re.compile(r'[^\w\s.,\-]+| {2,}')
+
+# Item line tokens: amounts such as 12, 12.50 or 1,250.00, multiplication
+# signs and unit words
+NUMBER_TOKEN = re.compile(r'\d[\d,]*(?:\.\d+)?')
+UNIT_WORDS = frozenset(['pcs', 'units', 'nos'])
+MULTIPLY_WORDS = frozenset(['x', '*'])
+
+# Minimum number of alphanumeric characters for an embedded text layer to be
+# trusted instead of running OCR on the page
+MIN_TEXT_LAYER_CHARS = 25
+
+# Adaptive resolution: pages are first rendered at PROBE_DPI (images decoded at
+# 1/PROBE_REDUCTION scale) to measure the text height, then rendered at the
+# lowest resolution that keeps text legible, within [MIN_OCR_DPI, MAX_OCR_DPI]
+PROBE_DPI = 100
+PROBE_REDUCTION = 4
+MIN_OCR_DPI = 100
+MAX_OCR_DPI = 400
+
+# Early termination: a totals line ends with the amount it states. OCR of a
+# long PDF stops once the items found so far add up to one of these amounts.
+TOTALS_PATTERN = re.compile(
+    r'^[^\S\n]*(?:grand\s*total|sub\s*-?\s*total|net\s+(?:amount|total)|invoice\s+total|'
+    r'total(?:\s+amount)?|amount\s+payable)\b.*?(\d[\d,]*(?:\.\d+)?)[^\d\n]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+TOTALS_TOLERANCE = 0.005
 
 class OCRProcessor:
-    def __init__(self):
-        # Check if Tesseract is available
-        try:
-            pytesseract.get_tesseract_version()
-        except Exception as e:
-            print(f"Tesseract not properly configured: {e}")
-            # In a production system, we might raise an exception here
+    def __init__(self, workers=None, lang='eng', page_window=None, dpi=200, cache=None,
+                 preprocessor=None, adaptive_dpi=None, engine=None, layout=None, roi=None,
+                 early_stop=None, page_budget=None, ai_extraction_mode=None):
+        """
+        Initialize the OCR processor
+        
+        Args:
+            workers (int, optional): Number of worker processes used to OCR PDF pages
+                in parallel. Defaults to the OCR_WORKERS environment variable, or the
+                CPU count. A value of 1 disables the process pool.
+            lang (str, optional): Tesseract language code
+            page_window (int, optional): Number of PDF pages rasterised at a time.
+                Defaults to the OCR_PAGE_WINDOW environment variable, or 2.
+            dpi (int, optional): Resolution used to rasterise PDF pages whose text
+                height cannot be measured, or all pages when adaptive_dpi is off
+            cache (ResultCache, optional): Cache for OCR results. Defaults to a cache
+                in data/ocr_cache.db bounded by OCR_CACHE_MAX_MB (256 MB); set the
+                OCR_CACHE environment variable to 0 to disable caching.
+            preprocessor (ImagePreprocessor, optional): Image preprocessing pipeline.
+                Defaults to the steps listed in the OCR_PREPROCESS_STEPS environment
+                variable (comma separated, all steps by default).
+            adaptive_dpi (bool, optional): Pick the OCR resolution per page from the
+                measured text height. Defaults to the OCR_ADAPTIVE_DPI environment
+                variable (enabled unless set to 0).
+            engine (str, optional): OCR engine name ("pytesseract" or "tesserocr").
+                Defaults to the OCR_ENGINE environment variable, or tesserocr when
+                the "ocr" extra is installed; falls back to pytesseract, with a
+                message, if the engine cannot be loaded.
+            layout (bool, optional): Keep word bounding boxes so line items can be
+                extracted from the table geometry. Defaults to the OCR_LAYOUT
+                environment variable (enabled unless set to 0).
+            roi (bool, optional): Locate the line-item table on each OCR'd page and
+                read only it at full quality; the header and footer are read
+                cheaply, or skipped when metadata is not requested. Defaults to
+                the OCR_ROI environment variable (disabled unless set to 1).
+            early_stop (bool, optional): Extract items as each PDF page finishes and
+                stop OCR once a totals line is found that the items add up to.
+                The remaining pages are recorded as skipped and can be read
+                later with complete_document(). Defaults to the OCR_EARLY_STOP
+                environment variable (disabled unless set to 1).
+            page_budget (int, optional): With early_stop, the maximum number of pages
+                to OCR before stopping even if the totals have not been
+                reconciled. Defaults to the OCR_PAGE_BUDGET environment variable;
+                0 or unset means no limit.
+            ai_extraction_mode (str, optional): "combined" extracts items (and
+                metadata) from the raw OCR text in one AI request; "two_step" first
+                has the AI rewrite the text, then extracts items from the rewrite.
+                Defaults to the AI_EXTRACTION_MODE environment variable, or "combined".
+        """
+        if workers is None:
+            workers = int(os.environ.get("OCR_WORKERS", os.cpu_count() or 1))
+        if page_window is None:
+            page_window = int(os.environ.get("OCR_PAGE_WINDOW", 2))
+        self.workers = max(1, workers)
+        self.lang = lang
+        self.page_window = max(1, page_window)
+        self.dpi = dpi
+        if adaptive_dpi is None:
+            adaptive_dpi = os.environ.get("OCR_ADAPTIVE_DPI", "1") != "0"
+        self.adaptive_dpi = adaptive_dpi
+        if layout is None:
+            layout = os.environ.get("OCR_LAYOUT", "1") != "0"
+        self.layout = layout
+        if roi is None:
+            roi = os.environ.get("OCR_ROI", "0") == "1"
+        self.roi = roi
+        if early_stop is None:
+            early_stop = os.environ.get("OCR_EARLY_STOP", "0") == "1"
+        self.early_stop = early_stop
+        if page_budget is None:
+            page_budget = int(os.environ.get("OCR_PAGE_BUDGET", 0))
+        self.page_budget = page_budget or None
+        self.layout_extractor = LayoutExtractor()
+        self._executor = None
+        # Request and batch threads share one processor; only one may start the pool
+        self._executor_lock = threading.Lock()
+        
+        if preprocessor is None:
+            steps = os.environ.get("OCR_PREPROCESS_STEPS", ",".join(ImagePreprocessor.STEPS)).split(",")
+            preprocessor = ImagePreprocessor(**{step: step in steps for step in ImagePreprocessor.STEPS})
+        self.preprocessor = preprocessor
+        
+        # The engine is loaded on first use, not here: the main module, and with
+        # it this processor, is imported again in the pool's worker server
+        # (see _get_executor), which must not load the engine itself
+        self.engine_name = engine or default_engine_name()
+        self._engine_version = None
+        
+        if cache is None and os.environ.get("OCR_CACHE", "1") != "0":
+            max_mb = int(os.environ.get("OCR_CACHE_MAX_MB", 256))
+            cache = ResultCache(os.path.join("data", "ocr_cache.db"), max_bytes=max_mb * 1024 * 1024)
+        self.cache = cache
+        
+        if ai_extraction_mode is None:
+            ai_extraction_mode = os.environ.get("AI_EXTRACTION_MODE", "combined")
+        self.ai_extraction_mode = ai_extraction_mode
         
         # Initialize AI processor if available
         try:
@@ -34,155 +346,732 @@ class OCRProcessor:
         Returns:
             str: Extracted text from the file
         """
+        return self.process_document(file_path, early_stop=False)["text"]
+    
+    def process_document(self, file_path, include_metadata=True, early_stop=None):
+        """
+        Process an uploaded file and report how long each page took
+        
+        Args:
+            file_path (str): Path to the uploaded file
+            include_metadata (bool, optional): In region-of-interest mode, also read
+                the page header and footer (vendor, dates, GSTIN) at reduced
+                quality; if False only the line-item table is read
+            early_stop (bool, optional): Stop OCR of a PDF once its items reconcile
+                with a totals line. Defaults to the processor's early_stop setting.
+            
+        Returns:
+            dict: Extracted "text", per-page "pages" timings and sources, word
+                boxes ("words", in layout mode), total "seconds", whether the
+                result was served from the cache, and the "skipped_pages" left
+                unread by early termination
+        """
+        if early_stop is None:
+            early_stop = self.early_stop
         file_ext = os.path.splitext(file_path)[1].lower()
+        start = time.perf_counter()
+        
+        regions = self._regions(include_metadata)
+        
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self._cache_key(file_path, regions, early_stop)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    cached["cached"] = True
+                    cached["seconds"] = time.perf_counter() - start
+                    return cached
+            except OSError as e:
+                print(f"Error reading file for cache lookup: {e}")
         
         try:
             if file_ext in ['.pdf']:
-                return self._process_pdf(file_path)
+                pages = self._process_pdf(file_path, regions, early_stop=early_stop)
             elif file_ext in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif']:
-                return self._process_image(file_path)
+                pages = [self._process_image(file_path, regions)]
             else:
                 raise ValueError(f"Unsupported file format: {file_ext}")
         except Exception as e:
             print(f"Error processing file: {e}")
-            return ""
+            pages = []
+        
+        read_pages = [page for page in pages if page["source"] != "skipped"]
+        result = {
+            "text": "\n\n".join(page["text"] for page in read_pages),
+            "pages": self._page_summaries(pages),
+            "words": [word for page in read_pages for word in page.get("words", [])],
+            "seconds": time.perf_counter() - start,
+            "cached": False,
+            "skipped_pages": [page["page"] for page in pages if page["source"] == "skipped"]
+        }
+        
+        # Only cache successful extractions so failures are retried
+        if cache_key and result["text"].strip():
+            self.cache.set(cache_key, result)
+        
+        return result
+    
+    def complete_document(self, file_path, result, include_metadata=True):
+        """
+        OCR the pages that early termination skipped and merge them into a
+        result from process_document, so the full raw text is only paid for
+        when it is needed
+        
+        Args:
+            file_path (str): Path to the file the result was produced from
+            result (dict): Result returned by process_document. Only a result that
+                still lists the skipped pages in its "pages" is written back to the
+                cache; anything partial would replace the file's cached pages and
+                words with the skipped pages' alone.
+            include_metadata (bool, optional): Same as for process_document
+        
+        Returns:
+            dict: The result, updated in place to cover every page
+        """
+        skipped = result.get("skipped_pages")
+        if not skipped:
+            return result
+        
+        from_process_document = {
+            page["page"] for page in result.get("pages", []) if page.get("source") == "skipped"
+        } == set(skipped)
+        
+        start = time.perf_counter()
+        regions = self._regions(include_metadata)
+        pages = self._process_pdf(file_path, regions, page_numbers=skipped)
+        
+        # Skipped pages always follow the pages that were read
+        result["text"] = "\n\n".join([result["text"]] + [page["text"] for page in pages])
+        result["pages"] = [
+            page for page in result["pages"] if page["source"] != "skipped"
+        ] + self._page_summaries(pages)
+        result["words"] = result["words"] + [word for page in pages for word in page.get("words", [])]
+        result["seconds"] += time.perf_counter() - start
+        result["skipped_pages"] = []
+        
+        if self.cache is not None and from_process_document:
+            try:
+                self.cache.set(self._cache_key(file_path, regions, True), result)
+            except OSError as e:
+                print(f"Error reading file for cache update: {e}")
+        
+        return result
+    
+    def _regions(self, include_metadata):
+        """Region-of-interest mode for _ocr_page, or None when ROI OCR is off"""
+        if not self.roi:
+            return None
+        return "cheap" if include_metadata else "skip"
+    
+    def _page_summaries(self, pages):
+        """Per-page statistics reported by process_document (pages without text and words)"""
+        return [
+            {key: value for key, value in page.items() if key not in ("text", "words")}
+            for page in pages
+        ]
     
-    def _process_image(self, image_path):
+    def _cache_key(self, file_path, regions=None, early_stop=False):
+        """
+        Build a content-addressed cache key from the file bytes and OCR config
+        
+        Args:
+            file_path (str): Path to the uploaded file
+            regions (str, optional): Region-of-interest mode the file is read with
+            early_stop (bool, optional): Whether OCR may stop before the last page
+            
+        Returns:
+            str: SHA-256 hex digest identifying this file under this configuration
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        
+        config = {
+            "ext": os.path.splitext(file_path)[1].lower(),
+            "lang": self.lang,
+            "dpi": self.dpi,
+            "adaptive_dpi": self.adaptive_dpi,
+            "layout": self.layout,
+            "regions": regions,
+            "early_stop": [early_stop, self.page_budget] if early_stop else False,
+            "engine": self.engine_version,
+            "min_text_layer_chars": MIN_TEXT_LAYER_CHARS,
+            "preprocessing": self.preprocessor.config()
+        }
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        
+        return digest.hexdigest()
+    
+    def _process_image(self, image_path, regions=None):
         """
         Process a single image using OCR
         
         Args:
             image_path (str): Path to the image file
+            regions (str, optional): Region-of-interest mode passed to _ocr_page
             
         Returns:
-            str: Extracted text from the image
+            dict: Page dictionary with "page", "text", "seconds", "source" and,
+                in layout and region-of-interest modes, "words" and "regions"
         """
+        start = time.perf_counter()
         try:
-            # Open image
-            image = Image.open(image_path)
+            # Open image, decoding at reduced resolution where the text allows
+            image, resolution_fixed = self._open_image(image_path)
             
             # Convert to grayscale for better OCR results
             if image.mode != 'L':
                 image = image.convert('L')
             
             # Apply some pre-processing for better OCR results
-            # This is a simple approach; more sophisticated methods could be used
-            # image = self._preprocess_image(image)
+            image = self._preprocess_image(image, resolution_fixed=resolution_fixed)
             
             # Perform OCR
-            extracted_text = pytesseract.image_to_string(image, lang='eng')
-            
-            return extracted_text
+            page = _ocr_page(1, image, self.engine_name, self.lang, layout=self.layout, regions=regions)
         except Exception as e:
             print(f"Error processing image: {e}")
-            return ""
+            page = {"page": 1, "text": ""}
+        
+        page["seconds"] = time.perf_counter() - start
+        page["source"] = "ocr"
+        return page
+    
+    def _open_image(self, image_path):
+        """
+        Open an image at the lowest resolution that keeps its text legible.
+        JPEGs are probed and decoded at reduced scale with Pillow's draft mode,
+        so large phone photos are never fully decoded.
+        
+        Args:
+            image_path (str): Path to the image file
+            
+        Returns:
+            tuple: (PIL.Image, True if the resolution was chosen from the text height)
+        """
+        image = Image.open(image_path)
+        if not self.adaptive_dpi:
+            return image, False
+        
+        full_size = image.size
+        if image.format == 'JPEG':
+            # Measure the text height on a cheap reduced-scale decode
+            probe = Image.open(image_path)
+            probe.draft('L', (full_size[0] // PROBE_REDUCTION, full_size[1] // PROBE_REDUCTION))
+            probe = np.asarray(probe.convert('L'))
+        else:
+            image = image.convert('L')
+            probe = np.asarray(image)[::PROBE_REDUCTION, ::PROBE_REDUCTION]
+        
+        text_height = estimate_text_height(probe)
+        if text_height is None:
+            return image, False
+        
+        scale = choose_scale(text_height * full_size[0] / probe.shape[1])
+        if scale < 1:
+            size = (max(1, round(full_size[0] * scale)), max(1, round(full_size[1] * scale)))
+            # For JPEGs this decodes at the smallest DCT scale at least as large as size
+            image.draft('L', size)
+            if image.size != size:
+                image = image.resize(size, Image.LANCZOS)
+        
+        return image, True
     
-    def _process_pdf(self, pdf_path):
+    def _process_pdf(self, pdf_path, regions=None, early_stop=False, page_numbers=None):
         """
-        Process a PDF file using OCR
+        Process a PDF file. Pages that carry an embedded text layer (digitally
+        generated invoices) are read directly; only the remaining pages are
+        rasterised a small window at a time and OCR'd as they are produced,
+        spread across the worker pool when more than one worker is configured.
         
         Args:
             pdf_path (str): Path to the PDF file
+            regions (str, optional): Region-of-interest mode for OCR'd pages
+            early_stop (bool, optional): Stop once the items read so far reconcile
+                with a totals line, or the page budget is spent
+            page_numbers (list, optional): Sorted 1-based pages to read; all pages if None
             
         Returns:
-            str: Extracted text from the PDF
+            list: Page dictionaries with "page", "text", "seconds", "source"
+                ("text_layer", "ocr" or "skipped") and, in layout mode, "words",
+                in page order
         """
         try:
-            # Convert PDF to images
-            images = convert_from_path(pdf_path)
-            
-            # Process each image
-            all_text = []
-            for image in images:
-                # Convert to grayscale
-                if image.mode != 'L':
-                    image = image.convert('L')
-                
-                # Apply pre-processing
-                # image = self._preprocess_image(image)
-                
-                # Perform OCR
-                text = pytesseract.image_to_string(image, lang='eng')
-                all_text.append(text)
+            page_count = pdfinfo_from_path(pdf_path)["Pages"]
+            if page_numbers is None:
+                page_numbers = list(range(1, page_count + 1))
+            
+            # Fast path: pull the embedded text of every page in one pdftotext call
+            start = time.perf_counter()
+            text_layer = self._extract_text_layer(pdf_path)
+            usable_pages = [
+                page_number
+                for page_number, text in enumerate(text_layer[:page_count], start=1)
+                if page_number in page_numbers and self._has_usable_text(text)
+            ]
+            text_layer_words = self._extract_text_layer_words(pdf_path) if self.layout and usable_pages else []
+            text_layer_seconds = (time.perf_counter() - start) / max(page_count, 1)
             
-            # Combine text from all pages
-            return "\n\n".join(all_text)
+            results = {}
+            for page_number in usable_pages:
+                results[page_number] = {
+                    "page": page_number,
+                    "text": text_layer[page_number - 1],
+                    "seconds": text_layer_seconds,
+                    "source": "text_layer"
+                }
+                if self.layout:
+                    results[page_number]["words"] = [
+                        word for word in text_layer_words if word["page"] == page_number
+                    ]
+            
+            ocr_page_numbers = [n for n in page_numbers if n not in results]
+            if not early_stop:
+                for page in self._ocr_pdf_pages(pdf_path, ocr_page_numbers, regions):
+                    page["source"] = "ocr"
+                    results[page["page"]] = page
+                return [results[page_number] for page_number in page_numbers]
+            
+            # Incremental mode: pages arrive in order, so after each one check
+            # whether the run of pages read so far already holds the whole table
+            ocr_pages = self._ocr_pdf_pages(pdf_path, ocr_page_numbers, regions)
+            read_until = self._read_until(results, page_numbers)
+            ocr_count = 0
+            while not self._totals_reconciled([results[n] for n in page_numbers[:read_until]]):
+                if read_until == len(page_numbers) or ocr_count == self.page_budget:
+                    break
+                page = next(ocr_pages, None)
+                if page is None:
+                    break
+                page["source"] = "ocr"
+                results[page["page"]] = page
+                ocr_count += 1
+                read_until = self._read_until(results, page_numbers)
+            
+            # Cancels pages still queued in the worker pool
+            ocr_pages.close()
+            
+            pages = [results[page_number] for page_number in page_numbers[:read_until]]
+            pages.extend(
+                {"page": page_number, "text": "", "seconds": 0.0, "source": "skipped"}
+                for page_number in page_numbers[read_until:]
+            )
+            return pages
         except Exception as e:
             print(f"Error processing PDF: {e}")
-            return ""
+            return []
+    
+    def _read_until(self, results, page_numbers):
+        """
+        Count the leading pages of page_numbers that have been read
+        
+        Args:
+            results (dict): Page dictionaries read so far, by page number
+            page_numbers (list): Sorted 1-based page numbers being read
+        
+        Returns:
+            int: Length of the run of read pages at the start of page_numbers
+        """
+        count = 0
+        while count < len(page_numbers) and page_numbers[count] in results:
+            count += 1
+        return count
+    
+    def _totals_reconciled(self, pages):
+        """
+        Check whether the pages read so far contain the complete item table:
+        a totals line whose amount matches the sum of the extracted items.
+        Only local extraction is used, so the check is cheap enough to repeat
+        after every page.
+        
+        Args:
+            pages (list): Page dictionaries read so far, in page order
+        
+        Returns:
+            bool: True if a totals line reconciles with the items
+        """
+        text = "\n\n".join(page["text"] for page in pages)
+        totals = [float(amount.replace(",", "")) for amount in TOTALS_PATTERN.findall(text)]
+        if not totals:
+            return False
+        
+        words = [word for page in pages for word in page.get("words", [])]
+        items = self.layout_extractor.extract_items(words) if words else []
+        if not items:
+            # Drop the totals and tax lines themselves before parsing, while
+            # they can still be recognised
+            item_lines = [
+                line for line in text.split("\n")
+                if not line.strip().lower().startswith(SUMMARY_WORDS)
+            ]
+            items = self._parse_items("\n".join(item_lines))
+        
+        items_total = sum(item["total"] for item in items)
+        return items_total > 0 and any(
+            abs(items_total - total) <= max(1, total * TOTALS_TOLERANCE) for total in totals
+        )
+    
+    def _extract_text_layer(self, pdf_path):
+        """
+        Extract the embedded text layer of a PDF using poppler's pdftotext
+        
+        Args:
+            pdf_path (str): Path to the PDF file
+            
+        Returns:
+            list: Text of each page in page order, or an empty list if pdftotext
+                is unavailable or fails
+        """
+        try:
+            completed = subprocess.run(
+                ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+                capture_output=True,
+                check=True,
+                timeout=60
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Text layer extraction not available: {e}")
+            return []
+        
+        # pdftotext separates pages with form feeds
+        return completed.stdout.decode("utf-8", errors="replace").split("\f")
+    
+    def _extract_text_layer_words(self, pdf_path):
+        """
+        Extract word bounding boxes from the embedded text layer of a PDF
+        
+        Args:
+            pdf_path (str): Path to the PDF file
+            
+        Returns:
+            list: Word dictionaries (coordinates in PDF points), or an empty list
+                if pdftotext is unavailable or fails
+        """
+        try:
+            completed = subprocess.run(
+                ["pdftotext", "-bbox-layout", "-enc", "UTF-8", pdf_path, "-"],
+                capture_output=True,
+                check=True,
+                timeout=60
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Text layer word extraction not available: {e}")
+            return []
+        
+        return parse_bbox_layout(completed.stdout.decode("utf-8", errors="replace"))
+    
+    def _has_usable_text(self, text):
+        """
+        Check whether an extracted text layer is substantial enough to skip OCR
+        
+        Args:
+            text (str): Text extracted from one page
+            
+        Returns:
+            bool: True if the page text can be used as-is
+        """
+        return sum(1 for char in text if char.isalnum()) >= MIN_TEXT_LAYER_CHARS
+    
+    def _ocr_pdf_pages(self, pdf_path, page_numbers, regions=None):
+        """
+        Rasterise and OCR the given PDF pages
+        
+        Args:
+            pdf_path (str): Path to the PDF file
+            page_numbers (list): Sorted 1-based page numbers to OCR
+            regions (str, optional): Region-of-interest mode passed to _ocr_page
+            
+        Yields:
+            dict: Page dictionaries with "page", "text", "seconds", "dpi" and, in
+                layout mode, "words", in page order, each as soon as it and the
+                pages before it are done. Closing the generator early cancels
+                pages that have not started.
+        """
+        pages = self._iter_pdf_pages(pdf_path, page_numbers)
+        
+        if self.workers > 1 and len(page_numbers) > 1:
+            # Keep a bounded number of pages in flight so that peak memory
+            # does not grow with the page count
+            executor = self._get_executor()
+            max_in_flight = self.workers * 2
+            pending = deque()
+            
+            try:
+                for page_number, image, dpi in pages:
+                    pending.append((dpi, executor.submit(
+                        _ocr_page, page_number, image, self.engine_name, self.lang,
+                        self.preprocessor, dpi, self.adaptive_dpi, self.layout, regions
+                    )))
+                    while pending and (len(pending) >= max_in_flight or pending[0][1].done()):
+                        dpi, future = pending.popleft()
+                        yield dict(future.result(), dpi=dpi)
+            
+                while pending:
+                    dpi, future = pending.popleft()
+                    yield dict(future.result(), dpi=dpi)
+            finally:
+                for _, future in pending:
+                    future.cancel()
+        else:
+            for page_number, image, dpi in pages:
+                page = _ocr_page(
+                    page_number, image, self.engine_name, self.lang,
+                    self.preprocessor, dpi, self.adaptive_dpi, self.layout, regions
+                )
+                page["dpi"] = dpi
+                yield page
+    
+    def _iter_pdf_pages(self, pdf_path, page_numbers):
+        """
+        Rasterise PDF pages lazily, holding at most one window of pages in memory
+        
+        Args:
+            pdf_path (str): Path to the PDF file
+            page_numbers (list): Sorted 1-based page numbers to rasterise
+            
+        Yields:
+            tuple: (page_number, PIL.Image, dpi) in page order
+        """
+        # Group the requested pages into runs of consecutive pages no longer
+        # than the window, so each run is a single convert_from_path call
+        windows = []
+        for page_number in page_numbers:
+            if (windows and page_number == windows[-1][-1] + 1
+                    and len(windows[-1]) < self.page_window):
+                windows[-1].append(page_number)
+            else:
+                windows.append([page_number])
+        
+        for window in windows:
+            if not self.adaptive_dpi:
+                images = convert_from_path(
+                    pdf_path, dpi=self.dpi, first_page=window[0], last_page=window[-1]
+                )
+                
+                for page_number, image in zip(window, images):
+                    yield page_number, image, self.dpi
+                
+                # Drop our reference before rasterising the next window
+                del images
+                continue
+            
+            # Render a low-resolution probe of the window, then each page at
+            # the resolution its text height calls for
+            probes = convert_from_path(
+                pdf_path, dpi=PROBE_DPI, grayscale=True, first_page=window[0], last_page=window[-1]
+            )
+            page_dpis = [self._choose_page_dpi(probe) for probe in probes]
+            del probes
+            
+            for page_number, dpi in zip(window, page_dpis):
+                image = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)[0]
+                yield page_number, image, dpi
+                del image
+    
+    def _choose_page_dpi(self, probe):
+        """
+        Choose the rasterisation DPI for a PDF page from a low-resolution probe
+        
+        Args:
+            probe (PIL.Image): Page rendered at PROBE_DPI
+            
+        Returns:
+            int: DPI to render the page at for OCR
+        """
+        text_height = estimate_text_height(np.asarray(probe.convert('L')))
+        if text_height is None:
+            return self.dpi
+        
+        # Text height scales linearly with DPI; round to a multiple of 10
+        dpi = PROBE_DPI * TARGET_TEXT_HEIGHT / text_height
+        return int(min(MAX_OCR_DPI, max(MIN_OCR_DPI, round(dpi, -1))))
+    
+    @property
+    def engine(self):
+        """This process's OCR engine, loaded on first use."""
+        return get_process_engine(self.engine_name, self.lang)
+    
+    @property
+    def engine_version(self):
+        """Version of the OCR engine, used to key cached results."""
+        if self._engine_version is None:
+            # Check if Tesseract is available
+            try:
+                self._engine_version = self.engine.version()
+            except Exception as e:
+                print(f"Tesseract not properly configured: {e}")
+                self._engine_version = "unknown"
+                # In a production system, we might raise an exception here
+        return self._engine_version
+    
+    def _get_executor(self):
+        """
+        Lazily create the pool of long-lived OCR worker processes. Each worker
+        loads the OCR engine once at start-up and receives pages over the
+        executor's pipes.
+        
+        Workers are started from a fork server rather than forked from this
+        process. A forked worker would inherit this process's OpenMP runtime,
+        which reads OMP_THREAD_LIMIT only once, when tesserocr is first loaded.
+        Started fresh, each worker can set the limit in init_worker before it
+        loads the engine, without limiting OCR in this process.
+        
+        Returns:
+            ProcessPoolExecutor: Shared executor for this processor
+        """
+        executor = self._executor
+        if executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context(start_method),
+                        initializer=init_worker,
+                        initargs=(self.engine_name, self.lang)
+                    )
+                executor = self._executor
+        return executor
+    
+    def close(self):
+        """Shut down the OCR worker pool, if one was started."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
     
-    def _preprocess_image(self, image):
+    def _preprocess_image(self, image, source_dpi=None, resolution_fixed=False):
         """
         Apply pre-processing to improve OCR results
         
         Args:
             image (PIL.Image): Image to preprocess
+            source_dpi (float, optional): Resolution of the image, if known
+            resolution_fixed (bool, optional): True if the resolution was already
+                chosen from the text height
             
         Returns:
             PIL.Image: Preprocessed image
         """
-        # This is a placeholder for more sophisticated preprocessing
-        # In a production system, we would use more advanced techniques
-        return image
+        return self.preprocessor.process(image, source_dpi=source_dpi, resolution_fixed=resolution_fixed)
     
-    def extract_items(self, text):
+    def extract_items(self, text, words=None):
         """
         Extract structured item data from OCR text
         
         Args:
             text (str): Raw OCR text
+            words (list, optional): Word bounding boxes from process_document. When
+                given, the invoice table is first rebuilt from the word geometry,
+                which avoids the AI round-trip for well-formed invoices.
             
         Returns:
             list: List of dictionaries containing item details
         """
-        # First, enhance the OCR text with AI if available
-        if self.use_ai:
+        return self.extract_invoice(text, words)["items"]
+    
+    def extract_invoice(self, text, words=None, include_metadata=False):
+        """
+        Extract structured item data, and optionally invoice metadata, from OCR text
+        
+        Args:
+            text (str): Raw OCR text
+            words (list, optional): Word bounding boxes from process_document
+            include_metadata (bool, optional): Also extract invoice metadata (number,
+                date, vendor, totals) with AI
+        
+        Returns:
+            dict: "items" (list of item dictionaries) and "metadata" (dict, empty if
+                not requested or AI is not available)
+        """
+        items = []
+        metadata = {}
+        
+        # Try the layout-aware extractor first; it is local and cheap
+        if words:
+            items = self.layout_extractor.extract_items(words)
+            if items:
+                print(f"Layout extraction found {len(items)} items")
+        
+        if self.use_ai and (not items or include_metadata):
             try:
-                # Enhance the raw OCR text
-                enhanced_text = self.ai_processor.enhance_ocr_text(text)
-                print("OCR text enhanced with AI")
+                if items:
+                    # Only the metadata is still missing
+                    metadata = self.ai_processor.analyze_invoice_metadata(text)
+                elif self.ai_extraction_mode == "two_step":
+                    # Enhance the raw OCR text, then extract items from the enhanced copy
+                    enhanced_text = self.ai_processor.enhance_ocr_text(text)
+                    print("OCR text enhanced with AI")
                 
-                # Try AI-based extraction first
-                ai_items = self.ai_processor.extract_structured_data(enhanced_text)
-                if ai_items and len(ai_items) > 0:
-                    print(f"AI successfully extracted {len(ai_items)} items")
-                    return ai_items
+                    items = self.ai_processor.extract_structured_data(enhanced_text)
+                    if include_metadata:
+                        metadata = self.ai_processor.analyze_invoice_metadata(enhanced_text)
                 
-                # If AI extraction fails, fall back to traditional methods but use the enhanced text
-                text = enhanced_text
+                    # If AI extraction fails, fall back to traditional methods but use the enhanced text
+                    text = enhanced_text
+                else:
+                    # One request from raw text to items (and metadata)
+                    extracted = self.ai_processor.extract_invoice(text, include_metadata=include_metadata)
+                    items = extracted["items"]
+                    metadata = extracted["metadata"]
+                
+                if items:
+                    print(f"AI successfully extracted {len(items)} items")
             except Exception as e:
                 print(f"AI-based extraction failed: {e}")
                 # Continue with traditional methods
         
-        items = []
+        if not items:
+            items = self._parse_items(text)
+        
+        return {"items": items, "metadata": metadata}
+    
+    async def extract_invoice_async(self, text, ai_processor, words=None, include_metadata=False):
+        """
+        Async counterpart of extract_invoice for batch jobs. The AI request goes
+        through an AsyncAIProcessor, so many invoices can be in flight while OCR
+        continues; it always uses the combined single-request extraction.
+        
+        Args:
+            text (str): Raw OCR text
+            ai_processor (AsyncAIProcessor): Async AI client
+            words (list, optional): Word bounding boxes from process_document
+            include_metadata (bool, optional): Also extract invoice metadata with AI
+        
+        Returns:
+            dict: "items" (list of item dictionaries) and "metadata" (dict)
+        """
+        items = self.layout_extractor.extract_items(words) if words else []
+        metadata = {}
+        
+        if items and include_metadata:
+            metadata = await ai_processor.analyze_invoice_metadata_async(text)
+        elif not items:
+            extracted = await ai_processor.extract_invoice_async(text, include_metadata=include_metadata)
+            items = extracted["items"]
+            metadata = extracted["metadata"]
         
+        if not items:
+            items = self._parse_items(text)
+        
+        return {"items": items, "metadata": metadata}
+    
+    def _parse_items(self, text):
+        """
+        Extract items from OCR text with the local parsers only
+        
+        Args:
+            text (str): Raw or AI-enhanced OCR text
+        
+        Returns:
+            list: List of dictionaries containing item details
+        """
         # Clean the text
         text = self._clean_text(text)
         
-        # Split into lines
-        lines = text.split('\n')
-        
-        # Different invoice formats will require different parsing strategies
-        # This is a simple approach that looks for lines with quantity, price, and total
-        for i, line in enumerate(lines):
-            # Skip short lines
-            if len(line.strip()) < 5:
-                continue
-            
-            # Try to extract item details using regex
-            item_data = self._extract_item_from_line(line)
-            
-            if item_data:
-                items.append(item_data)
-                continue
-            
-            # Try multi-line approach if single line fails
-            if i < len(lines) - 1:
-                combined_line = line + " " + lines[i + 1]
-                item_data = self._extract_item_from_line(combined_line)
-                
-                if item_data:
-                    items.append(item_data)
+        # Parse item lines in a single pass
+        items = self._parse_item_lines(text.split('\n'))
         
         # If no items found, try a different approach
         if not items:
@@ -198,99 +1087,130 @@ class OCRProcessor:
             text (str): Raw OCR text
             
         Returns:
-            str: Cleaned text
+            str: Cleaned text, with line breaks and column gaps preserved
         """
-        # Replace common OCR errors
-        text = text.replace('|', '1')
-        text = text.replace('l', '1')
-        text = text.replace('O', '0')
-        text = text.replace('o', '0')
+        # Replace common OCR errors and drop currency symbols
+        text = text.translate(OCR_TRANSLATION)
         
-        # Replace multiple spaces with a single space
-        text = re.sub(r'\s+', ' ', text)
+        # Remove other special characters and collapse wide gaps into a
+        # two-space column separator
+        return CLEANUP_PATTERN.sub(lambda match: '  ' if match.group()[0] == ' ' else '', text)
+    
+    def _parse_item_lines(self, lines):
+        """
+        Extract item details from invoice lines in a single pass. A line holding
+        only a description is carried over to a following line that holds only
+        amounts, so wrapped items are parsed without re-reading any line.
         
-        # Replace common currency symbols
-        text = text.replace('₹', '')
-        text = text.replace('$', '')
-        text = text.replace('€', '')
+        Args:
+            lines (list): Cleaned text lines
+            
+        Returns:
+            list: List of item dictionaries
+        """
+        items = []
+        pending_name = None
         
-        # Remove other special characters
-        text = re.sub(r'[^\w\s\.\-\,]', '', text)
+        for line in lines:
+            # Skip short lines
+            if len(line.strip()) < 5:
+                continue
+            
+            name_tokens, numbers, has_unit = self._tokenize_item_line(line)
+            
+            if not numbers:
+                # A description that may continue on the next line
+                pending_name = name_tokens or None
+                continue
+            
+            if not name_tokens and pending_name:
+                name_tokens = pending_name
+            pending_name = None
+            
+            item_data = self._build_item(name_tokens, numbers, has_unit)
+            if item_data:
+                items.append(item_data)
         
-        return text
+        return items
     
-    def _extract_item_from_line(self, line):
+    def _tokenize_item_line(self, line):
         """
-        Extract item details from a single line
+        Split a line into its description and the trailing run of amounts
         
         Args:
             line (str): Line of text
             
         Returns:
-            dict: Item details or None if no match
+            tuple: (description tokens, trailing amounts, whether a unit word
+                such as "pcs" appeared among the amounts)
+        """
+        tokens = line.split()
+        numbers = []
+        has_unit = False
+        
+        # Walk back from the end over amounts, unit words and multiplication signs
+        end = len(tokens)
+        while end > 0:
+            token = tokens[end - 1].lower()
+            if NUMBER_TOKEN.fullmatch(token):
+                numbers.append(float(token.replace(',', '')))
+            elif token in UNIT_WORDS:
+                has_unit = True
+            elif token not in MULTIPLY_WORDS:
+                break
+            end -= 1
+        
+        numbers.reverse()
+        name_tokens = [token.strip('.,-') for token in tokens[:end]]
+        return [token for token in name_tokens if token], numbers, has_unit
+    
+    def _build_item(self, name_tokens, numbers, has_unit):
         """
-        # This regex pattern tries to match common invoice line item formats
-        # It's simplified and would need to be adapted to specific invoice formats
-        patterns = [
-            # Pattern 1: Item name followed by quantity, unit price, and total
-            r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)\s+(?:x\s+)?(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)',
+        Map a description and its amounts to item details
+        
+        Args:
+            name_tokens (list): Description tokens
+            numbers (list): Trailing amounts on the line
+            has_unit (bool): Whether a unit word appeared among the amounts
             
-            # Pattern 2: Item name followed by quantity and total (no unit price)
-            r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)\s+(?:pcs|units|nos)?\s+(\d+(?:\.\d+)?)',
+        Returns:
+            dict: Item details or None if the line is not an item
+        """
+        item_name = ' '.join(name_tokens)
+        if not any(char.isalpha() for char in item_name):
+            return None
+        
+        # Item name followed by quantity, unit price, and total
+        if len(numbers) >= 3:
+            qty, unit_price, total = numbers[-3:]
             
-            # Pattern 3: Just item name and price
-            r'([\w\s\-]+)\s+(\d+(?:\.\d+)?)'
-        ]
+            # Verify that qty * unit_price is approximately equal to total
+            if abs(qty * unit_price - total) <= 1:  # Allow for small rounding differences
+                return {
+                    "item": item_name,
+                    "qty": qty,
+                    "unit_price": unit_price,
+                    "total": total
+                }
         
-        for pattern in patterns:
-            match = re.search(pattern, line)
-            if match:
-                groups = match.groups()
-                
-                if len(groups) == 4:  # Pattern 1
-                    item_name = groups[0].strip()
-                    qty = float(groups[1])
-                    unit_price = float(groups[2])
-                    total = float(groups[3])
-                    
-                    # Verify that qty * unit_price is approximately equal to total
-                    calculated_total = qty * unit_price
-                    if abs(calculated_total - total) > 1:  # Allow for small rounding differences
-                        # If totals don't match, this might not be a valid item line
-                        continue
-                    
-                    return {
-                        "item": item_name,
-                        "qty": qty,
-                        "unit_price": unit_price,
-                        "total": total
-                    }
-                
-                elif len(groups) == 3:  # Pattern 2
-                    item_name = groups[0].strip()
-                    qty = float(groups[1])
-                    total = float(groups[2])
-                    unit_price = total / qty if qty else 0
-                    
-                    return {
-                        "item": item_name,
-                        "qty": qty,
-                        "unit_price": unit_price,
-                        "total": total
-                    }
-                
-                elif len(groups) == 2:  # Pattern 3
-                    item_name = groups[0].strip()
-                    total = float(groups[1])
-                    
-                    return {
-                        "item": item_name,
-                        "qty": 1,  # Assume quantity of 1
-                        "unit_price": total,
-                        "total": total
-                    }
+        # Item name followed by quantity and total (no unit price)
+        if len(numbers) == 2 or (len(numbers) > 2 and has_unit):
+            qty, total = numbers[-2:]
+            return {
+                "item": item_name,
+                "qty": qty,
+                "unit_price": total / qty if qty else 0,
+                "total": total
+            }
         
-        return None
+        # Just item name and price
+        total = numbers[-1]
+        return {
+            "item": item_name,
+            "qty": 1,  # Assume quantity of 1
+            "unit_price": total,
+            "total": total
+        }
     
     def _extract_items_table_format(self, text):
         """
@@ -1,6 +1,8 @@
 {pkgs}: {
   deps = [
     pkgs.glibcLocales
+    pkgs.leptonica
+    pkgs.pkg-config
     pkgs.poppler_utils
     pkgs.tesseract
   ];
@@ -0,0 +1,197 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+
+class ResultCache:
+    def __init__(self, db_path, max_bytes=256 * 1024 * 1024, ttl=None):
+        """
+        Initialize a persistent, size-bounded LRU cache backed by SQLite
+        
+        Args:
+            db_path (str): Path to the SQLite cache file
+            max_bytes (int, optional): Maximum total size of cached values. The least
+                recently used entries are evicted once this is exceeded.
+            ttl (float, optional): Seconds an entry stays valid after it is stored;
+                entries never expire if None
+        """
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Hit and miss counters per namespace, for callers that share one cache
+        self.namespaces = {}
+        
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                created REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Caches created before entries had a creation time
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cache_entries)")]
+        if "created" not in columns:
+            self.conn.execute("ALTER TABLE cache_entries ADD COLUMN created REAL NOT NULL DEFAULT 0")
+        
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_entries_last_access ON cache_entries (last_access)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_entries_created ON cache_entries (created)"
+        )
+        self.conn.commit()
+    
+    def get(self, key, namespace=None):
+        """
+        Look up a cached value and mark it as recently used
+        
+        Args:
+            key (str): Cache key
+            namespace (str, optional): Name the lookup is counted under in stats()
+            
+        Returns:
+            The cached value, or None on a miss
+        """
+        try:
+            with self._lock:
+                row = self.conn.execute(
+                    "SELECT value, created FROM cache_entries WHERE key = ?", (key,)
+                ).fetchone()
+                
+                now = time.time()
+                if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                    self.conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                    self.conn.commit()
+                    self.expirations += 1
+                    row = None
+                
+                if row is None:
+                    self.misses += 1
+                    self._count(namespace, "misses")
+                    return None
+                
+                self.conn.execute(
+                    "UPDATE cache_entries SET last_access = ? WHERE key = ?",
+                    (now, key)
+                )
+                self.conn.commit()
+                self.hits += 1
+                self._count(namespace, "hits")
+                return json.loads(row[0])
+        except Exception as e:
+            print(f"Error reading from cache: {e}")
+            return None
+    
+    def set(self, key, value):
+        """
+        Store a value, evicting least recently used entries if the cache is full
+        
+        Args:
+            key (str): Cache key
+            value: JSON-serialisable value to cache
+        """
+        try:
+            payload = json.dumps(value)
+            size = len(payload.encode("utf-8"))
+            if size > self.max_bytes:
+                return
+            
+            now = time.time()
+            with self._lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, value, size, last_access, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, size, now, now)
+                )
+                self._evict()
+                self.conn.commit()
+        except Exception as e:
+            print(f"Error writing to cache: {e}")
+    
+    def _count(self, namespace, counter):
+        """Increment a per-namespace hit or miss counter"""
+        if namespace is None:
+            return
+        counters = self.namespaces.setdefault(namespace, {"hits": 0, "misses": 0})
+        counters[counter] += 1
+    
+    def _evict(self):
+        """Delete expired entries, then least recently used ones until the cache fits in max_bytes."""
+        if self.ttl is not None:
+            expired = self.conn.execute(
+                "DELETE FROM cache_entries WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+            self.expirations += max(expired, 0)
+        
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        rows = self.conn.execute(
+            "SELECT key, size FROM cache_entries ORDER BY last_access ASC"
+        ).fetchall()
+        
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        
+        self.conn.executemany("DELETE FROM cache_entries WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+    
+    def stats(self):
+        """
+        Get cache hit/miss counters and current size
+        
+        Returns:
+            dict: Cache statistics
+        """
+        with self._lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+            ).fetchone()
+        
+        lookups = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl
+        }
+        
+        if self.namespaces:
+            stats["namespaces"] = {}
+            for namespace, counters in self.namespaces.items():
+                namespace_lookups = counters["hits"] + counters["misses"]
+                stats["namespaces"][namespace] = dict(
+                    counters,
+                    hit_rate=counters["hits"] / namespace_lookups if namespace_lookups else 0
+                )
+        
+        return stats
+    
+    def __del__(self):
+        """Close the cache connection when the object is destroyed."""
+        if hasattr(self, 'conn'):
+            self.conn.close()